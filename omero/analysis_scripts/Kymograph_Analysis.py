@@ -31,7 +31,7 @@ kymograph images that have been created by the 'Kymograph.py' Script.
 
 from omero.gateway import BlitzGateway
 import omero
-from omero.rtypes import rlong, rstring, robject
+from omero.rtypes import rlong, rstring, robject, rlist
 from omero.model import ImageAnnotationLinkI, ImageI
 import omero.scripts as scripts
 import omero.util.script_utils as script_utils
@@ -40,6 +40,51 @@ import logging
 
 logger = logging.getLogger('kymograph_analysis')
 
+ROIS_QUERY = ("select distinct roi from Roi roi"
+              " join fetch roi.shapes shape"
+              " left outer join fetch shape.transform"
+              " where roi.image.id in (:ids)")
+
+
+def load_rois(conn, image_ids, shape_types=None, page_size=500):
+    """
+    Loads the ROIs of the images, for page_size images per query.
+
+    :param image_ids: IDs of the images
+    :param shape_types: E.g. ["Rectangle"] or ["Line", "Polyline"] to only
+                        keep these shapes. ROIs without any are left out.
+    :return: Dict of {image_id: [(roi, shapes)]} for every image, with the
+             ROIs in order of ID and the shapes as from roi.copyShapes()
+    """
+    shape_classes = None
+    if shape_types is not None:
+        shape_classes = tuple(getattr(omero.model, "%sI" % shape_type)
+                              for shape_type in shape_types)
+    unique_ids = list(dict.fromkeys(image_ids))
+    rois_by_image = dict((image_id, []) for image_id in unique_ids)
+    query_service = conn.getQueryService()
+    for start in range(0, len(unique_ids), page_size):
+        params = omero.sys.ParametersI()
+        params.add("ids", rlist([rlong(i) for i in
+                                 unique_ids[start:start + page_size]]))
+        rois = query_service.findAllByQuery(ROIS_QUERY, params,
+                                            conn.SERVICE_OPTS)
+        for roi in rois:
+            # shapes can be None in some situations
+            shapes = [shape for shape in roi.copyShapes()
+                      if shape is not None]
+            if shape_classes is not None:
+                shapes = [shape for shape in shapes
+                          if isinstance(shape, shape_classes)]
+                if not shapes:
+                    continue
+            rois_by_image[roi.getImage().getId().getValue()].append(
+                (roi, shapes))
+    for rois in rois_by_image.values():
+        # Sort by ROI.id (same as in iviewer)
+        rois.sort(key=lambda r: r[0].getId().getValue())
+    return rois_by_image
+
 
 def process_images(conn, script_params):
 
@@ -51,8 +96,9 @@ def process_images(conn, script_params):
     if not images:
         return None, message
     # Check for line and polyline ROIs and filter images list
-    images = [image for image in images if
-              image.getROICount(["Polyline", "Line"]) > 0]
+    rois_by_image = load_rois(conn, [image.getId() for image in images],
+                              ["Line", "Polyline"])
+    images = [image for image in images if rois_by_image[image.getId()]]
     if not images:
         message += "No ROI containing line or polyline was found."
         return None, message
@@ -66,9 +112,6 @@ def process_images(conn, script_params):
                 " not a kymograph." % (image.getName(), image.getId())
             continue
 
-        roi_service = conn.getRoiService()
-        result = roi_service.findByImage(image.getId(), None)
-
         secs_per_pixel_y = image.getPixelSizeY()
         microns_per_pixel_x = image.getPixelSizeX()
         if secs_per_pixel_y and microns_per_pixel_x:
@@ -82,10 +125,8 @@ def process_images(conn, script_params):
             " x_end (pixels), dt (pixels), dx (pixels), x/t, speed(um/sec)," \
             "avg x/t, avg speed(um/sec)"
         table_data = ""
-        for roi in result.rois:
-            for s in roi.copyShapes():
-                if s is None:
-                    continue    # seems possible in some situations
+        for roi, shapes in rois_by_image[image.getId()]:
+            for s in shapes:
                 if isinstance(s, omero.model.LineI):
                     table_data += "\nLine ID: %s" % s.getId().getValue()
                     x1 = s.getX1().getValue()
@@ -31,76 +31,701 @@ zip file for download.
 # @since 3.0-Beta4.3
 
 import omero.scripts as scripts
-from omero.gateway import BlitzGateway
+from omero.gateway import BlitzGateway, ImageWrapper
 import omero.util.script_utils as script_utils
 import omero
-from omero.rtypes import rstring, rlong, robject
+from omero.rtypes import rstring, rlong, robject, unwrap, rlist
 from omero.constants.namespaces import NSCREATED, NSOMETIFF
 import os
 
-import glob
+import hashlib
+import json
+import queue
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
 import zipfile
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from datetime import datetime
+from io import BytesIO
 
+import numpy
 from PIL import Image
 
-# keep track of log strings.
-log_strings = []
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+try:
+    import tifffile
+except ImportError:
+    tifffile = None
+try:
+    import zarr
+    # OME-Zarr is written with the API of zarr 2
+    if int(zarr.__version__.split(".")[0]) > 2:
+        zarr = None
+except ImportError:
+    zarr = None
+
+# Z-section choices that project the Z-range
+PROJECTIONS = {'Max projection': 'max',
+               'Mean projection': 'mean',
+               'Sum projection': 'sum'}
+
+# OME-TIFF blocks read from the server grow up to this size (bytes)
+MAX_BLOCK_SIZE = 16 * 1024 * 1024
+# OME-TIFFs read by workers are held in memory up to this size (bytes),
+# then in a temporary file, until they are added to the zip
+SPOOL_SIZE = 64 * 1024 * 1024
+# Max number of pixels rendered at once for a PNG or TIFF of a zoomed
+# 'Big' image
+RENDER_REGION_SIZE = 1024 * 1024
+# The zip of an export is checkpointed at most this often (seconds), so
+# that a failed export can resume
+CHECKPOINT_INTERVAL = 60
+# Checkpoint folders of failed exports are kept this long (seconds)
+CHECKPOINT_MAX_AGE = 7 * 24 * 3600
+
+# IDs of images for each container
+IMAGE_ID_QUERIES = {
+    "Image": ("select image.id, image.id from Image image"
+              " where image.id in (:ids)"),
+    "Dataset": ("select link.parent.id, link.child.id"
+                " from DatasetImageLink link"
+                " where link.parent.id in (:ids)"
+                " order by link.child.id")}
+
+IMAGES_QUERY = ("select distinct image from Image image"
+                " join fetch image.pixels pixels"
+                " join fetch pixels.pixelsType"
+                " left outer join fetch pixels.channels channel"
+                " left outer join fetch channel.logicalChannel"
+                " where image.id in (:ids)")
+
+# big-endian numpy types of the raw pixels
+PIXEL_TYPES = {'int8': 'i1', 'uint8': 'u1',
+               'int16': '>i2', 'uint16': '>u2',
+               'int32': '>i4', 'uint32': '>u4',
+               'float': '>f4', 'double': '>f8'}
+
+LOG_NAME = 'Batch_Image_Export.txt'
+
+# log of the export, written to a text file in the export folder. Lines are
+# held in memory until the file is opened with open_log_file(), then up to
+# max_lines at a time
+log_sink = {
+    "file": None,
+    "lines": [],
+    "max_lines": 1000,
+    "enabled": True,
+    # workers of a pool may log at the same time
+    "lock": threading.Lock()}
 
 
 def log(text):
     """
-    Adds the text to a list of logs. Compiled into text file at the end.
+    Adds the text to the log. Written to the log file as the export goes.
+    """
+    log_line(log_sink, text)
+
+
+def open_log_file(sink, path):
+    """Starts writing the log to a new file, including the lines so far."""
+    with sink["lock"]:
+        sink["file"] = open(path, 'w')
+        write_lines(sink)
+
+
+def disable_log(sink):
+    """Drops the lines so far and ignores any more."""
+    with sink["lock"]:
+        sink["enabled"] = False
+        sink["lines"] = []
+
+
+def log_line(sink, text):
+    """Adds the text to the log."""
+    if not sink["enabled"]:
+        return
+    with sink["lock"]:
+        sink["lines"].append(str(text))
+        if sink["file"] is not None and \
+                len(sink["lines"]) >= sink["max_lines"]:
+            write_lines(sink)
+
+
+def write_lines(sink):
+    """Appends the lines held in memory to the file. Call with the lock."""
+    if sink["file"] is None:
+        return
+    for line in sink["lines"]:
+        sink["file"].write(line)
+        sink["file"].write("\n")
+    sink["lines"] = []
+
+
+def flush_log(sink):
+    """Writes the lines held in memory to the log file now."""
+    with sink["lock"]:
+        write_lines(sink)
+        if sink["file"] is not None:
+            sink["file"].flush()
+
+
+def close_log(sink):
+    """Writes any lines held in memory and closes the log file."""
+    with sink["lock"]:
+        write_lines(sink)
+        if sink["file"] is not None:
+            sink["file"].close()
+            sink["file"] = None
+
+
+def get_checkpoint_dir(conn, script_params):
+    """
+    Returns the folder where an export with these parameters, by the
+    current user, keeps its zip and ledger until it has completed.
+    A rerun of the same export finds the folder left by a failed run.
+    """
+    params = dict(script_params)
+    # doesn't change what is exported
+    params.pop("Max_Workers", None)
+    params["user"] = conn.getUserId()
+    params["group"] = conn.getGroupFromContext().getId()
+    key = json.dumps(params, sort_keys=True, default=str)
+    key = hashlib.sha1(key.encode('utf8')).hexdigest()
+    return os.path.join(tempfile.gettempdir(), "Batch_Image_Export", key)
+
+
+def remove_old_checkpoint_dirs(parent_dir, max_age=CHECKPOINT_MAX_AGE):
+    """
+    Removes the checkpoint folders of failed exports that haven't been
+    written to for max_age seconds, unless an export is using them.
+    """
+    if not os.path.isdir(parent_dir):
+        return
+    now = time.time()
+    for entry in os.scandir(parent_dir):
+        if not entry.is_dir():
+            continue
+        try:
+            times = [f.stat().st_mtime for f in os.scandir(entry.path)]
+            times.append(entry.stat().st_mtime)
+        except OSError:
+            continue
+        if now - max(times) < max_age:
+            continue
+        try:
+            lock_file = open(os.path.join(entry.path, "lock"), 'w')
+        except OSError:
+            continue
+        try:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            log("Removing old checkpoint: %s" % entry.name)
+            shutil.rmtree(entry.path, ignore_errors=True)
+        except OSError:
+            # used by a running export
+            pass
+        finally:
+            lock_file.close()
+
+
+def lock_checkpoint_dir(checkpoint_dir):
+    """
+    Creates the checkpoint folder and locks it, so that it is only used by
+    one run of the export at a time. If another run of the same export
+    holds the lock, a new folder is used instead and nothing is resumed.
+    The lock is released when the returned file is closed.
+
+    :return: Tuple of (folder, lock file)
     """
-    # Handle unicode
     try:
-        text = text.encode('utf8')
-    except UnicodeEncodeError:
+        os.makedirs(checkpoint_dir)
+    except OSError:
         pass
-    log_strings.append(str(text))
+    lock_file = open(os.path.join(checkpoint_dir, "lock"), 'w')
+    if fcntl is None:
+        return checkpoint_dir, lock_file
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return checkpoint_dir, lock_file
+    except OSError:
+        lock_file.close()
+    log("Same export already running: starting a new export")
+    checkpoint_dir = tempfile.mkdtemp(dir=os.path.dirname(checkpoint_dir))
+    return checkpoint_dir, open(os.path.join(checkpoint_dir, "lock"), 'w')
 
 
-def compress(target, base):
+def open_ledger(ledger_path):
+    """
+    Opens the SQLite ledger of the files written to the zip, creating
+    the tables if needed.
     """
-    Creates a ZIP recursively from a given base directory.
+    ledger = sqlite3.connect(ledger_path, check_same_thread=False)
+    ledger.execute(
+        "CREATE TABLE IF NOT EXISTS planes (image_id INTEGER, rdef TEXT,"
+        " c TEXT, z TEXT, t INTEGER, name TEXT, checksum INTEGER,"
+        " PRIMARY KEY (image_id, rdef, c, z, t))")
+    # the zip central directory entries of the files, see get_zip_entry()
+    ledger.execute(
+        "CREATE TABLE IF NOT EXISTS entries (name TEXT, date_time TEXT,"
+        " compress_type INTEGER, crc INTEGER, compress_size INTEGER,"
+        " file_size INTEGER, header_offset INTEGER, external_attr INTEGER,"
+        " flag_bits INTEGER, create_version INTEGER,"
+        " extract_version INTEGER, extra BLOB)")
+    ledger.execute(
+        "CREATE TABLE IF NOT EXISTS checkpoint (start_dir INTEGER)")
+    ledger.commit()
+    return ledger
+
+
+def create_zip_sink(target, ledger_path=None):
+    """
+    Opens the zip file that exported files are written to as they are made.
+
+    If a ledger is used and a previous run left a checkpoint, the zip is
+    restored to its state at the last checkpoint and the files written
+    before it are not exported again.
 
     :param target: Name of the zip file we want to write e.g. "folder.zip"
-    :param base: Name of folder that we want to zip up E.g. "folder"
+    :param ledger_path: Path of the SQLite ledger or None
+    :return: Dict of sink state, used by add_to_zip()
     """
-    zip_file = zipfile.ZipFile(target, 'w')
-    try:
-        files = os.path.join(base, "*")
-        for name in glob.glob(files):
-            zip_file.write(name, os.path.basename(name), zipfile.ZIP_DEFLATED)
+    sink = {
+        "target": target,
+        # file names in the zip, handed out by make_image_name()
+        "names": set(),
+        # zip file can only be written by one worker at a time
+        "lock": threading.Lock(),
+        "ledger": None,
+        # key: name of files in the zip at the last checkpoint
+        "done": {},
+        # number of files in the zip at the last checkpoint
+        "entries": 0,
+        "checkpoint_time": time.time(),
+        # image ID: rendering settings version, see get_rdef_version()
+        "rdefs": {}}
+    if ledger_path is None:
+        sink["zip"] = zipfile.ZipFile(target, 'w', allowZip64=True)
+        return sink
+
+    ledger = open_ledger(ledger_path)
+    sink["ledger"] = ledger
+    row = ledger.execute("SELECT start_dir FROM checkpoint").fetchone()
+    if row is None or not os.path.exists(target):
+        ledger.execute("DELETE FROM planes")
+        ledger.execute("DELETE FROM entries")
+        ledger.commit()
+        sink["zip"] = zipfile.ZipFile(target, 'w', allowZip64=True)
+        return sink
+
+    # the zip has no central directory. Drop the files added after the
+    # last checkpoint and write the directory of the files before it.
+    with open(target, 'r+b') as f:
+        f.truncate(row[0])
+        f.seek(row[0])
+        with zipfile.ZipFile(f, 'w', allowZip64=True) as zip_file:
+            for entry in ledger.execute(
+                    "SELECT * FROM entries ORDER BY header_offset"):
+                zip_file.filelist.append(get_zip_entry(entry))
+    sink["zip"] = zipfile.ZipFile(target, 'a', allowZip64=True)
+    sink["entries"] = len(sink["zip"].filelist)
+    crcs = dict((i.filename, i.CRC) for i in sink["zip"].infolist())
+    # names of the files and OME-Zarr folders in the zip can't be used
+    # again, even if the file is exported again with other settings
+    for name in crcs:
+        sink["names"].add(name)
+        sink["names"].add(name.split("/")[0])
+    for image_id, rdef, c, z, t, name, checksum in ledger.execute(
+            "SELECT image_id, rdef, c, z, t, name, checksum FROM planes"):
+        if crcs.get(name) == checksum:
+            sink["done"][(image_id, rdef, c, z, t)] = name
+    log("Resuming export: %s files already exported" % len(sink["done"]))
+    return sink
+
+
+def get_export_key(sink, image_id, channel, z_range, t):
+    """
+    Returns the key of an exported file in the ledger. Rendered planes
+    include the version of the rendering settings.
+
+    :param channel: Channel index, None for merged or the format name for
+                    a file of the whole image e.g. 'OME-TIFF'
+    """
+    return (image_id, sink["rdefs"].get(image_id, ""),
+            "merged" if channel is None else str(channel),
+            "%s" % (z_range,), t)
+
+
+def is_exported(sink, key):
+    """
+    Returns True if the file was written to the zip before the last
+    checkpoint. Its name is already in sink["names"].
+    """
+    name = sink["done"].get(key)
+    if name is not None:
+        log("  Already exported: %s" % name)
+    return name is not None
+
+
+def record_export(sink, key, name, checksum):
+    """
+    Adds a file written to the zip to the ledger. Call with the sink lock
+    held. Saved to disk at the next checkpoint.
+    """
+    if sink["ledger"] is not None:
+        sink["ledger"].execute(
+            "INSERT OR REPLACE INTO planes VALUES (?, ?, ?, ?, ?, ?, ?)",
+            key + (name, checksum))
+
+
+def get_zip_entry(row):
+    """Returns the ZipInfo of a row of the entries table of the ledger."""
+    zip_info = zipfile.ZipInfo(row[0], tuple(json.loads(row[1])))
+    (zip_info.compress_type, zip_info.CRC, zip_info.compress_size,
+     zip_info.file_size, zip_info.header_offset, zip_info.external_attr,
+     zip_info.flag_bits, zip_info.create_version, zip_info.extract_version,
+     zip_info.extra) = row[2:]
+    return zip_info
+
+
+def checkpoint_zip_sink(sink):
+    """
+    Saves the central directory entries of the files added to the zip
+    since the last checkpoint, with the files written so far, so that the
+    zip can be restored to this state if the export fails.
+    """
+    if sink["ledger"] is None:
+        return
+    with sink["lock"]:
+        sink["zip"].fp.flush()
+        new_entries = sink["zip"].filelist[sink["entries"]:]
+        sink["ledger"].executemany(
+            "INSERT INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            [(i.filename, json.dumps(i.date_time), i.compress_type, i.CRC,
+              i.compress_size, i.file_size, i.header_offset,
+              i.external_attr, i.flag_bits, i.create_version,
+              i.extract_version, i.extra) for i in new_entries])
+        sink["ledger"].execute("DELETE FROM checkpoint")
+        sink["ledger"].execute("INSERT INTO checkpoint VALUES (?)",
+                               (sink["zip"].start_dir,))
+        sink["ledger"].commit()
+        sink["entries"] += len(new_entries)
+        sink["checkpoint_time"] = time.time()
+
+
+def remove_stale_exports(sink, image_id):
+    """
+    Removes the planes of the image that were exported before the last
+    checkpoint with other rendering settings, so that they are exported
+    again. The zip is written again without them, then checkpointed.
+    """
+    rdef = sink["rdefs"].get(image_id)
+    stale = [key for key in sink["done"]
+             if key[0] == image_id and key[1] != rdef]
+    if not stale:
+        return
+    log("  Rendering settings changed: exporting %s files again"
+        % len(stale))
+    names = set(sink["done"].pop(key) for key in stale)
+    tmp_path = "%s.tmp" % sink["target"]
+    with sink["lock"]:
+        sink["zip"].close()
+        with zipfile.ZipFile(sink["target"]) as old_zip, \
+                zipfile.ZipFile(tmp_path, 'w', allowZip64=True) as new_zip:
+            for zip_info in old_zip.infolist():
+                if zip_info.filename not in names:
+                    new_zip.writestr(zip_info, old_zip.read(zip_info))
+        os.replace(tmp_path, sink["target"])
+        sink["zip"] = zipfile.ZipFile(sink["target"], 'a', allowZip64=True)
+        sink["names"].difference_update(names)
+        sink["ledger"].executemany(
+            "DELETE FROM planes WHERE image_id = ? AND rdef = ? AND c = ?"
+            " AND z = ? AND t = ?", stale)
+        # the files have moved: all the entries are saved again
+        sink["ledger"].execute("DELETE FROM entries")
+        sink["entries"] = 0
+    checkpoint_zip_sink(sink)
+
+
+def get_rdef_version(conn, image):
+    """
+    Returns the ID and last update of the rendering settings used for the
+    image, so that planes are exported again if the settings change.
+    The Rendering Engine of the image must be prepared.
+    """
+    rdef_id = image._re.getRenderingDefId()
+    params = omero.sys.ParametersI()
+    params.addId(rdef_id)
+    rows = conn.getQueryService().projection(
+        "select r.details.updateEvent.id from RenderingDef r"
+        " where r.id = :id", params, conn.SERVICE_OPTS)
+    event_id = unwrap(rows[0][0]) if rows else None
+    return "%s:%s" % (rdef_id, event_id)
+
+
+def get_zip_info(name, compress):
+    """Returns a ZipInfo for a new file written to the zip now."""
+    zip_info = zipfile.ZipInfo(name, datetime.now().timetuple()[:6])
+    zip_info.external_attr = 0o644 << 16
+    if compress:
+        zip_info.compress_type = zipfile.ZIP_DEFLATED
+    return zip_info
+
+
+def add_to_zip(sink, name, data, compress=True, key=None):
+    """
+    Adds the bytes to the zip as a new file.
+
+    :param name: File name in the zip, from make_image_name()
+    :param compress: If False, data is stored as it is. Use for data that
+                     is already compressed e.g. png or jpeg
+    :param key: If not None, the file is added to the ledger with this key
+    """
+    zip_info = get_zip_info(name, compress)
+    with sink["lock"]:
+        sink["zip"].writestr(zip_info, data)
+        if key is not None:
+            record_export(sink, key, name, zip_info.CRC)
+
+
+def get_dtype(pixels_type):
+    """
+    Returns the big-endian numpy dtype of the raw pixels, e.g. '>u2' for
+    'uint16'. 'bit' pixels are unpacked to uint8.
+    """
+    if pixels_type == "bit":
+        return numpy.dtype(numpy.uint8)
+    return numpy.dtype(PIXEL_TYPES[pixels_type])
 
+
+def from_raw(data, pixels_type, size_x, size_y):
+    """
+    Returns the raw bytes of a plane or tile as a 2D numpy array of
+    size_y rows and size_x columns. The array is a read-only view of the
+    bytes, except for 'bit' pixels, which are unpacked.
+    """
+    if pixels_type == "bit":
+        plane = numpy.unpackbits(numpy.frombuffer(data, numpy.uint8))
+        plane = plane[:size_x * size_y]
+    else:
+        plane = numpy.frombuffer(data, PIXEL_TYPES[pixels_type])
+    return plane.reshape(size_y, size_x)
+
+
+def get_raw_plane(raw_store, pixels_type, size_x, size_y, z, c, t):
+    """
+    Reads a plane from the Raw Pixels Store as a 2D numpy array.
+    z, c and t are 0-based.
+    """
+    return from_raw(raw_store.getPlane(z, c, t), pixels_type, size_x, size_y)
+
+
+def get_raw_tile(raw_store, pixels_type, z, c, t, x, y, w, h):
+    """
+    Reads a tile from the Raw Pixels Store as a 2D numpy array of h rows
+    and w columns. z, c and t are 0-based.
+    """
+    return from_raw(raw_store.getTile(z, c, t, x, y, w, h), pixels_type,
+                    w, h)
+
+
+def project_planes(planes, projection):
+    """
+    Projects the 2D planes, one at a time so that only the projection
+    and the current plane are held in memory.
+
+    :param planes: Iterable of 2D numpy arrays
+    :param projection: 'max', 'mean' or 'sum'
+    :return: 2D float numpy array
+    """
+    result = None
+    count = 0
+    for plane in planes:
+        count += 1
+        if result is None:
+            result = plane.astype(numpy.float64)
+        elif projection == 'max':
+            numpy.maximum(result, plane, out=result)
+        else:
+            result += plane
+    if projection == 'mean':
+        result /= count
+    return result
+
+
+def is_local_projection(project_z, z_step):
+    """
+    Returns True if the projection is made by render_projection(). The
+    server projects every plane of a range, but can't skip planes.
+    """
+    return project_z is not None and z_step > 1
+
+
+def render_projection(image, raw_store, z_range, t, projection, z_step=1):
+    """
+    Projects the raw planes for the Z-range of each active channel and
+    renders the projection with the channel's window and colour, in the
+    same way as the current rendering settings.
+    Lookup tables, reverse intensity and non-linear rendering families are
+    not supported.
+
+    :param raw_store: Raw Pixels Store with the image's pixels set
+    :param z_range: Tuple of (zStart, zStop). 1-based
+    :param t: T index. 1-based
+    :param projection: 'max', 'mean' or 'sum'
+    :param z_step: Project every z_step plane of the range
+    :return: PIL Image
+    """
+    pixels = image.getPrimaryPixels()
+    size_x = pixels.getSizeX()
+    size_y = pixels.getSizeY()
+    pixels_type = pixels.getPixelsType().getValue()
+    greyscale = image.isGreyscaleRenderingModel()
+    z_indexes = range(z_range[0] - 1, z_range[1] - 1, z_step)
+
+    rgb = numpy.zeros((size_y, size_x, 3))
+    for c, ch in enumerate(image.getChannels()):
+        if not ch.isActive():
+            continue
+        planes = (get_raw_plane(raw_store, pixels_type, size_x, size_y,
+                                z, c, t - 1) for z in z_indexes)
+        plane = project_planes(planes, projection)
+        start = ch.getWindowStart()
+        end = ch.getWindowEnd()
+        if projection == 'sum':
+            # as the server does, so that the sum doesn't saturate
+            start *= len(z_indexes)
+            end *= len(z_indexes)
+        plane -= start
+        plane /= max(end - start, 1e-9)
+        numpy.clip(plane, 0, 1, out=plane)
+        colour = (255, 255, 255) if greyscale else ch.getColor().getRGB()
+        rgb += plane[:, :, numpy.newaxis] * numpy.array(colour[:3])
+    numpy.clip(rgb, 0, 255, out=rgb)
+    return Image.fromarray(rgb.astype(numpy.uint8), 'RGB')
+
+
+def get_raw_pixels_store(image):
+    """Returns a Raw Pixels Store for the image's pixels."""
+    raw_store = image._conn.c.sf.createRawPixelsStore()
+    raw_store.setPixelsId(image.getPrimaryPixels().getId(), True)
+    return raw_store
+
+
+def get_zoom_level(image, zoom_percent):
+    """
+    Returns the smallest resolution level of the Rendering Engine that is
+    at least as big as the zoomed image, as (level, size_x, size_y).
+    Returns None if the image has no pyramid or the level is the full
+    resolution.
+    """
+    if zoom_percent >= 100 or image._re is None or \
+            not image._re.requiresPixelsPyramid():
+        return None
+    # full resolution first
+    levels = image._re.getResolutionDescriptions()
+    width = image.getSizeX() * zoom_percent / 100
+    for i in range(len(levels) - 1, 0, -1):
+        if levels[i].sizeX >= width:
+            # levels of the Rendering Engine are numbered from the smallest
+            return len(levels) - 1 - i, levels[i].sizeX, levels[i].sizeY
+    return None
+
+
+def render_level(image, z, t, level, size_x, size_y):
+    """
+    Renders a plane at a resolution level of the pyramid, without the loss
+    of a jpeg, in strips of up to RENDER_REGION_SIZE pixels.
+
+    :param z: Z index, 0-based
+    :param t: T index, 0-based
+    :return: RGB PIL Image
+    """
+    previous_level = image._re.getResolutionLevel()
+    image._re.setResolutionLevel(level)
+    plane = numpy.empty((size_y, size_x), numpy.uint32)
+    rows = max(1, RENDER_REGION_SIZE // size_x)
+    try:
+        for y in range(0, size_y, rows):
+            plane_def = omero.romio.PlaneDef()
+            plane_def.slice = omero.romio.XY
+            plane_def.z = z
+            plane_def.t = t
+            plane_def.region = omero.romio.RegionDef()
+            plane_def.region.x = 0
+            plane_def.region.y = y
+            plane_def.region.width = size_x
+            plane_def.region.height = min(rows, size_y - y)
+            packed = image._re.renderAsPackedInt(plane_def,
+                                                 image._conn.SERVICE_OPTS)
+            # each pixel is a signed int of 0xAARRGGBB
+            plane[y:y + rows] = numpy.array(packed, numpy.int32).view(
+                numpy.uint32).reshape(-1, size_x)
     finally:
-        zip_file.close()
+        # later renders of the image use the level it had before
+        image._re.setResolutionLevel(previous_level)
+    rgb = numpy.dstack([(plane >> shift) & 0xFF for shift in (16, 8, 0)])
+    return Image.fromarray(rgb.astype(numpy.uint8), "RGB")
+
+
+def resize_plane(plane, width, height):
+    """
+    Resizes the rendered plane with LANCZOS. When shrinking by 2 or more,
+    the plane is first reduced by a whole factor with a box filter, so that
+    LANCZOS only works on a plane less than twice the final size.
+    """
+    start = time.time()
+    w, h = plane.size
+    resized = plane.resize((width, height), Image.LANCZOS, reducing_gap=2.0)
+    log("Resized %s x %s to %s x %s in %.3f secs"
+        % (w, h, width, height, time.time() - start))
+    return resized
 
 
 def save_plane(image, format, c_name, z_range, project_z, t=0, channel=None,
-               greyscale=False, zoom_percent=None, folder_name=None):
+               greyscale=False, zoom_percent=None, sink=None,
+               img_name=None, z_step=1, raw_store=None):
     """
-    Renders and saves an image to disk.
+    Renders an image and adds it to the zip file.
 
     :param image: The image to render
     :param format: The format to save as
     :param c_name: The name to use
     :param z_range: Tuple of (zIndex,) OR (zStart, zStop) for projection
+    :param project_z: Projection over the z_range: 'max', 'mean', 'sum'
+                      or None
     :param t: T index
     :param channel: Active channel index.
                     If None, use current rendering settings
     :param greyscale: If true, all visible channels will begreyscale
-    :param zoom_percent: Resize image by this percent if specified
-    :param folder_name: Indicate where to save the plane
+    :param zoom_percent: Resize image by this percent if specified. For
+                         'Big' images, a smaller resolution level of the
+                         pyramid is rendered
+    :param sink: The zip sink to add the plane to
+    :param img_name: Use this file name instead of making a new one
+    :param z_step: Only project every z_step plane of the z_range
+    :param raw_store: Raw Pixels Store for the image, used for projection
     """
 
     original_name = image.getName()
     log("")
     log("save_plane..")
     log("channel: %s" % c_name)
-    log("z: %s" % z_range)
+    log("z: %s" % (z_range,))
     log("t: %s" % t)
 
+    key = get_export_key(sink, image.getId(), channel, z_range, t)
+    if is_exported(sink, key):
+        return
+    if img_name is None:
+        img_name = make_image_name(original_name, c_name, z_range, t,
+                                   get_extension(format), sink["names"])
+
     # if channel == None: use current rendering settings
     if channel is not None:
         image.setActiveChannels([channel+1])    # use 1-based Channel indices
@@ -108,41 +733,76 @@ def save_plane(image, format, c_name, z_range, project_z, t=0, channel=None,
             image.setGreyscaleRenderingModel()
         else:
             image.setColorRenderingModel()
-    if project_z:
-        # imageWrapper only supports projection of full Z range (can't
-        # specify)
-        image.setProjection('intmax')
-
-    # All Z and T indices in this script are 1-based, but this method uses
-    # 0-based.
-    plane = image.renderImage(z_range[0]-1, t-1)
+    if project_z and len(z_range) > 1 and \
+            not is_local_projection(project_z, z_step):
+        image.setProjection('int%s' % project_z)
+        image.setProjectionRange(z_range[0]-1, z_range[1]-2)
+        try:
+            plane = image.renderImage(z_range[0]-1, t-1)
+        finally:
+            image.setProjection('normal')
+    elif project_z and len(z_range) > 1:
+        # the server can't skip planes, so we project the raw planes of
+        # the range ourselves
+        close_store = raw_store is None
+        if close_store:
+            raw_store = get_raw_pixels_store(image)
+        try:
+            plane = render_projection(image, raw_store, z_range, t,
+                                      project_z, z_step)
+        finally:
+            if close_store:
+                raw_store.close()
+    elif zoom_percent and get_zoom_level(image, zoom_percent):
+        # render the whole plane at a smaller resolution level
+        level, size_x, size_y = get_zoom_level(image, zoom_percent)
+        log("Resolution level: %s, %s x %s" % (level, size_x, size_y))
+        if format == "JPEG":
+            jpeg = image.renderJpegRegion(z_range[0]-1, t-1, 0, 0, size_x,
+                                          size_y, level=level)
+            plane = Image.open(BytesIO(jpeg))
+        else:
+            plane = render_level(image, z_range[0]-1, t-1, level, size_x,
+                                 size_y)
+    else:
+        # All Z and T indices in this script are 1-based, but this method
+        # uses 0-based.
+        plane = image.renderImage(z_range[0]-1, t-1)
     if zoom_percent:
-        w, h = plane.size
+        # zoom is relative to the full resolution, not the rendered level
         fraction = (float(zoom_percent) / 100)
-        plane = plane.resize((int(w * fraction), int(h * fraction)),
-                             Image.LANCZOS)
+        plane = resize_plane(plane, int(image.getSizeX() * fraction),
+                             int(image.getSizeY() * fraction))
 
+    log("Saving image: %s" % img_name)
+    data = BytesIO()
     if format == "PNG":
-        img_name = make_image_name(
-            original_name, c_name, z_range, t, "png", folder_name)
-        log("Saving image: %s" % img_name)
-        plane.save(img_name, "PNG")
+        plane.save(data, "PNG")
     elif format == 'TIFF':
-        img_name = make_image_name(
-            original_name, c_name, z_range, t, "tiff", folder_name)
-        log("Saving image: %s" % img_name)
-        plane.save(img_name, 'TIFF')
+        plane.save(data, 'TIFF')
     else:
-        img_name = make_image_name(
-            original_name, c_name, z_range, t, "jpg", folder_name)
-        log("Saving image: %s" % img_name)
-        plane.save(img_name)
+        plane.save(data, "JPEG")
+    # png and jpeg are already compressed. Don't compress again
+    add_to_zip(sink, img_name, data.getvalue(), compress=format == 'TIFF',
+               key=key)
+
+
+def get_extension(format):
+    """Returns the file extension for the rendered plane format."""
+    if format == "PNG":
+        return "png"
+    elif format == 'TIFF':
+        return "tiff"
+    return "jpg"
 
 
-def make_image_name(original_name, c_name, z_range, t, extension, folder_name):
+def make_image_name(original_name, c_name, z_range, t, extension, names):
     """
     Produces the name for the saved image.
     E.g. imported/myImage.dv -> myImage_DAPI_z13_t01.png
+
+    :param names: Set of names already in the export. The new name is
+                  added to it.
     """
     name = os.path.basename(original_name)
     # name = name.rsplit(".",1)[0]  # remove extension
@@ -151,45 +811,586 @@ def make_image_name(original_name, c_name, z_range, t, extension, folder_name):
     else:
         z = "%02d" % z_range[0]
     img_name = "%s_%s_z%s_t%02d.%s" % (name, c_name, z, t, extension)
-    if folder_name is not None:
-        img_name = os.path.join(folder_name, img_name)
-    # check we don't overwrite existing file
+    return make_unique_name(img_name, extension, names)
+
+
+def make_unique_name(img_name, extension, names):
+    """
+    Adds a number to the name if needed so we don't overwrite another file
+    in the export, then adds it to the set of names.
+    """
     i = 1
     name = img_name[:-(len(extension)+1)]
-    while os.path.exists(img_name):
+    while img_name in names:
         img_name = "%s_(%d).%s" % (name, i, extension)
         i += 1
+    names.add(img_name)
     return img_name
 
 
-def save_as_ome_tiff(conn, image, folder_name=None):
+def read_ome_tiff(conn, image, block_size):
     """
-    Saves the image as an ome.tif in the specified folder
+    Generates the OME-TIFF of the image in blocks read from the server.
+    The block size doubles, up to MAX_BLOCK_SIZE, after each read that
+    takes less than a second, so that fast connections make fewer round
+    trips.
+
+    :param block_size: Size of the first block (bytes)
     """
+    exporter = conn.createExporter()
+    try:
+        exporter.addImage(image.getId())
+        size = exporter.generateTiff(conn.SERVICE_OPTS)
+        pos = 0
+        while pos < size:
+            start = time.time()
+            block = exporter.read(pos, min(block_size, size - pos))
+            pos += len(block)
+            if time.time() - start < 1:
+                block_size = min(block_size * 2, MAX_BLOCK_SIZE)
+            yield block
+    finally:
+        exporter.close()
+
 
+def get_ome_tiff_name(image, sink):
+    """Returns the name of the ome.tif of the image in the zip."""
     extension = "ome.tif"
     name = os.path.basename(image.getName())
-    img_name = "%s.%s" % (name, extension)
-    if folder_name is not None:
-        img_name = os.path.join(folder_name, img_name)
-    # check we don't overwrite existing file
-    i = 1
-    path_name = img_name[:-(len(extension)+1)]
-    while os.path.exists(img_name):
-        img_name = "%s_(%d).%s" % (path_name, i, extension)
-        i += 1
+    return make_unique_name("%s.%s" % (name, extension), extension,
+                            sink["names"])
+
+
+def save_as_ome_tiff(conn, image, sink, block_size=65536, img_name=None,
+                     spool=False):
+    """
+    Saves the image as an ome.tif in the zip file
 
+    :param block_size: Size of the first block read from the server (bytes)
+    :param img_name: Use this file name instead of making a new one
+    :param spool: If True, the ome.tif is read into a temporary file before
+                  it is added to the zip, so other workers can write to the
+                  zip in the meantime
+    """
+
+    key = get_export_key(sink, image.getId(), "OME-TIFF", None, 0)
+    if is_exported(sink, key):
+        return
+    if img_name is None:
+        img_name = get_ome_tiff_name(image, sink)
     log("  Saving file as: %s" % img_name)
-    file_size, block_gen = image.exportOmeTiff(bufsize=65536)
-    with open(str(img_name), "wb") as f:
-        for piece in block_gen:
-            f.write(piece)
+    start = time.time()
+    file_size = 0
+    zip_info = get_zip_info(img_name, True)
+    if spool:
+        with tempfile.SpooledTemporaryFile(SPOOL_SIZE, dir=".") as tmp:
+            for block in read_ome_tiff(conn, image, block_size):
+                tmp.write(block)
+                file_size += len(block)
+            tmp.seek(0)
+            with sink["lock"]:
+                with sink["zip"].open(zip_info, 'w', force_zip64=True) as f:
+                    shutil.copyfileobj(tmp, f, 1024 * 1024)
+                record_export(sink, key, img_name, zip_info.CRC)
+    else:
+        with sink["lock"]:
+            with sink["zip"].open(zip_info, 'w', force_zip64=True) as f:
+                for block in read_ome_tiff(conn, image, block_size):
+                    f.write(block)
+                    file_size += len(block)
+            record_export(sink, key, img_name, zip_info.CRC)
+    secs = time.time() - start
+    megabytes = float(file_size) / (1024 * 1024)
+    log("  %s: %.1f MB in %.1f secs, %.1f MB/s"
+        % (img_name, megabytes, secs, megabytes / max(secs, 0.001)))
+
+
+def get_tiles(raw_store, pixels_type, size_x, size_y, size_z, size_c, size_t,
+              tile_w, tile_h):
+    """
+    Reads the tiles of every plane from the Raw Pixels Store, one at a time,
+    in the order they are written to the tiff: T, C, Z then row by row.
+    Tiles at the right and bottom edges are padded to the full tile size.
+    """
+    dtype = get_dtype(pixels_type)
+    for t in range(size_t):
+        for c in range(size_c):
+            for z in range(size_z):
+                for y in range(0, size_y, tile_h):
+                    for x in range(0, size_x, tile_w):
+                        w = min(tile_w, size_x - x)
+                        h = min(tile_h, size_y - y)
+                        tile = get_raw_tile(raw_store, pixels_type,
+                                            z, c, t, x, y, w, h)
+                        if w < tile_w or h < tile_h:
+                            tile = numpy.pad(
+                                tile, ((0, tile_h - h), (0, tile_w - w)))
+                        yield tile.astype(dtype.newbyteorder('='))
+
+
+def get_image_ids(conn, data_type, ids):
+    """
+    Returns the IDs of the images in the containers, in the order of the
+    container IDs. An image in 2 containers is listed twice.
+
+    :param data_type: 'Image' or 'Dataset'
+    :param ids: IDs of the containers
+    """
+    params = omero.sys.ParametersI()
+    params.add("ids", rlist([rlong(i) for i in ids]))
+    rows = conn.getQueryService().projection(
+        IMAGE_ID_QUERIES[data_type], params, conn.SERVICE_OPTS)
+    by_container = {}
+    for container_id, image_id in rows:
+        by_container.setdefault(container_id.val, []).append(image_id.val)
+    image_ids = []
+    for container_id in ids:
+        image_ids.extend(by_container.pop(container_id, []))
+    return image_ids
+
+
+def load_images(conn, data_type, ids, page_size=500):
+    """
+    Loads the images in the containers, page_size images per query, with
+    their pixels, pixels type and channels.
+
+    :param data_type: 'Image' or 'Dataset'
+    :param ids: IDs of the containers
+    :return: List of ImageWrappers, in the order of get_image_ids()
+    """
+    image_ids = get_image_ids(conn, data_type, ids)
+    return load_image_objects(conn, image_ids, page_size)
+
+
+def load_image_objects(conn, image_ids, page_size=500):
+    """
+    Loads the images, page_size per query, with their pixels, pixels type
+    and channels.
+
+    :return: List of ImageWrappers in the order of image_ids. Images that
+             are not found are left out.
+    """
+    unique_ids = list(dict.fromkeys(image_ids))
+    query_service = conn.getQueryService()
+    loaded = {}
+    for start in range(0, len(unique_ids), page_size):
+        params = omero.sys.ParametersI()
+        params.add("ids", rlist([rlong(i) for i in
+                                 unique_ids[start:start + page_size]]))
+        for obj in query_service.findAllByQuery(IMAGES_QUERY, params,
+                                                conn.SERVICE_OPTS):
+            loaded[obj.id.val] = obj
+    return [ImageWrapper(conn, loaded[i]) for i in image_ids if i in loaded]
+
+
+def get_channel_labels(image):
+    """
+    Returns the labels of the channels of the image, as
+    ImageWrapper.getChannelLabels() does but without a query if the image
+    is from load_images().
+    """
+    if image._obj.sizeOfPixels() < 1 or \
+            image._obj.getPrimaryPixels().sizeOfChannels() < 0:
+        # channels are not loaded
+        return image.getChannelLabels()
+    labels = []
+    channels = image._obj.getPrimaryPixels().copyChannels()
+    for idx, channel in enumerate(channels):
+        logical_channel = channel.getLogicalChannel()
+        name = unwrap(logical_channel.getName())
+        emission_wave = logical_channel.getEmissionWave()
+        if name is not None and len(name.strip()) > 0:
+            labels.append(name)
+        elif emission_wave is not None:
+            value = emission_wave.getValue()
+            # Don't show as double if it's really an int
+            if int(value) == value:
+                value = int(value)
+            labels.append(str(value))
+        else:
+            labels.append(str(idx))
+    return labels
+
+
+def save_as_tiled_ome_tiff(conn, image, sink):
+    """
+    Saves a 'Big' image as a tiled, pyramidal BigTIFF ome.tif in the zip
+    file. Tiles of each resolution level are streamed from one Raw Pixels
+    Store into the tiff, so only one tile is held in memory at a time.
+    """
+
+    key = get_export_key(sink, image.getId(), "OME-TIFF", None, 0)
+    if is_exported(sink, key):
+        return
+    img_name = get_ome_tiff_name(image, sink)
+    log("  Saving tiled file as: %s" % img_name)
+
+    pixels = image.getPrimaryPixels()
+    pixels_type = pixels.getPixelsType().getValue()
+    size_z = image.getSizeZ()
+    size_c = image.getSizeC()
+    size_t = image.getSizeT()
+    metadata = {'axes': 'TCZYX',
+                'Channel': {'Name': get_channel_labels(image)}}
+    if image.getPixelSizeX() is not None:
+        metadata['PhysicalSizeX'] = image.getPixelSizeX()
+    if image.getPixelSizeY() is not None:
+        metadata['PhysicalSizeY'] = image.getPixelSizeY()
+
+    raw_store = conn.c.sf.createRawPixelsStore()
+    fd, tiff_path = tempfile.mkstemp(suffix=".ome.tif", dir=".")
+    os.close(fd)
+    try:
+        raw_store.setPixelsId(pixels.getId(), True)
+        # tiff tiles must be a multiple of 16 pixels
+        tile_w, tile_h = [-(-size // 16) * 16
+                          for size in raw_store.getTileSize()]
+        dtype = get_dtype(pixels_type).newbyteorder('=')
+        # full resolution first
+        levels = raw_store.getResolutionDescriptions()
+        with tifffile.TiffWriter(tiff_path, bigtiff=True) as tif:
+            for i, level in enumerate(levels):
+                log("  Resolution level %s: %s x %s"
+                    % (i, level.sizeX, level.sizeY))
+                raw_store.setResolutionLevel(len(levels) - 1 - i)
+                tiles = get_tiles(raw_store, pixels_type, level.sizeX,
+                                  level.sizeY, size_z, size_c, size_t,
+                                  tile_w, tile_h)
+                options = {
+                    'shape': (size_t, size_c, size_z,
+                              level.sizeY, level.sizeX),
+                    'dtype': dtype,
+                    'tile': (tile_h, tile_w),
+                    # channels are separate planes, not RGB samples
+                    'photometric': 'minisblack',
+                    'compression': 'zlib'}
+                if i == 0:
+                    tif.write(tiles, subifds=len(levels) - 1,
+                              metadata=metadata, **options)
+                else:
+                    tif.write(tiles, subfiletype=1, metadata=None,
+                              **options)
+        # tiles are already compressed
+        with sink["lock"]:
+            sink["zip"].write(tiff_path, img_name, zipfile.ZIP_STORED)
+            record_export(sink, key, img_name,
+                          sink["zip"].getinfo(img_name).CRC)
+    finally:
+        raw_store.close()
+        os.remove(tiff_path)
+
+
+def create_render_pool(max_workers):
+    """
+    Creates a pool of workers to render and save planes concurrently.
+
+    Each worker loads its own ImageWrapper, and hence its own Rendering
+    Engine, from the same session. No more than 2 planes per worker are
+    queued at any time so that memory use stays flat.
+
+    :param max_workers: Number of planes rendered at the same time
+    :return: Dict of pool state, used by submit_plane()
+    """
+    contexts = queue.Queue()
+    for i in range(max_workers):
+        contexts.put({})
+    return {
+        "executor": ThreadPoolExecutor(max_workers=max_workers),
+        "pending": set(),
+        "max_pending": 2 * max_workers,
+        "contexts": contexts}
+
+
+def close_worker_image(context):
+    """Closes the Rendering Engine of the image loaded by a worker."""
+    image = context.get("image")
+    if image is not None and image._re is not None:
+        image._re.close()
+    if context.get("raw_store") is not None:
+        context["raw_store"].close()
+    context.clear()
+
+
+def save_plane_in_worker(conn, pool, image_id, format, c_name, z_range,
+                         project_z, t, channel, greyscale, zoom_percent, sink,
+                         img_name, z_step):
+    """
+    Renders and saves a plane with the ImageWrapper held by a free worker.
+
+    The worker keeps its image (and Rendering Engine) between planes, only
+    loading a new one when it moves to the next image.
+    """
+    context = pool["contexts"].get()
+    try:
+        image = context.get("image")
+        if image is None or image.getId() != image_id:
+            close_worker_image(context)
+            image = conn.getObject("Image", image_id)
+            # remember rendering settings for the 'merged' planes
+            context["active"] = [i + 1 for i, ch in
+                                 enumerate(image.getChannels())
+                                 if ch.isActive()]
+            context["greyscale"] = image.isGreyscaleRenderingModel()
+            context["image"] = image
+        elif channel is None:
+            # planes are not rendered in order - restore current settings
+            image.setActiveChannels(context["active"])
+            if context["greyscale"]:
+                image.setGreyscaleRenderingModel()
+            else:
+                image.setColorRenderingModel()
+        if is_local_projection(project_z, z_step) and \
+                context.get("raw_store") is None:
+            context["raw_store"] = get_raw_pixels_store(image)
+        save_plane(image, format, c_name, z_range, project_z, t, channel,
+                   greyscale, zoom_percent, sink, img_name, z_step,
+                   context.get("raw_store"))
+    finally:
+        pool["contexts"].put(context)
+
+
+def submit_job(pool, fn, *args):
+    """
+    Queues fn(*args) to be run by the pool, first waiting for a worker to
+    finish if too many jobs are already queued.
+    """
+    if len(pool["pending"]) >= pool["max_pending"]:
+        done, pool["pending"] = wait(pool["pending"],
+                                     return_when=FIRST_COMPLETED)
+        for future in done:
+            future.result()
+    future = pool["executor"].submit(fn, *args)
+    pool["pending"].add(future)
+
+
+def submit_plane(pool, *args):
+    """Queues a plane to be saved by save_plane_in_worker()."""
+    submit_job(pool, save_plane_in_worker, *args)
+
+
+def wait_for_jobs(pool):
+    """
+    Waits for all queued jobs to finish. Raises any exception from a
+    worker.
+    """
+    done, pool["pending"] = wait(pool["pending"])
+    for future in done:
+        future.result()
+
+
+def close_render_pool(pool):
+    """
+    Waits for all queued planes to be saved then closes the workers.
+    Raises any exception from a worker.
+    """
+    try:
+        wait_for_jobs(pool)
+    finally:
+        pool["executor"].shutdown()
+        while not pool["contexts"].empty():
+            close_worker_image(pool["contexts"].get())
+
+
+def get_worker_raw_store(context, image):
+    """
+    Returns the Raw Pixels Store held by a worker, opening a new one when
+    the worker moves to the next image.
+    """
+    pixels_id = image.getPrimaryPixels().getId()
+    if context.get("pixels_id") != pixels_id:
+        close_worker_image(context)
+        context["raw_store"] = get_raw_pixels_store(image)
+        context["pixels_id"] = pixels_id
+    return context["raw_store"]
+
+
+def write_zarr_plane(pool, image, arrays, z, c, t):
+    """
+    Reads a plane of a (non 'Big') image and writes it to each resolution
+    level of the zarr, down-sampling by picking every Nth pixel.
+    """
+    context = pool["contexts"].get()
+    try:
+        raw_store = get_worker_raw_store(context, image)
+        pixels = image.getPrimaryPixels()
+        plane = get_raw_plane(raw_store, pixels.getPixelsType().getValue(),
+                              pixels.getSizeX(), pixels.getSizeY(), z, c, t)
+        for level, array in enumerate(arrays):
+            step = 2 ** level
+            array[t, c, z] = plane[::step, ::step]
+    finally:
+        pool["contexts"].put(context)
+
+
+def write_zarr_tile(pool, image, array, level, z, c, t, x, y, w, h):
+    """
+    Reads a tile of a resolution level of a 'Big' image and writes it to
+    the zarr.
+
+    :param level: Resolution level, 0 is full resolution
+    """
+    context = pool["contexts"].get()
+    try:
+        raw_store = get_worker_raw_store(context, image)
+        if context.get("level") != level:
+            levels = raw_store.getResolutionLevels()
+            raw_store.setResolutionLevel(levels - 1 - level)
+            context["level"] = level
+        pixels_type = image.getPrimaryPixels().getPixelsType().getValue()
+        array[t, c, z, y:y + h, x:x + w] = get_raw_tile(
+            raw_store, pixels_type, z, c, t, x, y, w, h)
+    finally:
+        pool["contexts"].put(context)
+
+
+def get_ngff_metadata(image, levels):
+    """
+    Returns the OME-NGFF 'multiscales' and 'omero' metadata for the image.
+
+    :param levels: List of (size_x, size_y) for each resolution level
+    """
+    size_x = image.getSizeX()
+    size_y = image.getSizeY()
+    pixel_sizes = [image.getPixelSizeZ(), image.getPixelSizeY(),
+                   image.getPixelSizeX()]
+    axes = [{"name": "t", "type": "time"},
+            {"name": "c", "type": "channel"}]
+    for name, pixel_size in zip("zyx", pixel_sizes):
+        axis = {"name": name, "type": "space"}
+        if pixel_size is not None:
+            axis["unit"] = "micrometer"
+        axes.append(axis)
+    pixel_sizes = [1 if p is None else p for p in pixel_sizes]
+    datasets = []
+    for level, (level_x, level_y) in enumerate(levels):
+        scale = [1, 1, pixel_sizes[0],
+                 pixel_sizes[1] * size_y / level_y,
+                 pixel_sizes[2] * size_x / level_x]
+        datasets.append({
+            "path": str(level),
+            "coordinateTransformations": [{"type": "scale", "scale": scale}]})
+    multiscales = [{"version": "0.4", "name": image.getName(),
+                    "axes": axes, "datasets": datasets}]
+
+    channels = []
+    for ch in image.getChannels():
+        channels.append({
+            "label": ch.getLabel(),
+            "color": ch.getColor().getHtml(),
+            "active": ch.isActive(),
+            "window": {"start": ch.getWindowStart(),
+                       "end": ch.getWindowEnd(),
+                       "min": ch.getWindowMin(),
+                       "max": ch.getWindowMax()}})
+    omero_metadata = {
+        "id": image.getId(),
+        "channels": channels,
+        "rdefs": {"defaultZ": image.getDefaultZ(),
+                  "defaultT": image.getDefaultT(),
+                  "model": ("greyscale" if image.isGreyscaleRenderingModel()
+                            else "color")}}
+    return multiscales, omero_metadata
+
+
+def save_as_ome_zarr(conn, image, sink, pool=None):
+    """
+    Saves the raw pixels of the image as a multiscale OME-Zarr (OME-NGFF)
+    in the zip file. Planes (or tiles of 'Big' images) are read and written
+    as zarr chunks by the workers of the pool.
+
+    :param pool: Pool of workers, from create_render_pool(). If None, a
+                 pool with a single worker is used.
+    """
+
+    key = get_export_key(sink, image.getId(), "OME-Zarr", None, 0)
+    if is_exported(sink, key):
+        return
+    extension = "zarr"
+    name = os.path.basename(image.getName())
+    zarr_name = make_unique_name("%s.%s" % (name, extension), extension,
+                                 sink["names"])
+    # the attributes are the last file written
+    attrs_name = "%s/.zattrs" % zarr_name
+    log("  Saving file as: %s" % zarr_name)
+
+    size_x = image.getSizeX()
+    size_y = image.getSizeY()
+    size_z = image.getSizeZ()
+    size_c = image.getSizeC()
+    size_t = image.getSizeT()
+    pixels_type = image.getPrimaryPixels().getPixelsType().getValue()
+    dtype = get_dtype(pixels_type)
+
+    own_pool = pool is None
+    if own_pool:
+        pool = create_render_pool(1)
+    zarr_path = tempfile.mkdtemp(suffix=".%s" % extension, dir=".")
+    raw_store = get_raw_pixels_store(image)
+    try:
+        tile_w, tile_h = raw_store.getTileSize()
+        big_image = raw_store.requiresPixelsPyramid()
+        if big_image:
+            # use the resolution levels of the pyramid on the server
+            levels = [(r.sizeX, r.sizeY)
+                      for r in raw_store.getResolutionDescriptions()]
+        else:
+            levels = [(size_x, size_y)]
+            while max(levels[-1]) > 256:
+                level_x, level_y = levels[-1]
+                levels.append(((level_x + 1) // 2, (level_y + 1) // 2))
+
+        store = zarr.DirectoryStore(zarr_path, dimension_separator="/")
+        root = zarr.group(store=store, overwrite=True)
+        arrays = []
+        for level, (level_x, level_y) in enumerate(levels):
+            arrays.append(root.create_dataset(
+                str(level), shape=(size_t, size_c, size_z, level_y, level_x),
+                chunks=(1, 1, 1, min(tile_h, level_y), min(tile_w, level_x)),
+                dtype=dtype.newbyteorder('=')))
+
+        for t in range(size_t):
+            for c in range(size_c):
+                for z in range(size_z):
+                    if not big_image:
+                        submit_job(pool, write_zarr_plane, pool, image,
+                                   arrays, z, c, t)
+                        continue
+                    for level, (level_x, level_y) in enumerate(levels):
+                        for y in range(0, level_y, tile_h):
+                            for x in range(0, level_x, tile_w):
+                                w = min(tile_w, level_x - x)
+                                h = min(tile_h, level_y - y)
+                                submit_job(pool, write_zarr_tile, pool,
+                                           image, arrays[level], level,
+                                           z, c, t, x, y, w, h)
+        wait_for_jobs(pool)
+
+        multiscales, omero_metadata = get_ngff_metadata(image, levels)
+        root.attrs["multiscales"] = multiscales
+        root.attrs["omero"] = omero_metadata
+
+        # chunks are already compressed
+        with sink["lock"]:
+            for dir_path, dir_names, file_names in os.walk(zarr_path):
+                for file_name in file_names:
+                    path = os.path.join(dir_path, file_name)
+                    zip_name = os.path.join(
+                        zarr_name, os.path.relpath(path, zarr_path))
+                    sink["zip"].write(path, zip_name, zipfile.ZIP_STORED)
+            # all the files are written together, before any checkpoint
+            record_export(sink, key, attrs_name,
+                          sink["zip"].getinfo(attrs_name).CRC)
+    finally:
+        raw_store.close()
+        if own_pool:
+            close_render_pool(pool)
+        shutil.rmtree(zarr_path)
 
 
 def save_planes_for_image(conn, image, size_c, split_cs, merged_cs,
                           channel_names=None, z_range=None, t_range=None,
-                          greyscale=False, zoom_percent=None, project_z=False,
-                          format="PNG", folder_name=None):
+                          greyscale=False, zoom_percent=None, project_z=None,
+                          format="PNG", sink=None, pool=None, z_step=1):
     """
     Saves all the required planes for a single image, either as individual
     planes or projection.
@@ -201,7 +1402,10 @@ def save_planes_for_image(conn, image, size_c, split_cs, merged_cs,
     :param tRange: Tuple: (tStart, tStop). If None, use default Tindex
     :param greyscale: If true, all visible channels will be greyscale
     :param zoomPercent: Resize image by this percent if specified.
-    :param projectZ: If true, project over Z range.
+    :param projectZ: Projection over Z range: 'max', 'mean', 'sum' or None
+    :param sink: The zip sink to add the planes to
+    :param pool: If not None, planes are rendered by this render pool
+    :param z_step: Only project every z_step plane of the Z range
     """
 
     channels = []
@@ -231,33 +1435,55 @@ def save_planes_for_image(conn, image, size_c, split_cs, merged_cs,
         else:
             t_indexes = [t_range[0]]
 
-    c_name = 'merged'
-    for c in channels:
-        if c is not None:
-            g_scale = greyscale
-            if c < len(channel_names):
-                c_name = channel_names[c].replace(" ", "_")
-            else:
-                c_name = "c%02d" % c
-        else:
-            # if we're rendering 'merged' image - don't want grey!
-            g_scale = False
-        for t in t_indexes:
-            if z_range is None:
-                default_z = image.getDefaultZ()+1
-                save_plane(image, format, c_name, (default_z,), project_z, t,
-                           c, g_scale, zoom_percent, folder_name)
-            elif project_z:
-                save_plane(image, format, c_name, z_range, project_z, t, c,
-                           g_scale, zoom_percent, folder_name)
+    # the projected planes are all read with the same Raw Pixels Store
+    raw_store = None
+    if is_local_projection(project_z, z_step) and pool is None:
+        raw_store = get_raw_pixels_store(image)
+
+    def save(c_name, plane_z_range, t, c, g_scale):
+        if pool is None:
+            save_plane(image, format, c_name, plane_z_range, project_z, t, c,
+                       g_scale, zoom_percent, sink, z_step=z_step,
+                       raw_store=raw_store)
+            return
+        key = get_export_key(sink, image.getId(), c, plane_z_range, t)
+        if is_exported(sink, key):
+            return
+        # names are given out in order so that output is deterministic
+        img_name = make_image_name(
+            image.getName(), c_name, plane_z_range, t, get_extension(format),
+            sink["names"])
+        submit_plane(pool, conn, pool, image.getId(), format, c_name,
+                     plane_z_range, project_z, t, c, g_scale, zoom_percent,
+                     sink, img_name, z_step)
+
+    try:
+        c_name = 'merged'
+        for c in channels:
+            if c is not None:
+                g_scale = greyscale
+                if c < len(channel_names):
+                    c_name = channel_names[c].replace(" ", "_")
+                else:
+                    c_name = "c%02d" % c
             else:
-                if len(z_range) > 1:
-                    for z in range(z_range[0], z_range[1]):
-                        save_plane(image, format, c_name, (z,), project_z, t,
-                                   c, g_scale, zoom_percent, folder_name)
+                # if we're rendering 'merged' image - don't want grey!
+                g_scale = False
+            for t in t_indexes:
+                if z_range is None:
+                    default_z = image.getDefaultZ()+1
+                    save(c_name, (default_z,), t, c, g_scale)
+                elif project_z:
+                    save(c_name, z_range, t, c, g_scale)
                 else:
-                    save_plane(image, format, c_name, z_range, project_z, t,
-                               c, g_scale, zoom_percent, folder_name)
+                    if len(z_range) > 1:
+                        for z in range(z_range[0], z_range[1]):
+                            save(c_name, (z,), t, c, g_scale)
+                    else:
+                        save(c_name, z_range, t, c, g_scale)
+    finally:
+        if raw_store is not None:
+            raw_store.close()
 
 
 def batch_image_export(conn, script_params):
@@ -270,12 +1496,15 @@ def batch_image_export(conn, script_params):
     folder_name = script_params["Folder_Name"]
     folder_name = os.path.basename(folder_name)
     format = script_params["Format"]
-    project_z = "Choose_Z_Section" in script_params and \
-        script_params["Choose_Z_Section"] == 'Max projection'
+    project_z = PROJECTIONS.get(script_params.get("Choose_Z_Section"))
+    z_step = script_params.get("Projection_Step", 1)
 
     if (not split_cs) and (not merged_cs):
         log("Not chosen to save Individual Channels OR Merged Image")
         return None, "Not chosen to save Individual Channels OR Merged Image"
+    if format == 'OME-Zarr' and zarr is None:
+        log("  ** Can't export to OME-Zarr without zarr 2 installed. **")
+        return None, "Can't export to %s." % format
 
     # check if we have these params
     channel_names = []
@@ -284,6 +1513,9 @@ def batch_image_export(conn, script_params):
     zoom_percent = None
     if "Zoom" in script_params and script_params["Zoom"] != "100%":
         zoom_percent = int(script_params["Zoom"][:-1])
+    max_workers = script_params.get("Max_Workers", 1)
+    include_log = script_params.get("Include_Log", True)
+    block_size = script_params.get("Block_Size_KB", 1024) * 1024
 
     # functions used below for each imaage.
     def get_z_range(size_z, script_params):
@@ -310,6 +1542,9 @@ def batch_image_export(conn, script_params):
                     z_range = (z_start,)
                 else:
                     z_range = (z_start, z_end+1)
+            elif z_choice in PROJECTIONS:
+                # project all Z planes unless a range is chosen
+                z_range = (1, size_z+1)
         return z_range
 
     def get_t_range(size_t, script_params):
@@ -348,132 +1583,196 @@ def batch_image_export(conn, script_params):
     # Attach figure to the first image
     parent = objects[0]
 
-    if data_type == 'Dataset':
-        images = []
-        for ds in objects:
-            images.extend(list(ds.listChildren()))
-        if not images:
-            message += "No image found in dataset(s)"
-            return None, message
-    else:
-        images = objects
+    # images are loaded with their pixels and channels
+    images = load_images(conn, data_type, [obj.getId() for obj in objects])
+    if data_type == 'Dataset' and not images:
+        message += "No image found in dataset(s)"
+        return None, message
 
     log("Processing %s images" % len(images))
 
-    # somewhere to put images
+    # somewhere to put the log
     curr_dir = os.getcwd()
     exp_dir = os.path.join(curr_dir, folder_name)
     try:
         os.mkdir(exp_dir)
     except OSError:
         pass
-    # max size (default 12kx12k)
-    size = conn.getDownloadAsMaxSizeSetting()
-    size = int(size)
-
-    ids = []
-    # do the saving to disk
-
-    for img in images:
-        log("Processing image: ID %s: %s" % (img.id, img.getName()))
-        pixels = img.getPrimaryPixels()
-        if (pixels.getId() in ids):
-            continue
-        ids.append(pixels.getId())
-
-        if format == 'OME-TIFF':
-            if img._prepareRE().requiresPixelsPyramid():
-                log("  ** Can't export a 'Big' image to OME-TIFF. **")
-                if len(images) == 1:
-                    return None, "Can't export a 'Big' image to %s." % format
+    if include_log:
+        open_log_file(log_sink, os.path.join(exp_dir, LOG_NAME))
+    else:
+        disable_log(log_sink)
+    # exported files are added to the zip as soon as they are saved. The
+    # zip is checkpointed between images so a failed export can resume.
+    resume_dir = get_checkpoint_dir(conn, script_params)
+    remove_old_checkpoint_dirs(os.path.dirname(resume_dir))
+    checkpoint_dir, lock_file = lock_checkpoint_dir(resume_dir)
+    sink = None
+    pool = None
+    try:
+        sink = create_zip_sink(
+            os.path.join(checkpoint_dir, "%s.zip" % folder_name),
+            os.path.join(checkpoint_dir, "ledger.sqlite"))
+        # max size (default 12kx12k)
+        size = conn.getDownloadAsMaxSizeSetting()
+        size = int(size)
+
+        ids = []
+        # do the saving to disk
+
+        if max_workers > 1:
+            log("Rendering planes with %s workers" % max_workers)
+            pool = create_render_pool(max_workers)
+        for img in images:
+            log("Processing image: ID %s: %s" % (img.id, img.getName()))
+            pixels = img.getPrimaryPixels()
+            if (pixels.getId() in ids):
                 continue
+            ids.append(pixels.getId())
+
+            if format == 'OME-TIFF':
+                if img._prepareRE().requiresPixelsPyramid():
+                    if tifffile is None:
+                        log("  ** Can't export a 'Big' image to OME-TIFF"
+                            " without tifffile installed. **")
+                        if len(images) == 1:
+                            return None, ("Can't export a 'Big' image to %s."
+                                          % format)
+                        continue
+                    save_as_tiled_ome_tiff(conn, img, sink)
+                elif pool is None:
+                    save_as_ome_tiff(conn, img, sink, block_size)
+                elif not is_exported(sink, get_export_key(
+                        sink, img.getId(), "OME-TIFF", None, 0)):
+                    # names are given out in order so that output is
+                    # deterministic
+                    submit_job(pool, save_as_ome_tiff, conn, img, sink,
+                               block_size, get_ome_tiff_name(img, sink), True)
+            elif format == 'OME-Zarr':
+                try:
+                    save_as_ome_zarr(conn, img, sink, pool)
+                finally:
+                    if img._re is not None:
+                        img._re.close()
             else:
-                save_as_ome_tiff(conn, img, folder_name)
+                size_x = pixels.getSizeX()
+                size_y = pixels.getSizeY()
+                if zoom_percent and img._prepareRenderingEngine() and \
+                        get_zoom_level(img, zoom_percent):
+                    # 'Big' images are rendered from a smaller resolution level
+                    size_x = size_x * zoom_percent // 100
+                    size_y = size_y * zoom_percent // 100
+                if size_x*size_y > size:
+                    msg = "Can't export image over %s pixels. " \
+                          "See 'omero.client.download_as.max_size'" % size
+                    log("  ** %s. **" % msg)
+                    if len(images) == 1:
+                        return None, msg
+                    continue
+                else:
+                    log("Exporting image as %s: %s" % (format, img.getName()))
+
+                log("\n----------- Saving planes from image: '%s' ------------"
+                    % img.getName())
+                size_c = img.getSizeC()
+                size_z = img.getSizeZ()
+                size_t = img.getSizeT()
+                z_range = get_z_range(size_z, script_params)
+                t_range = get_t_range(size_t, script_params)
+                log("Using:")
+                if z_range is None:
+                    log("  Z-index: Last-viewed")
+                elif len(z_range) == 1:
+                    log("  Z-index: %d" % z_range[0])
+                else:
+                    log("  Z-range: %s-%s" % (z_range[0], z_range[1]-1))
+                if project_z:
+                    log("  Z-projection: %s, step: %s" % (project_z, z_step))
+                if t_range is None:
+                    log("  T-index: Last-viewed")
+                elif len(t_range) == 1:
+                    log("  T-index: %d" % t_range[0])
+                else:
+                    log("  T-range: %s-%s" % (t_range[0], t_range[1]-1))
+                log("  Format: %s" % format)
+                if zoom_percent is None:
+                    log("  Image Zoom: 100%")
+                else:
+                    log("  Image Zoom: %s" % zoom_percent)
+                log("  Greyscale: %s" % greyscale)
+                log("Channel Rendering Settings:")
+                for ch in img.getChannels():
+                    log("  %s: %d-%d" % (ch.getLabel(), ch.getWindowStart(),
+                                         ch.getWindowEnd()))
+                sink["rdefs"][img.getId()] = get_rdef_version(conn, img)
+                remove_stale_exports(sink, img.getId())
+
+                try:
+                    save_planes_for_image(
+                        conn, img, size_c, split_cs, merged_cs, channel_names,
+                        z_range, t_range, greyscale, zoom_percent,
+                        project_z=project_z, format=format, sink=sink,
+                        pool=pool, z_step=z_step)
+                finally:
+                    # Make sure we close Rendering Engine
+                    img._re.close()
+
+            flush_log(log_sink)
+            # files still being saved by the pool are added to the ledger at
+            # a later checkpoint
+            if time.time() - sink["checkpoint_time"] >= CHECKPOINT_INTERVAL:
+                checkpoint_zip_sink(sink)
+        if pool is not None:
+            close_render_pool(pool)
+            pool = None
+        close_log(log_sink)
+
+        if not sink["zip"].namelist():
+            return None, "No files exported. See 'info' for more details"
+        for name in os.listdir(exp_dir):
+            sink["zip"].write(os.path.join(exp_dir, name), name,
+                              zipfile.ZIP_DEFLATED)
+        sink["zip"].close()
+        sink["ledger"].close()
+        # use the zip (unless we've only got a single ome-tiff)
+        zip_names = sink["zip"].namelist()
+        if format == 'OME-TIFF' and len(zip_names) == 1:
+            ometiff_ids = [t.id for t in parent.listAnnotations(ns=NSOMETIFF)]
+            conn.deleteObjects("Annotation", ometiff_ids)
+            with zipfile.ZipFile(sink["target"]) as zip_file:
+                export_file = zip_file.extract(zip_names[0], folder_name)
+            namespace = NSOMETIFF
+            output_display_name = "OME-TIFF"
+            mimetype = 'image/tiff'
         else:
-            size_x = pixels.getSizeX()
-            size_y = pixels.getSizeY()
-            if size_x*size_y > size:
-                msg = "Can't export image over %s pixels. " \
-                      "See 'omero.client.download_as.max_size'" % size
-                log("  ** %s. **" % msg)
-                if len(images) == 1:
-                    return None, msg
-                continue
-            else:
-                log("Exporting image as %s: %s" % (format, img.getName()))
-
-            log("\n----------- Saving planes from image: '%s' ------------"
-                % img.getName())
-            size_c = img.getSizeC()
-            size_z = img.getSizeZ()
-            size_t = img.getSizeT()
-            z_range = get_z_range(size_z, script_params)
-            t_range = get_t_range(size_t, script_params)
-            log("Using:")
-            if z_range is None:
-                log("  Z-index: Last-viewed")
-            elif len(z_range) == 1:
-                log("  Z-index: %d" % z_range[0])
-            else:
-                log("  Z-range: %s-%s" % (z_range[0], z_range[1]-1))
-            if project_z:
-                log("  Z-projection: ON")
-            if t_range is None:
-                log("  T-index: Last-viewed")
-            elif len(t_range) == 1:
-                log("  T-index: %d" % t_range[0])
-            else:
-                log("  T-range: %s-%s" % (t_range[0], t_range[1]-1))
-            log("  Format: %s" % format)
-            if zoom_percent is None:
-                log("  Image Zoom: 100%")
-            else:
-                log("  Image Zoom: %s" % zoom_percent)
-            log("  Greyscale: %s" % greyscale)
-            log("Channel Rendering Settings:")
-            for ch in img.getChannels():
-                log("  %s: %d-%d"
-                    % (ch.getLabel(), ch.getWindowStart(), ch.getWindowEnd()))
-
-            try:
-                save_planes_for_image(conn, img, size_c, split_cs, merged_cs,
-                                      channel_names, z_range, t_range,
-                                      greyscale, zoom_percent,
-                                      project_z=project_z, format=format,
-                                      folder_name=folder_name)
-            finally:
-                # Make sure we close Rendering Engine
-                img._re.close()
-
-        # write log for exported images (not needed for ome-tiff)
-        name = 'Batch_Image_Export.txt'
-        with open(os.path.join(exp_dir, name), 'w') as log_file:
-            for s in log_strings:
-                log_file.write(s)
-                log_file.write("\n")
-
-    if len(os.listdir(exp_dir)) == 0:
-        return None, "No files exported. See 'info' for more details"
-    # zip everything up (unless we've only got a single ome-tiff)
-    if format == 'OME-TIFF' and len(os.listdir(exp_dir)) == 1:
-        ometiff_ids = [t.id for t in parent.listAnnotations(ns=NSOMETIFF)]
-        conn.deleteObjects("Annotation", ometiff_ids)
-        export_file = os.path.join(folder_name, os.listdir(exp_dir)[0])
-        namespace = NSOMETIFF
-        output_display_name = "OME-TIFF"
-        mimetype = 'image/tiff'
-    else:
-        export_file = "%s.zip" % folder_name
-        compress(export_file, folder_name)
-        mimetype = 'application/zip'
-        output_display_name = "Batch export zip"
-        namespace = NSCREATED + "/omero/export_scripts/Batch_Image_Export"
-
-    file_annotation, ann_message = script_utils.create_link_file_annotation(
-        conn, export_file, parent, output=output_display_name,
-        namespace=namespace, mimetype=mimetype)
-    message += ann_message
-    return file_annotation, message
+            export_file = sink["target"]
+            mimetype = 'application/zip'
+            output_display_name = "Batch export zip"
+            namespace = (NSCREATED +
+                         "/omero/export_scripts/Batch_Image_Export")
+
+        file_annotation, ann_message = \
+            script_utils.create_link_file_annotation(
+                conn, export_file, parent, output=output_display_name,
+                namespace=namespace, mimetype=mimetype,
+                orig_file_path_and_name=os.path.basename(export_file))
+        message += ann_message
+        # the export is complete, no need to resume it
+        shutil.rmtree(checkpoint_dir)
+        return file_annotation, message
+    finally:
+        # also after an early return or an error, the zip is left as it
+        # was at the last checkpoint, to resume from
+        if pool is not None:
+            close_render_pool(pool)
+        close_log(log_sink)
+        if sink is not None:
+            sink["zip"].close()
+            sink["ledger"].close()
+        lock_file.close()
+        # a new folder is not found by a rerun, to resume the export
+        if checkpoint_dir != resume_dir:
+            shutil.rmtree(checkpoint_dir, ignore_errors=True)
 
 
 def run_script():
@@ -484,12 +1783,13 @@ def run_script():
 
     data_types = [rstring('Dataset'), rstring('Image')]
     formats = [rstring('JPEG'), rstring('PNG'), rstring('TIFF'),
-               rstring('OME-TIFF')]
+               rstring('OME-TIFF'), rstring('OME-Zarr')]
     default_z_option = 'Default-Z (last-viewed)'
     z_choices = [rstring(default_z_option),
                  rstring('ALL Z planes'),
-                 # currently ImageWrapper only allows full Z-stack projection
                  rstring('Max projection'),
+                 rstring('Mean projection'),
+                 rstring('Sum projection'),
                  rstring('Other (see below)')]
     default_t_option = 'Default-T (last-viewed)'
     t_choices = [rstring(default_t_option),
@@ -500,8 +1800,10 @@ def run_script():
 
     client = scripts.client(
         'Batch_Image_Export.py',
-        """Save multiple images as JPEG, PNG, TIFF or OME-TIFF \
+        """Save multiple images as JPEG, PNG, TIFF, OME-TIFF or OME-Zarr \
         in a zip file available for download as a batch export. \
+If the export fails, running it again with the same parameters resumes it. \
+The files of a failed export are kept on the server for 7 days. \
 See http://help.openmicroscopy.org/export.html#batch""",
 
         scripts.String(
@@ -535,7 +1837,10 @@ See http://help.openmicroscopy.org/export.html#batch""",
         scripts.String(
             "Choose_Z_Section", grouping="5",
             description="Default Z is last viewed Z for each image, OR choose"
-            " Z below.", values=z_choices, default=default_z_option),
+            " Z below. Projections with a Projection_Step over 1 are"
+            " rendered by the script without lookup tables, reverse"
+            " intensity or non-linear rendering families",
+            values=z_choices, default=default_z_option),
 
         scripts.Int(
             "OR_specify_Z_index", grouping="5.1",
@@ -549,6 +1854,11 @@ See http://help.openmicroscopy.org/export.html#batch""",
             "...specify_Z_end", grouping="5.3",
             description="Choose a specific Z-index to export", min=1),
 
+        scripts.Int(
+            "Projection_Step", grouping="5.4",
+            description="For projections, use every Nth Z-index of the"
+            " range", default=1, min=1),
+
         scripts.String(
             "Choose_T_Section", grouping="6",
             description="Default T is last viewed T for each image, OR choose"
@@ -581,6 +1891,24 @@ See http://help.openmicroscopy.org/export.html#batch""",
             description="Name of folder (and zip file) to store images",
             default='Batch_Image_Export'),
 
+        scripts.Int(
+            "Max_Workers", grouping="10",
+            description="Number of planes to render (jpeg, png or tiff),"
+            " planes to read (OME-Zarr) or OME-TIFFs to export at the same"
+            " time",
+            default=1, min=1, max=16),
+
+        scripts.Int(
+            "Block_Size_KB", grouping="10.1",
+            description="Size of the first block of an OME-TIFF read from"
+            " the server (KB). Grows while reads are fast", default=1024,
+            min=64),
+
+        scripts.Bool(
+            "Include_Log", grouping="11",
+            description="Add a log of the export to the zip. A single"
+            " OME-TIFF without the log is attached as it is", default=True),
+
         version="4.3.0",
         authors=["William Moore", "OME Team"],
         institutions=["University of Dundee"],
@@ -24,16 +24,104 @@ This script exports ROI intensities for selected images.
 """
 
 
+import omero
+import omero.grid
 import omero.scripts as scripts
-from omero.gateway import BlitzGateway
-from omero.rtypes import rlong, rint, rstring, robject, unwrap
+from omero.api import ShapeStats
+from omero.constants.namespaces import NSBULKANNOTATIONS
+from omero.gateway import BlitzGateway, ImageWrapper
+from omero.rtypes import rlong, rint, rstring, robject, rlist, unwrap
 from omero.model import RectangleI, EllipseI, LineI, PolygonI, PolylineI, \
     MaskI, LabelI, PointI
 from math import sqrt, pi
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import csv
+import hashlib
+import io
+import json
 import re
 
+import numpy
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
 DEFAULT_FILE_NAME = "Batch_ROI_Export.csv"
+# Max number of shapes in each call to getShapeStatsRestricted()
+STATS_BATCH_SIZE = 500
 INSIGHT_POINT_LIST_RE = re.compile(r'points\[([^\]]+)\]')
+STATS_ENGINES = ["Server", "Local"]
+# Max number of pixels in a region of a plane read for the Local stats.
+# Bigger shapes are left to the server.
+MAX_REGION_SIZE = 2048 * 2048
+# Number of images to load the ROIs of at once
+ROI_PAGE_SIZE = 100
+OUTPUT_FORMATS = ["CSV", "OMERO.table", "Parquet"]
+# Rows of OMERO.table or Parquet output are written in chunks of this size
+CHUNK_ROWS = 10000
+# Max length of strings in an OMERO.table
+TABLE_STRING_SIZE = 256
+# Namespace of an incremental export, with the fingerprint of each image
+NS_INCREMENTAL = "openmicroscopy.org/omero/batch_roi_export/incremental"
+# Params that change the rows of an image, as well as its shapes
+FINGERPRINT_PARAMS = ["Channels", "Export_All_Planes", "Include_Points_Coords",
+                      "Include_Centroid_Perimeter", "Stats_Engine"]
+SHAPE_VERSIONS_QUERY = ("select roi.image.id, shape.id,"
+                        " shape.details.updateEvent.id"
+                        " from Shape shape join shape.roi roi"
+                        " where roi.image.id in (:ids)"
+                        " order by shape.id")
+ROIS_QUERY = ("select distinct roi from Roi roi"
+              " join fetch roi.shapes shape"
+              " left outer join fetch shape.transform"
+              " where roi.image.id in (:ids)")
+
+# IDs of images for each container
+IMAGE_ID_QUERIES = {
+    "Image": ("select image.id, image.id from Image image"
+              " where image.id in (:ids)"),
+    "Dataset": ("select link.parent.id, link.child.id"
+                " from DatasetImageLink link"
+                " where link.parent.id in (:ids)"
+                " order by link.child.id"),
+    "Project": ("select plink.parent.id, link.child.id"
+                " from ProjectDatasetLink plink, DatasetImageLink link"
+                " where link.parent.id = plink.child.id"
+                " and plink.parent.id in (:ids)"
+                " order by link.parent.id, link.child.id")}
+
+# Wells and images of each Plate or Screen
+WELL_QUERIES = {
+    "Plate": ("select plate.id, plate.id, plate.rowNamingConvention,"
+              " plate.columnNamingConvention, well.id, well.row,"
+              " well.column, ws.image.id"
+              " from WellSample ws join ws.well well join well.plate plate"
+              " where plate.id in (:ids)"
+              " order by well.row, well.column, ws.id"),
+    "Screen": ("select link.parent.id, plate.id, plate.rowNamingConvention,"
+               " plate.columnNamingConvention, well.id, well.row,"
+               " well.column, ws.image.id"
+               " from WellSample ws join ws.well well join well.plate plate"
+               " join plate.screenLinks link"
+               " where link.parent.id in (:ids)"
+               " order by plate.id, well.row, well.column, ws.id")}
+
+IMAGES_QUERY = ("select distinct image from Image image"
+                " join fetch image.pixels pixels"
+                " join fetch pixels.pixelsType"
+                " left outer join fetch pixels.channels channel"
+                " left outer join fetch channel.logicalChannel"
+                " where image.id in (:ids)")
+
+# big-endian numpy types of the raw pixels
+PIXEL_TYPES = {'int8': 'i1', 'uint8': 'u1',
+               'int16': '>i2', 'uint16': '>u2',
+               'int32': '>i4', 'uint32': '>u4',
+               'float': '>f4', 'double': '>f8'}
 
 
 def log(data):
@@ -41,8 +129,422 @@ def log(data):
     print(data)
 
 
-def get_export_data(conn, script_params, image, units=None):
-    """Get pixel data for shapes on image and returns list of dicts."""
+def get_shape_stats(roi_service, shape_planes, ch_indexes):
+    """
+    Gets the intensity stats of shapes on planes, with one call to
+    getShapeStatsRestricted() for all the shapes on each plane (up to
+    STATS_BATCH_SIZE shapes per call).
+
+    :param shape_planes: List of (shape_id, z, t). Z and T are only used
+                         by the server for shapes that don't have Z or T.
+    :return: Dict of {(shape_id, z, t): ShapeStats}
+    """
+    by_plane = {}
+    for shape_id, z, t in shape_planes:
+        by_plane.setdefault((z, t), []).append(shape_id)
+    stats = {}
+    for (z, t), shape_ids in by_plane.items():
+        for start in range(0, len(shape_ids), STATS_BATCH_SIZE):
+            batch = shape_ids[start:start + STATS_BATCH_SIZE]
+            results = roi_service.getShapeStatsRestricted(
+                batch, z, t, ch_indexes)
+            for shape_id, shape_stats in zip(batch, results):
+                stats[(shape_id, z, t)] = shape_stats
+    return stats
+
+
+def get_point_list(shape):
+    """Returns the points string of a Polygon or Polyline."""
+    point_list = shape.getPoints().getValue()
+    match = INSIGHT_POINT_LIST_RE.search(point_list)
+    if match is not None:
+        point_list = match.group(1)
+    return point_list
+
+
+def parse_points(shape):
+    """
+    Returns the points of a Polygon or Polyline as a numpy array of
+    [[x, y], ...], or None if they are not valid.
+    """
+    point_list = get_point_list(shape)
+    try:
+        coords = [[float(x.strip(", ")) for x in coord.split(",", 1)]
+                  for coord in point_list.strip(" ").split(" ")]
+        coords = numpy.array(coords, dtype=float)
+    except ValueError:
+        return None
+    if coords.ndim != 2 or coords.shape[1] != 2:
+        return None
+    return coords
+
+
+def get_line_points(coords):
+    """
+    Returns the pixels along the line segments between the coords, as a
+    numpy array of [[x, y], ...].
+    """
+    points = [numpy.floor(coords[-1:] + 0.5)]
+    for start, end in zip(coords[:-1], coords[1:]):
+        steps = int(numpy.ceil(numpy.abs(end - start).max())) + 1
+        fractions = numpy.linspace(0, 1, steps)[:, None]
+        points.append(numpy.floor(start + (end - start) * fractions + 0.5))
+    return numpy.unique(numpy.concatenate(points), axis=0).astype(int)
+
+
+def points_in_polygon(xs, ys, coords):
+    """
+    Returns a boolean array of the xs, ys points inside the polygon, using
+    the even-odd rule.
+    """
+    inside = numpy.zeros(xs.shape, dtype=bool)
+    for (x1, y1), (x2, y2) in zip(coords, numpy.roll(coords, -1, axis=0)):
+        if y1 == y2:
+            continue
+        crosses = (y1 > ys) != (y2 > ys)
+        x_cross = (x2 - x1) * (ys - y1) / (y2 - y1) + x1
+        inside ^= crosses & (xs < x_cross)
+    return inside
+
+
+def get_raw_tile(raw_store, pixels_type, z, c, t, x, y, w, h):
+    """
+    Reads a tile from the Raw Pixels Store as a 2D numpy array of h rows
+    and w columns, viewing the raw bytes without copying them.
+    """
+    tile = raw_store.getTile(z, c, t, x, y, w, h)
+    return numpy.frombuffer(tile, PIXEL_TYPES[pixels_type]).reshape(h, w)
+
+
+def get_shape_mask(shape, size_x, size_y, max_size=MAX_REGION_SIZE):
+    """
+    Returns (x, y, mask): a boolean mask of the pixels in the shape and the
+    position of its top-left corner on the plane. A pixel is in the shape
+    if its (x, y) point is inside, as for getShapeStatsRestricted().
+
+    Returns None if the shape is outside the plane, has a transform, is
+    not supported, e.g. a Label, or its bounding box on the plane is over
+    max_size pixels.
+    """
+    if shape.getTransform() is not None:
+        return None
+    if isinstance(shape, (LineI, PolylineI, PointI)):
+        if isinstance(shape, LineI):
+            coords = numpy.array([[shape.getX1().getValue(),
+                                   shape.getY1().getValue()],
+                                  [shape.getX2().getValue(),
+                                   shape.getY2().getValue()]])
+        elif isinstance(shape, PointI):
+            coords = numpy.array([[shape.getX().getValue(),
+                                   shape.getY().getValue()]])
+        else:
+            coords = parse_points(shape)
+            if coords is None:
+                return None
+        points = get_line_points(coords)
+        points = points[(points[:, 0] >= 0) & (points[:, 0] < size_x) &
+                        (points[:, 1] >= 0) & (points[:, 1] < size_y)]
+        if len(points) == 0:
+            return None
+        x, y = [int(v) for v in points.min(axis=0)]
+        width, height = [int(v) for v in points.max(axis=0) - (x, y) + 1]
+        if width * height > max_size:
+            return None
+        mask = numpy.zeros((height, width), dtype=bool)
+        mask[points[:, 1] - y, points[:, 0] - x] = True
+        return x, y, mask
+    if isinstance(shape, MaskI):
+        x = int(shape.getX().getValue())
+        y = int(shape.getY().getValue())
+        width = int(shape.getWidth().getValue())
+        height = int(shape.getHeight().getValue())
+        if width * height > max_size:
+            return None
+        bits = numpy.unpackbits(numpy.frombuffer(shape.getBytes(), 'u1'))
+        if bits.size < width * height:
+            return None
+        mask = bits[:width * height].reshape(height, width).astype(bool)
+        # crop to the plane
+        x0, y0 = max(x, 0), max(y, 0)
+        mask = mask[y0 - y:max(size_y - y, 0), x0 - x:max(size_x - x, 0)]
+        if not mask.any():
+            return None
+        return x0, y0, mask
+
+    if isinstance(shape, RectangleI):
+        x = shape.getX().getValue()
+        y = shape.getY().getValue()
+        width = shape.getWidth().getValue()
+        height = shape.getHeight().getValue()
+        bounds = (x, y, x + width, y + height)
+    elif isinstance(shape, EllipseI):
+        cx = shape.getX().getValue()
+        cy = shape.getY().getValue()
+        rx = shape.getRadiusX().getValue()
+        ry = shape.getRadiusY().getValue()
+        if rx <= 0 or ry <= 0:
+            return None
+        bounds = (cx - rx, cy - ry, cx + rx, cy + ry)
+    elif isinstance(shape, PolygonI):
+        coords = parse_points(shape)
+        if coords is None or len(coords) < 3:
+            return None
+        bounds = tuple(coords.min(axis=0)) + tuple(coords.max(axis=0))
+    else:
+        return None
+    # integer points within the bounds and the plane
+    x0 = max(int(numpy.ceil(bounds[0])), 0)
+    y0 = max(int(numpy.ceil(bounds[1])), 0)
+    x1 = min(int(numpy.floor(bounds[2])), size_x - 1)
+    y1 = min(int(numpy.floor(bounds[3])), size_y - 1)
+    if x1 < x0 or y1 < y0 or (x1 - x0 + 1) * (y1 - y0 + 1) > max_size:
+        return None
+    ys, xs = numpy.mgrid[y0:y1 + 1, x0:x1 + 1]
+    if isinstance(shape, RectangleI):
+        mask = (xs < x + width) & (ys < y + height)
+    elif isinstance(shape, EllipseI):
+        mask = ((xs - cx) / rx) ** 2 + ((ys - cy) / ry) ** 2 < 1
+    else:
+        mask = points_in_polygon(xs, ys, coords)
+    if not mask.any():
+        return None
+    return x0, y0, mask
+
+
+def get_plane_regions(masks, shape_ids, max_size=MAX_REGION_SIZE):
+    """
+    Groups the shapes on a plane into the regions read from the plane: one
+    region covering all the shapes, or one region per shape if that would
+    be over max_size pixels.
+
+    :param masks: Dict of {shape_id: (x, y, mask)} from get_shape_mask()
+    :return: List of ((x, y, width, height), shape_ids)
+    """
+    def get_bounds(ids):
+        x0 = min(masks[i][0] for i in ids)
+        y0 = min(masks[i][1] for i in ids)
+        x1 = max(masks[i][0] + masks[i][2].shape[1] for i in ids)
+        y1 = max(masks[i][1] + masks[i][2].shape[0] for i in ids)
+        return x0, y0, x1 - x0, y1 - y0
+
+    bounds = get_bounds(shape_ids)
+    if bounds[2] * bounds[3] <= max_size:
+        return [(bounds, shape_ids)]
+    return [(get_bounds([i]), [i]) for i in shape_ids]
+
+
+def get_local_shape_stats(conn, image, shapes, shape_planes, ch_indexes):
+    """
+    Calculates the intensity stats of shapes on planes from the raw pixels,
+    instead of on the server. Each plane is read once, only the region
+    covering all its shapes, unless that region is too big. Then each
+    shape is read on its own, see get_plane_regions().
+
+    :param shapes: Dict of {shape_id: shape}
+    :param shape_planes: List of (shape_id, z, t)
+    :return: Dict of {(shape_id, z, t): ShapeStats}. Shapes that are not
+             supported by get_shape_mask() are not included.
+    """
+    pixels_type = image.getPixelsType()
+    if pixels_type not in PIXEL_TYPES:
+        return {}
+    size_x = image.getSizeX()
+    size_y = image.getSizeY()
+    # masks don't change between planes
+    masks = {}
+    by_plane = {}
+    for shape_id, z, t in shape_planes:
+        if shape_id not in masks:
+            masks[shape_id] = get_shape_mask(shapes[shape_id], size_x, size_y)
+        if masks[shape_id] is not None:
+            by_plane.setdefault((z, t), []).append(shape_id)
+
+    stats = {}
+    raw_store = conn.c.sf.createRawPixelsStore()
+    try:
+        raw_store.setPixelsId(image.getPixelsId(), True)
+        for (z, t), shape_ids in by_plane.items():
+            values = {}
+            regions = get_plane_regions(masks, shape_ids)
+            for (x0, y0, w, h), region_ids in regions:
+                for ch_index in ch_indexes:
+                    tile = get_raw_tile(raw_store, pixels_type, z, ch_index,
+                                        t, x0, y0, w, h)
+                    for shape_id in region_ids:
+                        x, y, mask = masks[shape_id]
+                        region = tile[y - y0:y - y0 + mask.shape[0],
+                                      x - x0:x - x0 + mask.shape[1]]
+                        values.setdefault(shape_id, []).append(
+                            region[mask].astype(float))
+            for shape_id in shape_ids:
+                channel_values = values[shape_id]
+                stats[(shape_id, z, t)] = ShapeStats(
+                    shapeId=shape_id,
+                    channelIds=list(ch_indexes),
+                    pointsCount=[int(v.size) for v in channel_values],
+                    min=[float(v.min()) for v in channel_values],
+                    max=[float(v.max()) for v in channel_values],
+                    sum=[float(v.sum()) for v in channel_values],
+                    mean=[float(v.mean()) for v in channel_values],
+                    stdDev=[float(v.std()) for v in channel_values])
+    finally:
+        raw_store.close()
+    return stats
+
+
+def get_image_ids(conn, data_type, ids):
+    """
+    Returns the IDs of the images in the containers, in the order of the
+    container IDs. An image in 2 containers is listed twice.
+
+    :param data_type: 'Image', 'Dataset' or 'Project'
+    :param ids: IDs of the containers
+    """
+    params = omero.sys.ParametersI()
+    params.add("ids", rlist([rlong(i) for i in ids]))
+    rows = conn.getQueryService().projection(
+        IMAGE_ID_QUERIES[data_type], params, conn.SERVICE_OPTS)
+    by_container = {}
+    for container_id, image_id in rows:
+        by_container.setdefault(container_id.val, []).append(image_id.val)
+    image_ids = []
+    for container_id in ids:
+        image_ids.extend(by_container.pop(container_id, []))
+    return image_ids
+
+
+def load_images(conn, data_type, ids, page_size=500):
+    """
+    Loads the images in the containers, page_size images per query, with
+    their pixels, pixels type and channels.
+
+    :param data_type: 'Image', 'Dataset' or 'Project'
+    :param ids: IDs of the containers
+    :return: List of ImageWrappers, in the order of get_image_ids()
+    """
+    image_ids = get_image_ids(conn, data_type, ids)
+    return load_image_objects(conn, image_ids, page_size)
+
+
+def load_image_objects(conn, image_ids, page_size=500):
+    """
+    Loads the images, page_size per query, with their pixels, pixels type
+    and channels.
+
+    :return: List of ImageWrappers in the order of image_ids. Images that
+             are not found are left out.
+    """
+    unique_ids = list(dict.fromkeys(image_ids))
+    query_service = conn.getQueryService()
+    loaded = {}
+    for start in range(0, len(unique_ids), page_size):
+        params = omero.sys.ParametersI()
+        params.add("ids", rlist([rlong(i) for i in
+                                 unique_ids[start:start + page_size]]))
+        for obj in query_service.findAllByQuery(IMAGES_QUERY, params,
+                                                conn.SERVICE_OPTS):
+            loaded[obj.id.val] = obj
+    return [ImageWrapper(conn, loaded[i]) for i in image_ids if i in loaded]
+
+
+def get_grid_label(index, letters):
+    """
+    Returns the label of a 0-based row or column of a plate, as
+    WellWrapper.getWellPos() does. E.g. 0 -> 'A' if letters, else 1.
+    """
+    if not letters:
+        return index + 1
+    label = chr(ord('A') + index % 26)
+    index = index // 26
+    while index > 0:
+        index -= 1
+        label = chr(ord('A') + index % 26) + label
+        index = index // 26
+    return label
+
+
+def load_plate_images(conn, data_type, ids, page_size=500):
+    """
+    Loads the images in the wells of the Plates or Screens, as
+    load_images() does, and the wells they are in. All wells are found
+    with one query, rather than loading each well.
+
+    :param data_type: 'Plate' or 'Screen'
+    :param ids: IDs of the Plates or Screens
+    :return: Tuple of (images, wells) where wells is a dict of
+             {image_id: {'well_id', 'well_row', 'well_column',
+             'well_label'}}
+    """
+    params = omero.sys.ParametersI()
+    params.add("ids", rlist([rlong(i) for i in ids]))
+    query_service = conn.getQueryService()
+    rows = query_service.projection(WELL_QUERIES[data_type], params,
+                                    conn.SERVICE_OPTS)
+    by_container = {}
+    for row in rows:
+        by_container.setdefault(row[0].val, []).append(unwrap(row[1:]))
+    rows = []
+    for container_id in ids:
+        rows.extend(by_container.pop(container_id, []))
+
+    wells = {}
+    image_ids = []
+    for plate_id, row_naming, column_naming, well_id, row, column, \
+            image_id in rows:
+        # rows are letters and columns numbers, unless named otherwise
+        row_letters = (row_naming or "").lower() != "number"
+        column_letters = (column_naming or "").lower() == "letter"
+        wells[image_id] = {
+            "well_id": well_id,
+            "well_row": row,
+            "well_column": column,
+            "well_label": "%s%s" % (
+                get_grid_label(row, row_letters),
+                get_grid_label(column, column_letters))}
+        image_ids.append(image_id)
+    return load_image_objects(conn, image_ids, page_size), wells
+
+
+def get_channel_labels(image):
+    """
+    Returns the labels of the channels of the image, as
+    ImageWrapper.getChannelLabels() does but without a query if the image
+    is from load_images().
+    """
+    if image._obj.sizeOfPixels() < 1 or \
+            image._obj.getPrimaryPixels().sizeOfChannels() < 0:
+        # channels are not loaded
+        return image.getChannelLabels()
+    labels = []
+    channels = image._obj.getPrimaryPixels().copyChannels()
+    for idx, channel in enumerate(channels):
+        logical_channel = channel.getLogicalChannel()
+        name = unwrap(logical_channel.getName())
+        emission_wave = logical_channel.getEmissionWave()
+        if name is not None and len(name.strip()) > 0:
+            labels.append(name)
+        elif emission_wave is not None:
+            value = emission_wave.getValue()
+            # Don't show as double if it's really an int
+            if int(value) == value:
+                value = int(value)
+            labels.append(str(value))
+        else:
+            labels.append(str(idx))
+    return labels
+
+
+def get_export_data(conn, script_params, image, rois, units=None,
+                    well=None):
+    """
+    Get pixel data for shapes on image and returns a generator of the rows,
+    as dicts. The ROIs and stats are loaded here, but each row is only made
+    when it is written, so the rows of an image are not all held in memory.
+
+    :param rois: List of (roi, shapes) of the image, from load_rois()
+    :param well: For SPW data, dict of the Well info to add to each row,
+                 from load_plate_images()
+    """
     log("Image ID %s..." % image.id)
 
     # Get pixel size in SAME units for all images
@@ -68,34 +570,15 @@ def get_export_data(conn, script_params, image, units=None):
             # User input is 1-based
             ch_indexes.append(ch - 1)
 
-    ch_names = image.getChannelLabels()
-
-    ch_names = [ch_name.replace(",", ".") for ch_name in ch_names]
-    image_name = image.getName().replace(",", ".")
-
-    result = roi_service.findByImage(image.getId(), None)
-
-    rois = result.rois
-    # Sort by ROI.id (same as in iviewer)
-    rois.sort(key=lambda r: r.id.val)
-    export_data = []
-
-    well_id = None
-    # For SPW data, add Well info...
-    if image._obj.wellSamplesLoaded:
-        for well_sample in image.copyWellSamples():
-            well_id = well_sample.getWell().id.val
-            well = conn.getObject("Well", well_id)
-            well_row = well.getRow()
-            well_column = well.getColumn()
-            well_label = well.getWellPos()
-
-    for roi in rois:
-        for shape in roi.copyShapes():
-            label = unwrap(shape.getTextValue())
-            # wrap label in double quotes in case it contains comma
-            label = "" if label is None else '"%s"' % label.replace(",", ".")
-            shape_type = shape.__class__.__name__.rstrip('I').lower()
+    ch_names = get_channel_labels(image)
+
+    image_name = image.getName()
+
+    # planes of each shape, so we can get the stats of all shapes together
+    shapes = []
+    shape_planes = []
+    for roi, roi_shapes in rois:
+        for shape in roi_shapes:
             # If shape has no Z or T, we may go through all planes...
             the_z = unwrap(shape.theZ)
             z_indexes = [the_z]
@@ -106,45 +589,68 @@ def get_export_data(conn, script_params, image, units=None):
             t_indexes = [the_t]
             if the_t is None and all_planes:
                 t_indexes = range(image.getSizeT())
+            shapes.append((roi, shape, z_indexes, t_indexes))
+            shape_planes.extend((shape.id.val, z, t)
+                                for z in z_indexes for t in t_indexes
+                                if z is not None and t is not None)
+
+    all_stats = {}
+    if ch_indexes:
+        if script_params.get("Stats_Engine") == "Local":
+            shapes_by_id = dict((s[1].id.val, s[1]) for s in shapes)
+            all_stats = get_local_shape_stats(conn, image, shapes_by_id,
+                                              shape_planes, ch_indexes)
+            # the server does the shapes we can't
+            shape_planes = [p for p in shape_planes if p not in all_stats]
+        all_stats.update(
+            get_shape_stats(roi_service, shape_planes, ch_indexes))
+
+    # geometry of each shape, for all its rows
+    shapes = [(roi, shape, z_indexes, t_indexes,
+               get_shape_geometry(shape, pixel_size_x, pixel_size_y,
+                                  include_points))
+              for roi, shape, z_indexes, t_indexes in shapes]
+    return get_export_rows(image.getId(), image_name, shapes, all_stats,
+                           ch_indexes, ch_names, well)
+
 
-            # get pixel intensities
-            for z in z_indexes:
-                for t in t_indexes:
-                    if z is None or t is None:
-                        stats = None
-                    else:
-                        stats = roi_service.getShapeStatsRestricted(
-                            [shape.id.val], z, t, ch_indexes)
-                    for c, ch_index in enumerate(ch_indexes):
-                        row_data = {
-                            "image_id": image.getId(),
-                            "image_name": '"%s"' % image_name,
-                            "roi_id": roi.id.val,
-                            "shape_id": shape.id.val,
-                            "type": shape_type,
-                            "text": label,
-                            "z": z + 1 if z is not None else "",
-                            "t": t + 1 if t is not None else "",
-                            "channel": ch_names[ch_index],
-                            "points": stats[0].pointsCount[c] if stats else "",
-                            "min": stats[0].min[c] if stats else "",
-                            "max": stats[0].max[c] if stats else "",
-                            "sum": stats[0].sum[c] if stats else "",
-                            "mean": stats[0].mean[c] if stats else "",
-                            "std_dev": stats[0].stdDev[c] if stats else ""
-                        }
-                        # For SPW data, add Well info...
-                        if well_id is not None:
-                            row_data['well_id'] = well_id
-                            row_data['well_row'] = well_row
-                            row_data['well_column'] = well_column
-                            row_data['well_label'] = well_label
-                        add_shape_coords(shape, row_data,
-                                         pixel_size_x, pixel_size_y,
-                                         include_points)
-                        export_data.append(row_data)
-
-    return export_data
+def get_export_rows(image_id, image_name, shapes, all_stats, ch_indexes,
+                    ch_names, well=None):
+    """Generates the rows of each shape, on each plane and channel."""
+    for roi, shape, z_indexes, t_indexes, geometry in shapes:
+        label = unwrap(shape.getTextValue())
+        shape_type = shape.__class__.__name__.rstrip('I').lower()
+
+        # get pixel intensities
+        for z in z_indexes:
+            for t in t_indexes:
+                stats = None
+                if (shape.id.val, z, t) in all_stats:
+                    stats = [all_stats[(shape.id.val, z, t)]]
+                for c, ch_index in enumerate(ch_indexes):
+                    # missing values are None, left empty in the output
+                    row_data = {
+                        "image_id": image_id,
+                        "image_name": image_name,
+                        "roi_id": roi.id.val,
+                        "shape_id": shape.id.val,
+                        "type": shape_type,
+                        "text": label,
+                        "z": z + 1 if z is not None else None,
+                        "t": t + 1 if t is not None else None,
+                        "channel": ch_names[ch_index],
+                        "points": stats[0].pointsCount[c] if stats else None,
+                        "min": stats[0].min[c] if stats else None,
+                        "max": stats[0].max[c] if stats else None,
+                        "sum": stats[0].sum[c] if stats else None,
+                        "mean": stats[0].mean[c] if stats else None,
+                        "std_dev": stats[0].stdDev[c] if stats else None
+                    }
+                    # For SPW data, add Well info...
+                    if well is not None:
+                        row_data.update(well)
+                    row_data.update(geometry)
+                    yield row_data
 
 
 # well_id, well_row, well_column, well_label inserted if SPW
@@ -177,91 +683,420 @@ COLUMN_NAMES = ["image_id",
                 "X2",
                 "Y2"]
 
+# Type of each column for OMERO.table or Parquet output. Others are double
+LONG_COLUMNS = ["image_id", "well_id", "well_row", "well_column", "roi_id",
+                "shape_id", "z", "t", "points"]
+STRING_COLUMNS = ["image_name", "well_label", "type", "text", "channel",
+                  "Points"]
+
+
+def scale_coords(coords, pixel_size_x, pixel_size_y):
+    """Returns the coords in the units of the pixel sizes, if known."""
+    if pixel_size_x is None or pixel_size_y is None:
+        return coords
+    return coords * (pixel_size_x, pixel_size_y)
+
+
+def get_path_length(coords, closed=False):
+    """Returns the total length of the line segments between the coords."""
+    if closed:
+        coords = numpy.vstack([coords, coords[:1]])
+    return float(numpy.hypot(*numpy.diff(coords, axis=0).T).sum())
 
-def add_shape_coords(shape, row_data, pixel_size_x, pixel_size_y,
-                     include_points=True):
-    """Add shape coordinates and length or area to the row_data dict."""
-    if shape.getTextValue():
-        row_data['Text'] = shape.getTextValue().getValue()
+
+def get_polygon_centroid(coords):
+    """Returns the centroid of the polygon area, as (x, y)."""
+    x, y = coords.T
+    next_x, next_y = numpy.roll(x, -1), numpy.roll(y, -1)
+    cross = x * next_y - next_x * y
+    # https://www.mathopenref.com/coordpolygonarea.html
+    area = 0.5 * cross.sum()
+    if area == 0:
+        return tuple(float(v) for v in coords.mean(axis=0))
+    return (float(((x + next_x) * cross).sum() / (6 * area)),
+            float(((y + next_y) * cross).sum() / (6 * area)))
+
+
+def get_shape_geometry(shape, pixel_size_x, pixel_size_y,
+                       include_points=True):
+    """
+    Returns a dict of the shape coordinates, length or area, perimeter and
+    centroid, for the columns of the shape's rows. Calculated once for each
+    shape, since it is the same on every plane and channel.
+    """
+    geometry = {}
     if isinstance(shape, (RectangleI, EllipseI, PointI, LabelI, MaskI)):
-        row_data['X'] = shape.getX().getValue()
-        row_data['Y'] = shape.getY().getValue()
+        geometry['X'] = shape.getX().getValue()
+        geometry['Y'] = shape.getY().getValue()
+        geometry['centroid_x'] = geometry['X']
+        geometry['centroid_y'] = geometry['Y']
     if isinstance(shape, (RectangleI, MaskI)):
-        row_data['Width'] = shape.getWidth().getValue()
-        row_data['Height'] = shape.getHeight().getValue()
-        row_data['area'] = row_data['Width'] * row_data['Height']
+        geometry['Width'] = shape.getWidth().getValue()
+        geometry['Height'] = shape.getHeight().getValue()
+        geometry['area'] = geometry['Width'] * geometry['Height']
+        corners = numpy.array([[0, 0], [geometry['Width'], 0],
+                               [geometry['Width'], geometry['Height']],
+                               [0, geometry['Height']]])
+        geometry['perimeter'] = get_path_length(
+            scale_coords(corners, pixel_size_x, pixel_size_y), closed=True)
+        geometry['centroid_x'] = geometry['X'] + geometry['Width'] / 2.0
+        geometry['centroid_y'] = geometry['Y'] + geometry['Height'] / 2.0
     if isinstance(shape, EllipseI):
-        row_data['RadiusX'] = shape.getRadiusX().getValue()
-        row_data['RadiusY'] = shape.getRadiusY().getValue()
-        row_data['area'] = pi * row_data['RadiusX'] * row_data['RadiusY']
+        geometry['RadiusX'] = shape.getRadiusX().getValue()
+        geometry['RadiusY'] = shape.getRadiusY().getValue()
+        geometry['area'] = pi * geometry['RadiusX'] * geometry['RadiusY']
+        a, b = scale_coords(numpy.array([geometry['RadiusX'],
+                                         geometry['RadiusY']]),
+                            pixel_size_x, pixel_size_y)
+        # Ramanujan's approximation
+        geometry['perimeter'] = float(
+            pi * (3 * (a + b) - sqrt((3 * a + b) * (a + 3 * b))))
     if isinstance(shape, LineI):
-        row_data['X1'] = shape.getX1().getValue()
-        row_data['X2'] = shape.getX2().getValue()
-        row_data['Y1'] = shape.getY1().getValue()
-        row_data['Y2'] = shape.getY2().getValue()
-        dx = (row_data['X1'] - row_data['X2'])
-        dx = dx if pixel_size_x is None else dx * pixel_size_x
-        dy = (row_data['Y1'] - row_data['Y2'])
-        dy = dy if pixel_size_y is None else dy * pixel_size_y
-        row_data['length'] = sqrt((dx * dx) + (dy * dy))
+        geometry['X1'] = shape.getX1().getValue()
+        geometry['X2'] = shape.getX2().getValue()
+        geometry['Y1'] = shape.getY1().getValue()
+        geometry['Y2'] = shape.getY2().getValue()
+        coords = numpy.array([[geometry['X1'], geometry['Y1']],
+                              [geometry['X2'], geometry['Y2']]])
+        geometry['length'] = get_path_length(
+            scale_coords(coords, pixel_size_x, pixel_size_y))
+        geometry['centroid_x'] = (geometry['X1'] + geometry['X2']) / 2.0
+        geometry['centroid_y'] = (geometry['Y1'] + geometry['Y2']) / 2.0
     if isinstance(shape, (PolygonI, PolylineI)):
-        point_list = shape.getPoints().getValue()
-        match = INSIGHT_POINT_LIST_RE.search(point_list)
-        if match is not None:
-            point_list = match.group(1)
         if include_points:
-            row_data['Points'] = '"%s"' % point_list
-    if isinstance(shape, PolylineI):
-        coords = point_list.strip(" ").split(" ")
-        try:
-            coords = [[float(x.strip(", ")) for x in coord.split(",", 1)]
-                      for coord in coords]
-        except ValueError:
-            log("Invalid Polyline coords: %s" % coords)
-        else:
-            lengths = []
-            for i in range(len(coords)-1):
-                dx = (coords[i][0] - coords[i + 1][0])
-                dy = (coords[i][1] - coords[i + 1][1])
-                dx = dx if pixel_size_x is None else dx * pixel_size_x
-                dy = dy if pixel_size_y is None else dy * pixel_size_y
-                lengths.append(sqrt((dx * dx) + (dy * dy)))
-            row_data['length'] = sum(lengths)
-    if isinstance(shape, PolygonI):
-        # https://www.mathopenref.com/coordpolygonarea.html
-        coords = point_list.strip(" ").split(" ")
-        try:
-            coords = [[float(x.strip(", ")) for x in coord.split(",", 1)]
-                      for coord in coords]
-        except ValueError:
-            log("Invalid Polygon coords: %s" % coords)
+            geometry['Points'] = get_point_list(shape)
+        coords = parse_points(shape)
+        if coords is None:
+            log("Invalid %s coords: %s" % (
+                shape.__class__.__name__.rstrip('I'), get_point_list(shape)))
+        elif isinstance(shape, PolylineI):
+            geometry['length'] = get_path_length(
+                scale_coords(coords, pixel_size_x, pixel_size_y))
+            # middle of the line, by length
+            lengths = numpy.hypot(*numpy.diff(coords, axis=0).T)
+            midpoints = (coords[:-1] + coords[1:]) / 2.0
+            if lengths.sum() > 0:
+                centroid = (midpoints * lengths[:, None]).sum(axis=0) \
+                    / lengths.sum()
+            else:
+                centroid = coords.mean(axis=0)
+            geometry['centroid_x'] = float(centroid[0])
+            geometry['centroid_y'] = float(centroid[1])
         else:
-            total = 0
-            for c in range(len(coords)):
-                coord = coords[c]
-                next_c = coords[(c + 1) % len(coords)]
-                total += (coord[0] * next_c[1]) - (next_c[0] * coord[1])
-            row_data['area'] = abs(0.5 * total)
-    if 'area' in row_data and pixel_size_x and pixel_size_y:
-        row_data['area'] = row_data['area'] * pixel_size_x * pixel_size_y
+            x, y = coords.T
+            total = (x * numpy.roll(y, -1) - numpy.roll(x, -1) * y).sum()
+            geometry['area'] = abs(0.5 * float(total))
+            geometry['perimeter'] = get_path_length(
+                scale_coords(coords, pixel_size_x, pixel_size_y),
+                closed=True)
+            (geometry['centroid_x'],
+             geometry['centroid_y']) = get_polygon_centroid(coords)
+    if 'area' in geometry and pixel_size_x and pixel_size_y:
+        geometry['area'] = geometry['area'] * pixel_size_x * pixel_size_y
+    return geometry
 
 
-def get_file_name(script_params):
+def get_file_name(script_params, extension="csv"):
     file_name = script_params.get("File_Name", "")
     if len(file_name) == 0:
         file_name = DEFAULT_FILE_NAME
-    if not file_name.endswith(".csv"):
-        file_name += ".csv"
-    return file_name
+    if file_name.endswith(".csv"):
+        file_name = file_name[:-len(".csv")]
+    return "%s.%s" % (file_name, extension)
 
 
-def get_csv_header(units_symbol):
-    csv_header = ",".join(COLUMN_NAMES)
+def get_column_titles(units_symbol):
+    """Returns the COLUMN_NAMES, with units for the lengths and areas."""
     if units_symbol is None:
         units_symbol = "pixels"
-    csv_header = csv_header.replace(",length,", ",length (%s)," % units_symbol)
-    csv_header = csv_header.replace(",area,", ",area (%s)," % units_symbol)
-    return csv_header
+    titles = []
+    for name in COLUMN_NAMES:
+        if name in ("length", "area", "perimeter"):
+            name = "%s (%s)" % (name, units_symbol)
+        titles.append(name)
+    return titles
+
+
+def get_csv_header(units_symbol):
+    return ",".join(get_column_titles(units_symbol))
+
+
+def create_column_writer(conn, output_format, file_name, units_symbol):
+    """
+    Creates a writer of the rows to an OMERO.table or Parquet file. Rows
+    are held as typed columns until CHUNK_ROWS are ready to write.
+
+    :return: Dict of writer state, used by write_rows()
+    """
+    titles = get_column_titles(units_symbol)
+    writer = {
+        "format": output_format,
+        "names": list(COLUMN_NAMES),
+        "columns": dict((name, []) for name in COLUMN_NAMES),
+        "row_count": 0}
+    if output_format == "Parquet":
+        types = []
+        for name, title in zip(COLUMN_NAMES, titles):
+            if name in LONG_COLUMNS:
+                types.append((title, pyarrow.int64()))
+            elif name in STRING_COLUMNS:
+                types.append((title, pyarrow.string()))
+            else:
+                types.append((title, pyarrow.float64()))
+        writer["schema"] = pyarrow.schema(types)
+        writer["file"] = pyarrow.parquet.ParquetWriter(file_name,
+                                                       writer["schema"])
+        return writer
+
+    # OMERO.table columns can't be empty, so missing values are -1 for
+    # longs, NaN for doubles or ""
+    table_columns = []
+    for name, title in zip(COLUMN_NAMES, titles):
+        if name in LONG_COLUMNS:
+            table_columns.append(omero.grid.LongColumn(title, "", []))
+        elif name in STRING_COLUMNS:
+            table_columns.append(omero.grid.StringColumn(
+                title, "", TABLE_STRING_SIZE, []))
+        else:
+            table_columns.append(omero.grid.DoubleColumn(title, "", []))
+    resources = conn.c.sf.sharedResources()
+    repository_id = resources.repositories().descriptions[0].getId().getValue()
+    table = resources.newTable(repository_id, file_name, conn.SERVICE_OPTS)
+    table.initialize(table_columns)
+    writer["table"] = table
+    writer["table_columns"] = table_columns
+    return writer
+
+
+def write_rows(writer, rows):
+    """Adds the rows to the columns, writing them if a chunk is ready."""
+    for row in rows:
+        for name in writer["names"]:
+            writer["columns"][name].append(row.get(name))
+        writer["row_count"] += 1
+        if len(writer["columns"][writer["names"][0]]) >= CHUNK_ROWS:
+            flush_columns(writer)
+
+
+def flush_columns(writer):
+    """Writes the rows held in the columns."""
+    columns = writer["columns"]
+    if not columns[writer["names"][0]]:
+        return
+    if writer["format"] == "Parquet":
+        arrays = [pyarrow.array(columns[name], type=field.type)
+                  for name, field in zip(writer["names"], writer["schema"])]
+        writer["file"].write_table(
+            pyarrow.Table.from_arrays(arrays, schema=writer["schema"]))
+    else:
+        for name, column in zip(writer["names"], writer["table_columns"]):
+            if name in LONG_COLUMNS:
+                column.values = [-1 if v is None else v
+                                 for v in columns[name]]
+            elif name in STRING_COLUMNS:
+                column.values = ["" if v is None else
+                                 v[:TABLE_STRING_SIZE]
+                                 for v in columns[name]]
+            else:
+                column.values = [float("nan") if v is None else float(v)
+                                 for v in columns[name]]
+        writer["table"].addData(writer["table_columns"])
+    for name in writer["names"]:
+        columns[name] = []
+
+
+def close_column_writer(conn, writer):
+    """
+    Writes any rows left and closes the writer.
+
+    :return: The FileAnnotationWrapper of an OMERO.table, or None
+    """
+    flush_columns(writer)
+    if writer["format"] == "Parquet":
+        writer["file"].close()
+        return None
+    table = writer["table"]
+    try:
+        orig_file = table.getOriginalFile()
+    finally:
+        table.close()
+    file_ann = omero.model.FileAnnotationI()
+    file_ann.setNs(rstring(NSBULKANNOTATIONS))
+    file_ann.setFile(omero.model.OriginalFileI(orig_file.id.val, False))
+    file_ann = conn.getUpdateService().saveAndReturnObject(
+        file_ann, conn.SERVICE_OPTS)
+    return conn.getObject("FileAnnotation", file_ann.id.val)
+
+
+def load_rois(conn, image_ids, shape_types=None, page_size=500):
+    """
+    Loads the ROIs of the images, for page_size images per query.
+
+    :param image_ids: IDs of the images
+    :param shape_types: E.g. ["Rectangle"] or ["Line", "Polyline"] to only
+                        keep these shapes. ROIs without any are left out.
+    :return: Dict of {image_id: [(roi, shapes)]} for every image, with the
+             ROIs in order of ID and the shapes as from roi.copyShapes()
+    """
+    shape_classes = None
+    if shape_types is not None:
+        shape_classes = tuple(getattr(omero.model, "%sI" % shape_type)
+                              for shape_type in shape_types)
+    unique_ids = list(dict.fromkeys(image_ids))
+    rois_by_image = dict((image_id, []) for image_id in unique_ids)
+    query_service = conn.getQueryService()
+    for start in range(0, len(unique_ids), page_size):
+        params = omero.sys.ParametersI()
+        params.add("ids", rlist([rlong(i) for i in
+                                 unique_ids[start:start + page_size]]))
+        rois = query_service.findAllByQuery(ROIS_QUERY, params,
+                                            conn.SERVICE_OPTS)
+        for roi in rois:
+            # shapes can be None in some situations
+            shapes = [shape for shape in roi.copyShapes()
+                      if shape is not None]
+            if shape_classes is not None:
+                shapes = [shape for shape in shapes
+                          if isinstance(shape, shape_classes)]
+                if not shapes:
+                    continue
+            rois_by_image[roi.getImage().getId().getValue()].append(
+                (roi, shapes))
+    for rois in rois_by_image.values():
+        # Sort by ROI.id (same as in iviewer)
+        rois.sort(key=lambda r: r[0].getId().getValue())
+    return rois_by_image
+
+
+def get_images_with_rois(conn, images):
+    """
+    Generates (image, rois) for each image, loading the ROIs of
+    ROI_PAGE_SIZE images at a time.
+    """
+    for start in range(0, len(images), ROI_PAGE_SIZE):
+        page = images[start:start + ROI_PAGE_SIZE]
+        rois_by_image = load_rois(conn, [image.getId() for image in page])
+        for image in page:
+            yield image, rois_by_image.get(image.getId(), [])
+
+
+def get_export_data_for_images(conn, script_params, images, units=None,
+                               wells=None):
+    """
+    Generates the rows of each image, in the order of the images, as soon
+    as the image and those before it are done. Up to Max_Workers images
+    are processed at the same time and no more than 2 per worker are held
+    in memory, as their ROIs and stats.
+
+    :param wells: For SPW data, dict of {image_id: Well info}
+    """
+    if wells is None:
+        wells = {}
+    max_workers = script_params.get("Max_Workers", 1)
+    if max_workers == 1:
+        for image, rois in get_images_with_rois(conn, images):
+            yield get_export_data(conn, script_params, image, rois, units,
+                                  wells.get(image.getId()))
+        return
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = deque()
+        for image, rois in get_images_with_rois(conn, images):
+            pending.append(executor.submit(get_export_data, conn,
+                                           script_params, image, rois,
+                                           units, wells.get(image.getId())))
+            if len(pending) >= 2 * max_workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def get_image_fingerprints(conn, script_params, images, page_size=500):
+    """
+    Returns a fingerprint of the shapes of each image, from the shape IDs
+    and the update event of each shape, of the params that change its rows
+    and of the name, channel labels and pixel size in its rows. It changes
+    when a shape or ROI of the image is added, edited or deleted.
+
+    :return: Dict of {image_id: fingerprint}
+    """
+    options = [script_params.get(name) for name in FINGERPRINT_PARAMS]
+    versions = dict((image.getId(), []) for image in images)
+    image_ids = list(versions)
+    query_service = conn.getQueryService()
+    for start in range(0, len(image_ids), page_size):
+        params = omero.sys.ParametersI()
+        params.add("ids", rlist([rlong(i) for i in
+                                 image_ids[start:start + page_size]]))
+        for image_id, shape_id, event_id in query_service.projection(
+                SHAPE_VERSIONS_QUERY, params, conn.SERVICE_OPTS):
+            versions[image_id.val].append((shape_id.val, event_id.val))
+    fingerprints = {}
+    for image in images:
+        text = json.dumps([options, image.getName(), get_channel_labels(image),
+                           image.getPixelSizeX(), image.getPixelSizeY(),
+                           versions[image.getId()]])
+        fingerprints[image.getId()] = hashlib.sha1(text.encode()).hexdigest()
+    return fingerprints
+
+
+def get_previous_export(conn, parent, file_name, csv_header):
+    """
+    Finds the last incremental export with the same file name and columns,
+    linked to the parent object.
+
+    :return: Tuple of (fingerprints, rows) where rows is a dict of
+             {image_id: [csv cells]}, or None
+    """
+    previous = None
+    for ann in parent.listAnnotations(ns=NS_INCREMENTAL):
+        if not isinstance(ann._obj, omero.model.FileAnnotationI) or \
+                ann.getFile().getName() != file_name:
+            continue
+        if previous is None or ann.getId() > previous.getId():
+            previous = ann
+    if previous is None:
+        return None
+    try:
+        export = json.loads(previous.getDescription())
+    except (TypeError, ValueError):
+        log("Can't read the fingerprints of the previous export")
+        return None
+    if export.get("header") != csv_header:
+        log("Columns have changed since the previous export")
+        return None
+    text = b"".join(previous.getFileInChunks()).decode("utf-8")
+    rows = {}
+    stale = set()
+    last_id = None
+    try:
+        reader = csv.reader(io.StringIO(text, newline=""))
+        # skip the header. Each row starts with the image ID
+        next(reader, None)
+        for cells in reader:
+            try:
+                image_id = int(cells[0])
+            except (IndexError, ValueError):
+                image_id = None
+            if image_id is not None and image_id != last_id:
+                # rows of an image in 2 containers are only kept once
+                repeated = image_id in rows
+                last_id = image_id
+            if image_id is None or len(cells) != len(COLUMN_NAMES):
+                # the image of a row we can't read is exported again
+                stale.add(last_id)
+            elif not repeated:
+                rows.setdefault(image_id, []).append(cells)
+        fingerprints = dict((int(image_id), fingerprint)
+                            for image_id, fingerprint
+                            in export["fingerprints"].items())
+    except (csv.Error, AttributeError, KeyError, ValueError):
+        log("Can't read the rows of the previous export")
+        return None
+    for image_id in stale:
+        fingerprints.pop(image_id, None)
+        rows.pop(image_id, None)
+    log("Found previous export: %s" % previous.getId())
+    return fingerprints, rows
 
 
 def link_annotation(objects, file_ann):
@@ -271,17 +1106,15 @@ def link_annotation(objects, file_ann):
             o.linkAnnotation(file_ann)
 
 
-def get_images_from_plate(plate):
-    imgs = []
-    for well in plate.listChildren():
-        for ws in well.listChildren():
-            imgs.append(ws.image())
-    return imgs
-
-
 def batch_roi_export(conn, script_params):
     """Main entry point. Get images, process them and return result."""
     images = []
+    wells = None
+
+    output_format = script_params.get("Output_Format", "CSV")
+    if output_format == "Parquet" and pyarrow is None:
+        log("Can't export to Parquet without pyarrow installed")
+        return None, "Can't export to %s" % output_format
 
     dtype = script_params['Data_Type']
     ids = script_params['IDs']
@@ -290,24 +1123,18 @@ def batch_roi_export(conn, script_params):
         COLUMN_NAMES.insert(2, "well_row")
         COLUMN_NAMES.insert(3, "well_column")
         COLUMN_NAMES.insert(4, "well_label")
+    if script_params.get("Include_Centroid_Perimeter", False):
+        COLUMN_NAMES.insert(COLUMN_NAMES.index("length") + 1, "perimeter")
+        COLUMN_NAMES.append("centroid_x")
+        COLUMN_NAMES.append("centroid_y")
     if script_params.get("Include_Points_Coords", False):
         COLUMN_NAMES.append("Points")
-    if dtype == "Image":
-        images = list(conn.getObjects("Image", ids))
-    elif dtype == "Dataset":
-        for dataset in conn.getObjects("Dataset", ids):
-            images.extend(list(dataset.listChildren()))
-    elif dtype == "Project":
-        for project in conn.getObjects("Project", ids):
-            for dataset in project.listChildren():
-                images.extend(list(dataset.listChildren()))
-    elif dtype == "Plate":
-        for plate in conn.getObjects("Plate", ids):
-            images.extend(get_images_from_plate(plate))
-    elif dtype == "Screen":
-        for screen in conn.getObjects("Screen", ids):
-            for plate in screen.listChildren():
-                images.extend(get_images_from_plate(plate))
+    if dtype in ("Image", "Dataset", "Project"):
+        # images are loaded with their pixels and channels
+        images = load_images(conn, dtype, ids)
+    elif dtype in ("Plate", "Screen"):
+        # images and their wells are loaded together
+        images, wells = load_plate_images(conn, dtype, ids)
 
     log("Processing %s images..." % len(images))
     if len(images) == 0:
@@ -323,20 +1150,70 @@ def batch_roi_export(conn, script_params):
     units = None if any_none else pixel_size_x.getUnit()
     units_symbol = None if any_none else pixel_size_x.getSymbol()
 
-    # Create a file so we can write direct to open file
-    file_name = get_file_name(script_params)
-    csv_header = get_csv_header(units_symbol)
+    if output_format == "CSV":
+        # Create a file so we can write direct to open file
+        file_name = get_file_name(script_params)
+        csv_header = get_csv_header(units_symbol)
+
+        # Images with the same shapes as the previous export keep their rows
+        incremental = script_params.get("Incremental", False)
+        previous_rows = {}
+        if incremental:
+            fingerprints = get_image_fingerprints(conn, script_params, images)
+            parent = images[0] if dtype == "Image" else \
+                conn.getObject(dtype, ids[0])
+            previous = get_previous_export(conn, parent, file_name,
+                                           csv_header)
+            if previous is not None:
+                previous_fingerprints, rows = previous
+                for image_id, fingerprint in fingerprints.items():
+                    if previous_fingerprints.get(image_id) == fingerprint:
+                        previous_rows[image_id] = rows.get(image_id, [])
+            log("Exporting %s images that have changed" % (
+                len(images) - len(previous_rows)))
+        changed = [image for image in images
+                   if image.getId() not in previous_rows]
+        export_data_for_images = get_export_data_for_images(
+            conn, script_params, changed, units, wells)
 
-    row_count = 0
-    with open(file_name, 'w') as csv_file:
-        csv_file.write(csv_header)
-        for image in images:
-            for row in get_export_data(conn, script_params, image, units):
-                cells = [str(row.get(name, "")) for name in COLUMN_NAMES]
-                csv_file.write("\n" + ",".join(cells))
-                row_count += 1
+        row_count = 0
+        with open(file_name, 'w', encoding="utf-8", newline="") as csv_file:
+            writer = csv.writer(csv_file, lineterminator="\n")
+            writer.writerow(get_column_titles(units_symbol))
+            for image in images:
+                if image.getId() in previous_rows:
+                    for cells in previous_rows[image.getId()]:
+                        writer.writerow(cells)
+                        row_count += 1
+                    continue
+                for row in next(export_data_for_images):
+                    writer.writerow([row.get(name) for name in COLUMN_NAMES])
+                    row_count += 1
 
-    file_ann = conn.createFileAnnfromLocalFile(file_name, mimetype="text/csv")
+        if incremental:
+            desc = json.dumps({"header": csv_header,
+                               "fingerprints": fingerprints})
+            file_ann = conn.createFileAnnfromLocalFile(
+                file_name, mimetype="text/csv", ns=NS_INCREMENTAL, desc=desc)
+        else:
+            file_ann = conn.createFileAnnfromLocalFile(file_name,
+                                                       mimetype="text/csv")
+    else:
+        if output_format == "OMERO.table" and "Points" in COLUMN_NAMES:
+            log("Points are not included in an OMERO.table")
+            COLUMN_NAMES.remove("Points")
+        file_name = get_file_name(script_params, "parquet"
+                                  if output_format == "Parquet" else "h5")
+        writer = create_column_writer(conn, output_format, file_name,
+                                      units_symbol)
+        for export_data in get_export_data_for_images(
+                conn, script_params, images, units, wells):
+            write_rows(writer, export_data)
+        row_count = writer["row_count"]
+        file_ann = close_column_writer(conn, writer)
+        if file_ann is None:
+            file_ann = conn.createFileAnnfromLocalFile(
+                file_name, mimetype="application/vnd.apache.parquet")
 
     if dtype == "Image":
         link_annotation(images, file_ann)
@@ -354,7 +1231,8 @@ def run_script():
 
     client = scripts.client(
         'Batch_ROI_Export.py',
-        """Export ROI intensities for selected Images as a CSV file.""",
+        """Export ROI intensities for selected Images as a CSV file,
+OMERO.table or Parquet file.""",
 
         scripts.String(
             "Data_Type", optional=False, grouping="1",
@@ -384,10 +1262,41 @@ def run_script():
                          "numbers of ROIs"),
             default=True),
 
+        scripts.Bool(
+            "Include_Centroid_Perimeter", grouping="5.1",
+            description=("Export the centroid and perimeter of each "
+                         "shape"),
+            default=False),
+
         scripts.String(
             "File_Name", grouping="6", default=DEFAULT_FILE_NAME,
             description="Name of the exported CSV file"),
 
+        scripts.Int(
+            "Max_Workers", grouping="7",
+            description="Number of images to process at the same time",
+            default=1, min=1, max=16),
+
+        scripts.String(
+            "Stats_Engine", grouping="8", values=[
+                rstring(e) for e in STATS_ENGINES],
+            description="Calculate the intensity stats on the server, or"
+            " in the script from the raw pixels of each plane (shapes with"
+            " a transform are still done on the server)", default="Server"),
+
+        scripts.String(
+            "Output_Format", grouping="9", values=[
+                rstring(f) for f in OUTPUT_FORMATS],
+            description="Save a CSV file, an OMERO.table (without the"
+            " Points) or a Parquet file, with typed columns",
+            default="CSV"),
+
+        scripts.Bool(
+            "Incremental", grouping="10", default=False,
+            description="Only export the images whose ROIs have changed"
+            " since the last incremental export with this File_Name,"
+            " keeping the rows of the others. CSV only."),
+
         authors=["William Moore", "OME Team"],
         institutions=["University of Dundee"],
         contact="ome-users@lists.openmicroscopy.org.uk",
@@ -37,20 +37,25 @@ import omero.util.figureUtil as figureUtil
 import omero
 import omero.min  # Constants etc.
 import os
+import shutil
+import subprocess
 import sys
 import re
+import tempfile
+import time
 import numpy
-import omero.util.pixelstypetopython as pixelstypetopython
-from struct import unpack
-from omero.rtypes import wrap, rstring, rint, rlong, robject
+from collections import deque
+from itertools import groupby
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue
+from omero.rtypes import wrap, rstring, rint, rlong, robject, unwrap
 from omero.gateway import BlitzGateway
 from omero.constants.namespaces import NSCREATED
 from omero.constants.metadata import NSMOVIE
 
 from io import BytesIO
-from types import StringTypes
 
-from PIL import Image, ImageDraw
+from PIL import Image, ImageDraw, ImageFont
 
 COLOURS = script_utils.COLOURS
 COLOURS.update(script_utils.EXTRA_COLOURS)    # name:(rgba) map
@@ -58,45 +63,51 @@ COLOURS.update(script_utils.EXTRA_COLOURS)    # name:(rgba) map
 MPEG = 'MPEG'
 QT = 'Quicktime'
 WMV = 'WMV'
+H264 = 'H.264'
+VP9 = 'VP9'
+AV1 = 'AV1'
+MJPEG = 'MJPEG'
 MOVIE_NS = NSMOVIE
-format_ns_map = {MPEG: MOVIE_NS, QT: MOVIE_NS, WMV: MOVIE_NS}
-format_extension_map = {MPEG: "avi", QT: "avi", WMV: "avi"}
-format_map = {MPEG: "avi", QT: "avi", WMV: "avi"}
+format_ns_map = {MPEG: MOVIE_NS, QT: MOVIE_NS, WMV: MOVIE_NS,
+                 H264: MOVIE_NS, VP9: MOVIE_NS, AV1: MOVIE_NS,
+                 MJPEG: MOVIE_NS}
+format_extension_map = {MPEG: "avi", QT: "avi", WMV: "avi", H264: "mp4",
+                        VP9: "webm", AV1: "mp4", MJPEG: "avi"}
+format_map = {MPEG: "avi", QT: "avi", WMV: "avi", H264: "mp4",
+              VP9: "webm", AV1: "mp4", MJPEG: "avi"}
 format_mimetypes = {
     MPEG: "video/mpeg",
     QT: "video/quicktime",
-    WMV: "video/x-ms-wmv"}
+    WMV: "video/x-ms-wmv",
+    H264: "video/mp4",
+    VP9: "video/webm",
+    AV1: "video/mp4",
+    MJPEG: "video/x-msvideo"}
+# ffmpeg encoders of each format, in order of preference
+format_codecs = {
+    MPEG: ["mpeg4"],
+    QT: ["mjpeg"],
+    WMV: ["wmv2"],
+    H264: ["libx264", "libopenh264"],
+    VP9: ["libvpx-vp9"],
+    AV1: ["libsvtav1", "libaom-av1", "librav1e"],
+    MJPEG: ["mjpeg"]}
+# mencoder codecs, if ffmpeg is not installed
+mencoder_codecs = {
+    MPEG: "mpeg4",
+    QT: "mjpeg:vbitrate=800",
+    WMV: "wmv2",
+    MJPEG: "mjpeg"}
+# quality of the frames of MJPEG movies, which are encoded by PIL
+MJPEG_QUALITY = 90
 OVERLAYCOLOUR = "#666666"
 
 
-log_lines = []    # make a log / legend of the figure
-
-
 def log(text):
     """
-    Adds lines of text to the log_lines list, so they can be collected into a
-    figure legend.
+    Prints lines of text to the log of the movie, the stdout of the script.
     """
-    log_lines.append(text)
-
-
-def download_plane(gateway, pixels, pixels_id, x, y, z, c, t):
-    """ Retrieves the selected plane """
-    raw_plane = gateway.get_plane(pixels_id, z, c, t)
-    convert_type = '>' + str(x*y) + pixelstypetopython.toPython(
-        pixels.getPixelsType().getValue())
-    converted_plane = unpack(convert_type, raw_plane)
-    remapped_plane = numpy.array(
-        converted_plane, dtype=(pixels.getPixelsType().getValue()))
-    remapped_plane.resize(x, y)
-    return remapped_plane
-
-
-def upload_plane(gateway, new_pixels_id, x, y, z, c, t, new_plane):
-    """Uploads the specified plane. """
-    byte_swapped_plane = new_plane.byteswap()
-    converted_plane = byte_swapped_plane.tostring()
-    gateway.upload_plane(new_pixels_id, z, c, t, converted_plane)
+    print(text)
 
 
 def mac_osx():
@@ -107,63 +118,219 @@ def mac_osx():
         return 0
 
 
-def build_avi(size_x, size_y, filelist, fps, movie_name, format):
-    """ Encodes. """
-    program = 'mencoder'
-    args = ""
-    if (format == WMV):
-        args = ' mf://'+filelist + ' -mf w=' + str(size_x) + ':h=' + \
-            str(size_y) + ':fps=' + str(fps) + \
-            ':type=jpg -ovc lavc -lavcopts vcodec=wmv2 -o %s' % movie_name
-    elif (format == QT):
-        args = ' mf://'+filelist + ' -mf w=' + str(size_x) + ':h=' + \
-            str(size_y) + ':fps='+str(fps) + \
-            ':type=png -ovc lavc -lavcopts vcodec=mjpeg:vbitrate=800  -o %s' \
-            % movie_name
-    else:
-        args = ' mf://'+filelist + ' -mf w=' + str(size_x) + ':h=' + \
-            str(size_y) + ':fps=' + str(fps) + \
-            ':type=jpg -ovc lavc -lavcopts vcodec=mpeg4 -o %s' % movie_name
-    log(args)
-    os.system(program + args)
+def get_ffmpeg_encoders():
+    """ Returns the names of the video encoders of ffmpeg. """
+    output = subprocess.run(
+        ["ffmpeg", "-hide_banner", "-encoders"], stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL, universal_newlines=True).stdout
+    encoders = set()
+    for line in output.splitlines():
+        # e.g. " V....D libx264   libx264 H.264 / AVC ..."
+        fields = line.split()
+        if len(fields) > 1 and fields[0].startswith("V"):
+            encoders.add(fields[1])
+    return encoders
+
+
+def get_encoder_command(size_x, size_y, fps, format):
+    """
+    Returns the command to encode raw RGB frames from stdin, with ffmpeg or
+    else mencoder. If the format can't be encoded, MJPEG is used instead.
+    MJPEG frames are encoded as JPEGs before they are piped to ffmpeg,
+    which copies them into the movie. Other formats are piped as raw
+    frames at a constant rate, which can't carry the duration of a frame.
+
+    :return: Tuple of (command, format, output, frame format) where frame
+             format is 'rgb24' or 'mjpeg', or None if neither is installed
+    """
+    if shutil.which("ffmpeg"):
+        encoders = get_ffmpeg_encoders()
+        codecs = [c for c in format_codecs[format] if c in encoders]
+        if not codecs:
+            log("No ffmpeg encoder for %s, using %s" % (format, MJPEG))
+            format = MJPEG
+            codecs = format_codecs[MJPEG]
+        codec = codecs[0]
+        output = "localfile.%s" % format_map[format]
+        if codec == "mjpeg":
+            command = [
+                "ffmpeg", "-y", "-loglevel", "error",
+                "-f", "jpeg_pipe", "-framerate", str(fps), "-i", "-",
+                "-c:v", "copy", output]
+            return command, format, output, "mjpeg"
+        command = [
+            "ffmpeg", "-y", "-loglevel", "error",
+            "-f", "rawvideo", "-pix_fmt", "rgb24",
+            "-video_size", "%sx%s" % (size_x, size_y),
+            "-framerate", str(fps), "-i", "-",
+            # most codecs need an even width and height
+            "-vf", "pad=ceil(iw/2)*2:ceil(ih/2)*2",
+            "-c:v", codec,
+            "-pix_fmt", "yuv420p", output]
+        return command, format, output, "rgb24"
+    if shutil.which("mencoder"):
+        if format not in mencoder_codecs:
+            log("mencoder can't encode %s, using %s" % (format, MJPEG))
+            format = MJPEG
+        output = "localfile.%s" % format_map[format]
+        command = [
+            "mencoder", "-", "-demuxer", "rawvideo",
+            "-rawvideo", "w=%s:h=%s:fps=%s:format=rgb24" % (
+                size_x, size_y, fps),
+            "-ovc", "lavc", "-lavcopts", "vcodec=%s" % mencoder_codecs[format],
+            "-o", output]
+        return command, format, output, "rgb24"
+    return None
+
+
+def create_encoder(size_x, size_y, fps, format):
+    """
+    Starts the encoder, which frames are piped to as they are made, with no
+    files for each frame.
+
+    :return: Dict of encoder state, used by write_frame(), or None if no
+             encoder is installed
+    """
+    command = get_encoder_command(size_x, size_y, fps, format)
+    if command is None:
+        return None
+    command, format, output, frame_format = command
+    log(" ".join(command))
+    # output of the encoder, to log if it fails
+    errors = tempfile.TemporaryFile()
+    process = subprocess.Popen(command, stdin=subprocess.PIPE,
+                               stdout=errors, stderr=errors)
+    return {
+        "process": process,
+        "errors": errors,
+        "format": format,
+        "output": output,
+        "size": (size_x, size_y),
+        "frame_format": frame_format,
+        "frames": 0}
+
+
+def get_frame_data(encoder, image):
+    """ Returns the PIL image as a frame for the encoder, raw RGB or JPEG. """
+    if image.size != encoder["size"]:
+        image = reshape_to_fit(image, *encoder["size"])
+    image = image.convert("RGB")
+    if encoder["frame_format"] == "mjpeg":
+        data = BytesIO()
+        image.save(data, "JPEG", quality=MJPEG_QUALITY)
+        return data.getvalue()
+    return image.tobytes()
+
+
+def write_frame(encoder, image, count=1):
+    """
+    Sends the PIL image to the encoder as count frames of the movie. The
+    frame is converted, or encoded for MJPEG, once and sent count times.
+    Only MJPEG copies the frames into the movie: other encoders still
+    encode each of the count frames.
+    """
+    if encoder["process"].stdin.closed:
+        return
+    data = get_frame_data(encoder, image)
+    try:
+        for i in range(count):
+            encoder["process"].stdin.write(data)
+            encoder["frames"] += 1
+    except OSError:
+        # the encoder has stopped. See close_encoder()
+        encoder["process"].stdin.close()
+
+
+def close_encoder(encoder):
+    """
+    Waits for the encoder to finish the movie.
+
+    :return: True if the movie was made
+    """
+    process = encoder["process"]
+    try:
+        process.stdin.close()
+    except OSError:
+        pass
+    status = process.wait()
+    errors = encoder["errors"]
+    errors.seek(0)
+    output = errors.read().decode("utf-8", "replace").strip()
+    errors.close()
+    if status != 0:
+        log("Encoder failed with status %s:" % status)
+        # the end of the output explains the error
+        log("\n".join(output.splitlines()[-20:]))
+        return False
+    log("Encoded %s frames" % encoder["frames"])
+    return os.path.exists(encoder["output"])
+
+
+PLANE_TIMES_QUERY = ("select info.theZ, info.theC, info.theT,"
+                     " info.deltaT.value from PlaneInfo info"
+                     " where info.pixels.id = :id")
+
+# {pixels_id: plane times} for the run of the script
+plane_times_cache = {}
 
 
-def range_from_list(list, index):
-    min_value = list[0][index]
-    max_value = list[0][index]
-    for i in list:
-        min_value = min(min_value, i[index])
-        max_value = max(max_value, i[index])
-    return range(min_value, max_value+1)
+def get_plane_times(conn, pixels_id):
+    """
+    Returns the times of all the planes of the pixels, loaded with one
+    query the first time and cached after that.
+    As in figureUtil, the times are assumed to be in seconds.
+
+    :return: Dict of numpy arrays of the same length: 'z', 'c' and 't'
+             indexes and 'delta_t', NaN for planes without a time
+    """
+    if pixels_id in plane_times_cache:
+        return plane_times_cache[pixels_id]
+    params = omero.sys.ParametersI()
+    params.add("id", rlong(pixels_id))
+    rows = conn.getQueryService().projection(PLANE_TIMES_QUERY, params,
+                                             conn.SERVICE_OPTS)
+    times = {
+        "z": numpy.array([row[0].val for row in rows], int),
+        "c": numpy.array([row[1].val for row in rows], int),
+        "t": numpy.array([row[2].val for row in rows], int),
+        "delta_t": numpy.array([numpy.nan if row[3] is None else row[3].val
+                                for row in rows], float)}
+    plane_times_cache[pixels_id] = times
+    return times
+
+
+def get_mean_times(conn, pixels_id, c_list=None):
+    """
+    Returns the time of each Z and T, averaged over the channels.
+
+    :param c_list: Indexes of the channels to average. All by default
+    :return: Dict of {(z, t): seconds}. Planes without times are left out
+    """
+    times = get_plane_times(conn, pixels_id)
+    keep = ~numpy.isnan(times["delta_t"])
+    if c_list is not None:
+        keep &= numpy.isin(times["c"], list(c_list))
+    zt = numpy.stack([times["z"][keep], times["t"][keep]], axis=1)
+    if len(zt) == 0:
+        return {}
+    planes, index = numpy.unique(zt, axis=0, return_inverse=True)
+    index = index.ravel()
+    sums = numpy.bincount(index, times["delta_t"][keep], len(planes))
+    counts = numpy.bincount(index, minlength=len(planes))
+    return dict(((int(z), int(t)), float(total / count))
+                for (z, t), total, count in zip(planes, sums, counts))
 
 
 def calculate_acquisition_time(conn, pixels_id, c_list, tz_list):
-    """ Loads the plane information. """
-    query_service = conn.getQueryService()
-
-    t_range = ",".join([str(i) for i in range_from_list(tz_list, 0)])
-    z_range = ",".join([str(i) for i in range_from_list(tz_list, 1)])
-    c_range = ",".join([str(i) for i in c_list])
-    query = "from PlaneInfo as Info where Info.theZ in (%s) and Info.theT" \
-        " in (%s) and Info.theC in (%s) and pixels.id='%s'" \
-        % (z_range, t_range, c_range, pixels_id)
-    info_list = query_service.findAllByQuery(query, None)
-
-    map = {}
-    for info in info_list:
-        if (info.deltaT is None):
+    """
+    Returns the time of each plane of the movie, averaged over the
+    channels, as a dict of {(z, t): seconds}. None if any plane has no time.
+    """
+    time_map = get_mean_times(conn, pixels_id, c_list)
+    for t, z in tz_list:
+        if (z, t) not in time_map:
             return None
-        key = "z:" + str(info.theZ.getValue()) + "t:" + \
-            str(info.theT.getValue())
-        if key in map:
-            value = map.get(key)
-            value = value+info.deltaT.getValue()
-            map[key] = value
-        else:
-            map[key] = info.deltaT.getValue()
-    for key in map:
-        map[key] = map[key]/len(c_range)
-    return map
+    return time_map
 
 
 def add_scalebar(scalebar, image, pixels, command_args):
@@ -190,30 +357,117 @@ def add_scalebar(scalebar, image, pixels, command_args):
     return image
 
 
-def add_plane_info(z, t, pixels, image, colour):
-    """ Displays the plane information. """
-    image_w, image_h = image.size
-    draw = ImageDraw.Draw(image)
-    text_y = image_h-60
-    text_x = 20
-    if (text_y <= 0 or text_x > image_w or text_y > image_h):
-        return image
-    plane_coord = "z:"+str(z+1)+" t:"+str(t+1)
-    draw.text((text_x, text_y), plane_coord, fill=colour)
-    return image
+def premultiply(layer, box):
+    """
+    Returns the box of the RGBA layer as premultiplied colour and alpha
+    arrays, with values from 0 to 1.
+    """
+    rgba = numpy.asarray(layer.crop(box), dtype=numpy.float32) / 255
+    alpha = rgba[:, :, 3:]
+    return rgba[:, :, :3] * alpha, alpha
 
 
-def add_time_points(time, pixels, image, colour):
-    """ Displays the time-points as hrs:mins:secs """
-    time = figureUtil.formatTime(time, "HOURS_MINS_SECS")
-    image_w, image_h = image.size
-    draw = ImageDraw.Draw(image)
-    text_y = image_h-45
-    text_x = 20
-    if (text_y <= 0 or text_x > image_w or text_y > image_h):
+def create_compositor(size, command_args, pixels, colour, watermark):
+    """
+    Builds the overlays that are the same on every frame, the scale bar
+    below the labels and the watermark above them, once for the movie.
+
+    :param size:        (width, height) of the frames
+    :param colour:      (r, g, b) of the time and plane info labels
+    :param watermark:   PIL Image or None
+    :return:            Dict of compositor state, used by add_overlays()
+    """
+    size_x, size_y = size
+    layers = []
+    below = Image.new("RGBA", size, (0, 0, 0, 0))
+    if "Scalebar" in command_args and command_args["Scalebar"]:
+        add_scalebar(command_args["Scalebar"], below, pixels, command_args)
+    above = Image.new("RGBA", size, (0, 0, 0, 0))
+    if watermark is not None:
+        watermark = watermark.convert("RGBA")
+        # bottom left corner
+        above.paste(watermark, (0, size_y - watermark.size[1]))
+    for layer in (below, above):
+        # only blend the part of the frame that the layer covers
+        box = layer.getbbox()
+        layers.append(None if box is None else
+                      (box,) + premultiply(layer, box))
+    font = ImageFont.load_default()
+    return {
+        "size": size,
+        "below": layers[0],
+        "above": layers[1],
+        "colour": numpy.array(colour, dtype=numpy.float32) / 255,
+        "font": font,
+        # height of the labels, from the top of the text
+        "line_height": font.getbbox("0123456789:zt")[3] + 1,
+        "glyphs": {}}
+
+
+def get_glyph(compositor, char):
+    """ Returns the cached alpha mask of the character, as an array. """
+    glyph = compositor["glyphs"].get(char)
+    if glyph is None:
+        font = compositor["font"]
+        width = max(int(font.getlength(char)), font.getbbox(char)[2], 1)
+        mask = Image.new("L", (width, compositor["line_height"]), 0)
+        ImageDraw.Draw(mask).text((0, 0), char, fill=255, font=font)
+        glyph = numpy.asarray(mask, dtype=numpy.float32) / 255
+        compositor["glyphs"][char] = glyph
+    return glyph
+
+
+def get_label(compositor, text, x, y):
+    """
+    Returns the label of the text at (x, y), made of the cached glyphs,
+    as (box, colour, alpha) for blend().
+    """
+    font = compositor["font"]
+    offsets = [0]
+    for char in text:
+        offsets.append(offsets[-1] + font.getlength(char))
+    glyphs = [get_glyph(compositor, char) for char in text]
+    width = max(int(o) + g.shape[1] for o, g in zip(offsets, glyphs))
+    alpha = numpy.zeros((compositor["line_height"], width), numpy.float32)
+    for offset, glyph in zip(offsets, glyphs):
+        # anti-aliased edges of neighbouring glyphs can overlap
+        part = alpha[:, int(offset):int(offset) + glyph.shape[1]]
+        numpy.maximum(part, glyph, out=part)
+    size_x, size_y = compositor["size"]
+    # clip to the frame
+    alpha = alpha[:max(size_y - y, 0), :max(size_x - x, 0), None]
+    box = (x, y, x + alpha.shape[1], y + alpha.shape[0])
+    return box, compositor["colour"] * alpha, alpha
+
+
+def blend(frame, layer):
+    """ Blends the premultiplied layer over its box of the frame array. """
+    (x1, y1, x2, y2), colour, alpha = layer
+    region = frame[y1:y2, x1:x2]
+    region[...] = colour * 255 + region * (1 - alpha)
+
+
+def add_overlays(compositor, image, labels):
+    """
+    Adds the scale bar, labels and watermark to the frame.
+
+    :param labels:  List of (text, x, y) for the labels of this frame
+    :return:        PIL Image
+    """
+    layers = [compositor["below"]]
+    size_x, size_y = compositor["size"]
+    for text, x, y in labels:
+        if (y <= 0 or x > size_x or y > size_y):
+            continue
+        layers.append(get_label(compositor, text, x, y))
+    layers.append(compositor["above"])
+    layers = [layer for layer in layers if layer is not None]
+    if not layers:
         return image
-    draw.text((text_x, text_y), str(time), fill=colour)
-    return image
+    frame = numpy.array(image.convert("RGB"), dtype=numpy.float32)
+    for layer in layers:
+        blend(frame, layer)
+    return Image.fromarray(numpy.rint(frame).astype(numpy.uint8))
 
 
 def get_rendering_engine(conn, pixels_id, size_c, c_range):
@@ -260,7 +514,7 @@ def valid_channels(set, size_c):
     if (len(set) == 0):
         return False
     for val in set:
-        if isinstance(val, StringTypes):
+        if isinstance(val, str):
             val = int(val.split('|')[0].split('$')[0])
         if (val < 0 or val > size_c):
             return False
@@ -347,17 +601,17 @@ def reshape_to_fit(image, size_x, size_y, bg=(0, 0, 0)):
         return image
     # scale
     ratio = min(float(size_x) / image_w, float(size_y) / image_h)
-    image = image.resize(map(lambda x: int(x*ratio), image.size),
+    image = image.resize(tuple(int(x*ratio) for x in image.size),
                          Image.LANCZOS)
     # paste
     bg = Image.new("RGBA", (size_x, size_y), (0, 0, 0))     # black bg
-    ovlpos = (size_x-image.size[0]) / 2, (size_y-image.size[1]) / 2
+    ovlpos = (size_x-image.size[0]) // 2, (size_y-image.size[1]) // 2
     bg.paste(image, ovlpos)
     return bg
 
 
 def write_intro_end_slides(conn, command_args, orig_file_id, duration, size_x,
-                           size_y):
+                           size_y, encoder):
     """
     Uses an original file (jpeg or png) to add frames to the movie.
     Scales and pads to fit size_x, size_y.
@@ -366,12 +620,10 @@ def write_intro_end_slides(conn, command_args, orig_file_id, duration, size_x,
     :param duration:        Duration of intro / end (secs)
     :param size_x:          Width of the exported movie
     :param size_y:          Height of the exported movie
-    :return:                List of file names to add to mencoder list
+    :param encoder:         Encoder to write the frames to
     """
 
-    slide_filenames = []
     fps = command_args["FPS"]
-    format = command_args["Format"]
 
     # get Original File as Image
     slide_file = conn.getObject("OriginalFile", orig_file_id)
@@ -380,18 +632,9 @@ def write_intro_end_slides(conn, command_args, orig_file_id, duration, size_x,
     slide = Image.open(i)
     slide = reshape_to_fit(slide, size_x, size_y)
 
-    # write the file once
-    if format == QT:
-        filename = 'slide_%s.png' % orig_file_id
-        slide.save(filename, "PNG")
-    else:
-        filename = 'slide_%s.jpg' % orig_file_id
-        slide.save(filename, "JPEG")
-    # control duration by adding the filename multiple times
-    for i in range(duration * fps):
-        slide_filenames.append(filename)
-
-    return slide_filenames
+    # control duration by holding the slide for several frames, rendered
+    # once. Only MJPEG also encodes it once.
+    write_frame(encoder, slide, duration * fps)
 
 
 def prepare_watermark(conn, command_args, size_x, size_y):
@@ -416,44 +659,137 @@ def prepare_watermark(conn, command_args, size_x, size_y):
     return wm
 
 
-def paste_watermark(image, watermark):
+def get_renderers(conn, omero_image, count, rid, c_range, c_windows,
+                  c_colours):
     """
-    Paste the watermark onto the bottom left corner of the image. Return image
+    Returns count images to render frames with, each with its own rendering
+    engine and the same settings. The first is omero_image.
+
+    :param rid:     Rendering Definition ID, or None for the default
     """
+    renderers = [omero_image]
+    for i in range(count - 1):
+        image = conn.getObject("Image", omero_image.getId())
+        if rid is not None:
+            image._prepareRenderingEngine(rdid=rid)
+        image.setActiveChannels([x+1 for x in c_range], c_windows, c_colours)
+        renderers.append(image)
+    return renderers
 
-    wm_w, wm_h = watermark.size
-    w, h = image.size
-    wmpos = 0, h - wm_h
-    image.paste(watermark, wmpos, watermark)
-    return image
 
+def close_renderers(renderers):
+    """ Closes the rendering engines of the renderers. """
+    for image in renderers:
+        if image._re is not None:
+            image._re.close()
 
-def write_movie(command_args, conn):
+
+def make_frame(image, z, t, frame):
     """
-    Makes the movie.
+    Renders the plane and adds the overlays to make a frame of the movie.
 
-    :return: Returns the file annotation
+    :param image:   Image to render the plane with
+    :param frame:   Dict of the canvas, overlays etc. of every frame
+    :return:        PIL Image
     """
-    log("Movie created by OMERO")
-    log("")
+    command_args = frame["command_args"]
+    image = image.renderImage(z, t)
+
+    if frame["ovlpos"] is not None:
+        image2 = frame["canvas"].copy()
+        image2.paste(image, frame["ovlpos"], image)
+        image = image2
+
+    size_x, size_y = image.size
+    labels = []
+    if "Show_Time" in command_args and command_args["Show_Time"]:
+        # time-points as hrs:mins:secs
+        time_label = figureUtil.formatTime(frame["time_map"][(z, t)],
+                                           "HOURS_MINS_SECS")
+        labels.append((str(time_label), 20, size_y-45))
+    if "Show_Plane_Info" in command_args and \
+            command_args["Show_Plane_Info"]:
+        labels.append(("z:"+str(z+1)+" t:"+str(t+1), 20, size_y-60))
+    return add_overlays(frame["compositor"], image, labels)
+
+
+def get_frame_holds(tz_list):
+    """
+    Returns the planes of the movie with the number of frames to hold
+    each one for, e.g. [[0, 0], [0, 0], [1, 0]] -> [((0, 0), 2), ((1, 0), 1)]
+    so that repeated planes are only rendered once.
 
-    message = ""
+    :return: List of ((t, z), count)
+    """
+    return [(tz, len(list(run)))
+            for tz, run in groupby(tuple(tz) for tz in tz_list)]
 
-    session = conn.c.sf
-    update_service = session.getUpdateService()
-    raw_file_store = session.createRawFileStore()
 
-    # Get the images
-    images, log_message = script_utils.get_objects(conn, command_args)
-    message += log_message
-    if not images:
-        return None, message
-    # Get the first valid image (should be expanded to process the list)
-    omero_image = images[0]
+def make_frames(renderers, tz_list, frame, executor=None):
+    """
+    Generates the frames of each (t, z) in tz_list, in order. Each
+    renderer makes a frame at a time, and up to 2 frames per renderer are
+    held in memory, however long the movie is.
+
+    :param executor:    Pool of threads to render with, or None to make one
+    """
+    if len(renderers) == 1:
+        for t, z in tz_list:
+            yield make_frame(renderers[0], z, t, frame)
+        return
+    # each renderer is used by one thread at a time
+    idle = Queue()
+    for image in renderers:
+        idle.put(image)
+
+    def render(z, t):
+        image = idle.get()
+        try:
+            return make_frame(image, z, t, frame)
+        finally:
+            idle.put(image)
+
+    pool = executor or ThreadPoolExecutor(max_workers=len(renderers))
+    try:
+        pending = deque()
+        for t, z in tz_list:
+            pending.append(pool.submit(render, z, t))
+            if len(pending) >= 2 * len(renderers):
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        if executor is None:
+            pool.shutdown()
+
+
+def get_rdef_image_id(conn, rid):
+    """ Returns the ID of the image of the Rendering Definition, or None. """
+    params = omero.sys.ParametersI()
+    params.addId(rid)
+    rows = conn.getQueryService().projection(
+        "select r.pixels.image.id from RenderingDef r where r.id = :id",
+        params, conn.SERVICE_OPTS)
+    return unwrap(rows[0][0]) if rows else None
+
+
+def get_movie_settings(conn, command_args, omero_image):
+    """
+    Works out the planes, channels and frame size of the movie of the image.
 
+    :return: Dict of the settings, or None if the image has no sizes
+    """
+    # changes to the args are only for this image
+    command_args = dict(command_args)
     if command_args["RenderingDef_ID"] >= 0:
         rid = command_args["RenderingDef_ID"]
-        omero_image._prepareRenderingEngine(rdid=rid)
+        if get_rdef_image_id(conn, rid) == omero_image.getId():
+            omero_image._prepareRenderingEngine(rdid=rid)
+        else:
+            # the Rendering Definition is of another image
+            log("Image %s: using default rendering settings"
+                % omero_image.getId())
+            command_args["RenderingDef_ID"] = -1
     pixels = omero_image.getPrimaryPixels()
     pixels_id = pixels.getId()
 
@@ -465,7 +801,7 @@ def write_movie(command_args, conn):
 
     if (size_x is None or size_y is None or size_z is None or size_t is None or
             size_c is None):
-        return
+        return None
 
     if (pixels.getPhysicalSizeX() is None):
         command_args["Scalebar"] = 0
@@ -492,13 +828,9 @@ def write_movie(command_args, conn):
     tz_list = calculate_ranges(size_z, size_t, command_args)
 
     time_map = calculate_acquisition_time(conn, pixels_id, c_range, tz_list)
-    if (time_map is None):
+    if time_map is None or len(time_map) == 0:
         command_args["Show_Time"] = False
-    if (time_map is not None):
-        if (len(time_map) == 0):
-            command_args["Show_Time"] = False
 
-    frame_no = 1
     omero_image.setActiveChannels([x+1 for x in c_range],
                                   c_windows, c_colours)
 
@@ -517,101 +849,206 @@ def write_movie(command_args, conn):
     ovlpos = None
     canvas = None
     if size_x < mw or size_y < mh:
-        ovlpos = ((mw-size_x) / 2, (mh-size_y) / 2)
+        ovlpos = ((mw-size_x) // 2, (mh-size_y) // 2)
         canvas = Image.new("RGBA", (mw, mh), canvas_colour)
 
-    format = command_args["Format"]
-    file_names = []
+    return {
+        "command_args": command_args,
+        "image": omero_image,
+        "pixels": pixels,
+        "c_range": c_range,
+        "c_windows": c_windows,
+        "c_colours": c_colours,
+        "tz_list": tz_list,
+        "time_map": time_map,
+        "overlay_colour": overlay_colour,
+        "size": (mw, mh),
+        "canvas": canvas,
+        "ovlpos": ovlpos}
+
+
+def write_image_frames(conn, settings, encoder, executor=None):
+    """
+    Renders the frames of the image and writes them to the encoder.
 
-    # add intro...
-    if "Intro_Slide" in command_args and command_args["Intro_Slide"].id:
-        intro_duration = command_args["Intro_Duration"]
-        intro_file_id = command_args["Intro_Slide"].getId().getValue()
-        intro_filenames = write_intro_end_slides(
-            conn, command_args, intro_file_id, intro_duration, mw, mh)
-        file_names.extend(intro_filenames)
+    :param settings:    Dict from get_movie_settings()
+    :param executor:    Pool of threads to render with, shared by all
+                        the images of the movies
+    """
+    command_args = settings["command_args"]
+    omero_image = settings["image"]
+    size_x, size_y = settings["size"]
 
     # prepare watermark
+    watermark = None
     if "Watermark" in command_args and command_args["Watermark"].id:
-        watermark = prepare_watermark(conn, command_args, mw, mh)
+        watermark = prepare_watermark(conn, command_args, size_x, size_y)
 
     # add movie frames...
-    for tz in tz_list:
-        t = tz[0]
-        z = tz[1]
-        image = omero_image.renderImage(z, t)
-
-        if ovlpos is not None:
-            image2 = canvas.copy()
-            image2.paste(image, ovlpos, image)
-            image = image2
-
-        if "Scalebar" in command_args and command_args["Scalebar"]:
-            image = add_scalebar(
-                command_args["Scalebar"], image, pixels, command_args)
-        plane_info = "z:"+str(z)+"t:"+str(t)
-        if "Show_Time" in command_args and command_args["Show_Time"]:
-            time = time_map[plane_info]
-            image = add_time_points(time, pixels, image, overlay_colour)
-        if "Show_Plane_Info" in command_args and \
-                command_args["Show_Plane_Info"]:
-            image = add_plane_info(z, t, pixels, image, overlay_colour)
-        if "Watermark" in command_args and command_args["Watermark"].id:
-            image = paste_watermark(image, watermark)
-        if format == QT:
-            filename = str(frame_no) + '.png'
-            image.save(filename, "PNG")
-        else:
-            filename = str(frame_no) + '.jpg'
-            image.save(filename, "JPEG")
-        file_names.append(filename)
-        frame_no += 1
-
-    # add exit frames... "outro"
-    # add intro...
-    if "Ending_Slide" in command_args and command_args["Ending_Slide"].id:
-        end_duration = command_args["Ending_Duration"]
-        end_file_id = command_args["Ending_Slide"].id.val
-        end_filenames = write_intro_end_slides(
-            conn, command_args, end_file_id, end_duration, mw, mh)
-        file_names.extend(end_filenames)
-
-    filelist = ",".join(file_names)
+    frame = {
+        "command_args": command_args,
+        "canvas": settings["canvas"],
+        "ovlpos": settings["ovlpos"],
+        "time_map": settings["time_map"],
+        "compositor": create_compositor(
+            settings["size"], command_args, settings["pixels"],
+            settings["overlay_colour"], watermark)}
+    rid = command_args["RenderingDef_ID"]
+    renderers = get_renderers(conn, omero_image,
+                              command_args.get("Max_Workers", 1),
+                              rid if rid >= 0 else None,
+                              settings["c_range"], settings["c_windows"],
+                              settings["c_colours"])
+    holds = get_frame_holds(settings["tz_list"])
+    try:
+        frames = make_frames(renderers, [tz for tz, count in holds], frame,
+                             executor)
+        for image, (tz, count) in zip(frames, holds):
+            write_frame(encoder, image, count)
+    finally:
+        close_renderers(renderers)
+
+
+def write_slide(conn, command_args, name, encoder):
+    """ Writes the Intro or Ending slide, if chosen. """
+    slide = command_args.get("%s_Slide" % name)
+    if slide is None or not slide.id:
+        return
+    size_x, size_y = encoder["size"]
+    write_intro_end_slides(conn, command_args, slide.id.val,
+                           command_args["%s_Duration" % name], size_x,
+                           size_y, encoder)
 
+
+def get_movie_name(command_args, format, image=None):
+    """ Returns the file name of the movie, of the image if given. """
     ext = format_map[format]
     movie_name = "Movie"
     if "Movie_Name" in command_args:
         movie_name = command_args["Movie_Name"]
         movie_name = os.path.basename(movie_name)
-    if not movie_name.endswith(".%s" % ext):
-        movie_name = "%s.%s" % (movie_name, ext)
+    if movie_name.endswith(".%s" % ext):
+        movie_name = movie_name[:-len(".%s" % ext)]
+    if image is not None:
+        movie_name = "%s_%s" % (movie_name, image.getId())
+    movie_name = "%s.%s" % (movie_name, ext)
 
     # spaces etc in file name cause problems
-    movie_name = re.sub("[$&\\;|\\(\\)<>' ]", "", movie_name)
-    frames_per_sec = 2
-    if "FPS" in command_args:
-        frames_per_sec = command_args["FPS"]
-    output = "localfile.%s" % ext
-    build_avi(mw, mh, filelist, frames_per_sec, output, format)
-    mimetype = format_mimetypes[format]
-    omero_image._re.close()
+    return re.sub("[$&\\;|\\(\\)<>' ]", "", movie_name)
 
-    if not os.path.exists(output):
+
+def save_movie(conn, command_args, encoder, movie_name, images):
+    """
+    Finishes the movie and saves it, linked to the images if Do_Link.
+
+    :return: Tuple of (OriginalFile or FileAnnotation, message)
+    """
+    output = encoder["output"]
+    if not close_encoder(encoder):
         return None, "Failed to create movie file: %s" % output
+    mimetype = format_mimetypes[encoder["format"]]
     if not command_args["Do_Link"]:
+        session = conn.c.sf
         original_file = script_utils.create_file(
-            update_service, output, mimetype, movie_name)
-        script_utils.upload_file(raw_file_store, original_file, movie_name)
-        return original_file, message
+            session.getUpdateService(), output, mimetype, movie_name)
+        raw_file_store = session.createRawFileStore()
+        try:
+            script_utils.upload_file(raw_file_store, original_file,
+                                     movie_name)
+        finally:
+            raw_file_store.close()
+        return original_file, ""
 
     namespace = NSCREATED + "/omero/export_scripts/Make_Movie"
-    file_annotation, ann_message = script_utils.create_link_file_annotation(
-        conn, output, omero_image, namespace=namespace,
+    file_annotation, message = script_utils.create_link_file_annotation(
+        conn, output, images[0], namespace=namespace,
         mimetype=mimetype, orig_file_path_and_name=movie_name)
-    message += ann_message
+    for image in images[1:]:
+        if image.canAnnotate():
+            image.linkAnnotation(file_annotation)
     return file_annotation._obj, message
 
 
+def write_movie(command_args, conn):
+    """
+    Makes a movie of each image, or one movie of all the images one after
+    another if Concatenate.
+
+    :return: Returns the file annotation of the first movie
+    """
+    log("Movie created by OMERO")
+    log("")
+
+    message = ""
+
+    # Get the images
+    images, log_message = script_utils.get_objects(conn, command_args)
+    message += log_message
+    if not images:
+        return None, message
+
+    concatenate = command_args.get("Concatenate", False)
+    frames_per_sec = 2
+    if "FPS" in command_args:
+        frames_per_sec = command_args["FPS"]
+    max_workers = command_args.get("Max_Workers", 1)
+    executor = None
+    if max_workers > 1:
+        # the same threads render the frames of every image
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    movies = []
+    encoder = None
+    movie_images = []
+    try:
+        for omero_image in images:
+            start = time.time()
+            settings = get_movie_settings(conn, command_args, omero_image)
+            if settings is None:
+                log("Image %s has no size, skipping" % omero_image.getId())
+                continue
+            if encoder is None:
+                encoder = create_encoder(settings["size"][0],
+                                         settings["size"][1],
+                                         frames_per_sec,
+                                         command_args["Format"])
+                if encoder is None:
+                    close_renderers([omero_image])
+                    return None, ("No movie encoder found. Install ffmpeg"
+                                  " or mencoder")
+                write_slide(conn, command_args, "Intro", encoder)
+            # frames of a different size are fitted to the movie
+            write_image_frames(conn, settings, encoder, executor)
+            movie_images.append(omero_image)
+            log("Image %s: %s frames in %.1f secs" % (
+                omero_image.getId(), len(settings["tz_list"]),
+                time.time() - start))
+            if not concatenate:
+                write_slide(conn, command_args, "Ending", encoder)
+                name = get_movie_name(command_args, encoder["format"],
+                                      omero_image if len(images) > 1
+                                      else None)
+                movies.append(save_movie(conn, command_args, encoder, name,
+                                         movie_images))
+                encoder = None
+                movie_images = []
+        if encoder is not None:
+            write_slide(conn, command_args, "Ending", encoder)
+            name = get_movie_name(command_args, encoder["format"])
+            movies.append(save_movie(conn, command_args, encoder, name,
+                                     movie_images))
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    created = [movie for movie, movie_message in movies if movie is not None]
+    message += "; ".join(movie_message for movie, movie_message in movies
+                         if movie_message)
+    if len(created) > 1:
+        message += " Created %s movies" % len(created)
+    return (created[0] if created else None), message
+
+
 def run_script():
     """
     The main entry point of the script. Gets the parameters from the scripting
@@ -642,7 +1079,8 @@ def run_script():
 
         scripts.Long(
             "RenderingDef_ID",
-            description="The Rendering Definitions for the Image.",
+            description="The Rendering Definitions for the Image. Other"
+            " Images use their default rendering settings",
             default=-1, optional=True, grouping="1"),
 
         scripts.String(
@@ -697,8 +1135,10 @@ def run_script():
             " pixel-size info.", min=1, grouping="9"),
 
         scripts.String(
-            "Format", description="Format to save movie", values=formats,
-            default=QT, grouping="10"),
+            "Format", description="Format to save movie. H.264, VP9 and AV1"
+            " need ffmpeg with that encoder, else MJPEG is used. With ffmpeg,"
+            " MJPEG encodes slides and repeated planes only once",
+            values=formats, default=QT, grouping="10"),
 
         scripts.String(
             "Overlay_Colour",
@@ -747,6 +1187,16 @@ def run_script():
             description="Duration of finishing slide in seconds. Default is 3"
             " secs."),
 
+        scripts.Int(
+            "Max_Workers", grouping="13", default=1, min=1, max=8,
+            description="Number of frames to render at the same time, each"
+            " with its own rendering engine"),
+
+        scripts.Bool(
+            "Concatenate", grouping="14", default=False,
+            description="Make one movie of all the Images, one after"
+            " another, instead of a movie of each Image"),
+
         scripts.Bool(
             "Do_Link",
             description="If true, creates a FileAnnotation with the"
@@ -46,6 +46,7 @@ from omero.constants.namespaces import NSCREATED
 from omero.constants.projection import ProjectionType
 from datetime import date
 import math
+import numpy
 
 from PIL import Image, ImageDraw
 
@@ -59,6 +60,93 @@ def log(text):
     log_lines.append(text)
 
 
+PLANE_TIMES_QUERY = ("select info.theZ, info.theC, info.theT,"
+                     " info.deltaT.value from PlaneInfo info"
+                     " where info.pixels.id = :id")
+
+# {pixels_id: plane times} for the run of the script
+plane_times_cache = {}
+
+
+def get_plane_times(conn, pixels_id):
+    """
+    Returns the times of all the planes of the pixels, loaded with one
+    query the first time and cached after that.
+    As in figureUtil, the times are assumed to be in seconds.
+
+    :return: Dict of numpy arrays of the same length: 'z', 'c' and 't'
+             indexes and 'delta_t', NaN for planes without a time
+    """
+    if pixels_id in plane_times_cache:
+        return plane_times_cache[pixels_id]
+    params = omero.sys.ParametersI()
+    params.add("id", rlong(pixels_id))
+    rows = conn.getQueryService().projection(PLANE_TIMES_QUERY, params,
+                                             conn.SERVICE_OPTS)
+    times = {
+        "z": numpy.array([row[0].val for row in rows], int),
+        "c": numpy.array([row[1].val for row in rows], int),
+        "t": numpy.array([row[2].val for row in rows], int),
+        "delta_t": numpy.array([numpy.nan if row[3] is None else row[3].val
+                                for row in rows], float)}
+    plane_times_cache[pixels_id] = times
+    return times
+
+
+def get_times(conn, pixels_id, t_indexes, the_z=0, the_c=0):
+    """
+    Returns the time of the plane at each T index, as figureUtil.getTimes()
+    does, for one Z and channel.
+
+    :return: Dict of {t: seconds}. Planes without times are left out
+    """
+    times = get_plane_times(conn, pixels_id)
+    keep = (times["z"] == the_z) & (times["c"] == the_c) & \
+        ~numpy.isnan(times["delta_t"]) & \
+        numpy.isin(times["t"], list(t_indexes))
+    return dict((int(t), float(delta_t)) for t, delta_t in
+                zip(times["t"][keep], times["delta_t"][keep]))
+
+
+def get_time_labels(conn, pixels_id, t_indexes, size_t,
+                    time_units=None, show_roi_duration=False):
+    """
+    Returns the time labels of the T indexes, as figureUtil.getTimeLabels()
+    does but from the cached plane times. Planes without a time are
+    labelled e.g. "3/10".
+
+    :param time_units: Format of the times, see figureUtil.formatTime().
+                       Chosen from the longest time by default.
+    :param show_roi_duration: If True, times are from the first T index
+    :return: List of labels in the order of t_indexes, followed by the
+             time units
+    """
+    seconds_map = get_times(conn, pixels_id, t_indexes)
+
+    if time_units is None and len(seconds_map) > 0:
+        max_secs = max(seconds_map.values())
+        if max_secs > 3600:
+            time_units = figUtil.HOURS_MINS
+        elif max_secs > 60:
+            time_units = figUtil.MINS_SECS
+        else:
+            time_units = figUtil.SECS_MILLIS
+
+    start = 0
+    if show_roi_duration and len(t_indexes) > 0:
+        start = seconds_map.get(t_indexes[0], 0)
+    labels = []
+    for t in t_indexes:
+        if t in seconds_map:
+            labels.append(figUtil.formatTime(seconds_map[t] - start,
+                                             time_units))
+        else:
+            labels.append("%d/%d" % (t + 1, size_t))
+
+    labels.append(time_units)
+    return labels
+
+
 def createmovie_figure(conn, pixel_ids, t_indexes, z_start, z_end, width,
                        height, spacer, algorithm, stepping, scalebar,
                        overlay_colour, time_units, image_labels,
@@ -198,12 +286,11 @@ def createmovie_figure(conn, pixel_ids, t_indexes, z_start, z_end, width,
         canvas = Image.new(mode, size, white)
 
         # add text labels
-        query_service = conn.getQueryService()
         text_x = spacer
         text_y = spacer // 4
         col_index = 0
-        time_labels = figUtil.getTimeLabels(
-            query_service, pixels_id, t_indexes, size_t, time_units)
+        time_labels = get_time_labels(
+            conn, pixels_id, t_indexes, size_t, time_units)
         for t, t_index in enumerate(t_indexes):
             if t_index >= size_t:
                 continue
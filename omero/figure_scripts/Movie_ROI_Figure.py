@@ -33,18 +33,20 @@ ROIs as zoomed panels beside the images.
 # <a href="mailto:donald@lifesci.dundee.ac.uk">donald@lifesci.dundee.ac.uk</a>
 # @since 3.0
 
+import omero
 import omero.scripts as scripts
 import omero.util.image_utils as image_utils
 import omero.util.figureUtil as figUtil
 import omero.util.script_utils as script_utils
 from omero.gateway import BlitzGateway
-from omero.rtypes import rlong, rint, rstring, robject, wrap, unwrap
+from omero.rtypes import rlong, rint, rstring, robject, wrap, unwrap, rlist
 from omero.constants.namespaces import NSCREATED
 import omero.model
 from omero.constants.projection import ProjectionType
 import os
 import io
 from datetime import date
+import numpy
 
 from PIL import Image, ImageDraw
 
@@ -54,6 +56,11 @@ OVERLAY_COLOURS = dict(COLOURS, **script_utils.EXTRA_COLOURS)
 
 log_strings = []
 
+ROIS_QUERY = ("select distinct roi from Roi roi"
+              " join fetch roi.shapes shape"
+              " left outer join fetch shape.transform"
+              " where roi.image.id in (:ids)")
+
 
 def log(text):
     """
@@ -62,6 +69,93 @@ def log(text):
     log_strings.append(text)
 
 
+PLANE_TIMES_QUERY = ("select info.theZ, info.theC, info.theT,"
+                     " info.deltaT.value from PlaneInfo info"
+                     " where info.pixels.id = :id")
+
+# {pixels_id: plane times} for the run of the script
+plane_times_cache = {}
+
+
+def get_plane_times(conn, pixels_id):
+    """
+    Returns the times of all the planes of the pixels, loaded with one
+    query the first time and cached after that.
+    As in figureUtil, the times are assumed to be in seconds.
+
+    :return: Dict of numpy arrays of the same length: 'z', 'c' and 't'
+             indexes and 'delta_t', NaN for planes without a time
+    """
+    if pixels_id in plane_times_cache:
+        return plane_times_cache[pixels_id]
+    params = omero.sys.ParametersI()
+    params.add("id", rlong(pixels_id))
+    rows = conn.getQueryService().projection(PLANE_TIMES_QUERY, params,
+                                             conn.SERVICE_OPTS)
+    times = {
+        "z": numpy.array([row[0].val for row in rows], int),
+        "c": numpy.array([row[1].val for row in rows], int),
+        "t": numpy.array([row[2].val for row in rows], int),
+        "delta_t": numpy.array([numpy.nan if row[3] is None else row[3].val
+                                for row in rows], float)}
+    plane_times_cache[pixels_id] = times
+    return times
+
+
+def get_times(conn, pixels_id, t_indexes, the_z=0, the_c=0):
+    """
+    Returns the time of the plane at each T index, as figureUtil.getTimes()
+    does, for one Z and channel.
+
+    :return: Dict of {t: seconds}. Planes without times are left out
+    """
+    times = get_plane_times(conn, pixels_id)
+    keep = (times["z"] == the_z) & (times["c"] == the_c) & \
+        ~numpy.isnan(times["delta_t"]) & \
+        numpy.isin(times["t"], list(t_indexes))
+    return dict((int(t), float(delta_t)) for t, delta_t in
+                zip(times["t"][keep], times["delta_t"][keep]))
+
+
+def get_time_labels(conn, pixels_id, t_indexes, size_t,
+                    time_units=None, show_roi_duration=False):
+    """
+    Returns the time labels of the T indexes, as figureUtil.getTimeLabels()
+    does but from the cached plane times. Planes without a time are
+    labelled e.g. "3/10".
+
+    :param time_units: Format of the times, see figureUtil.formatTime().
+                       Chosen from the longest time by default.
+    :param show_roi_duration: If True, times are from the first T index
+    :return: List of labels in the order of t_indexes, followed by the
+             time units
+    """
+    seconds_map = get_times(conn, pixels_id, t_indexes)
+
+    if time_units is None and len(seconds_map) > 0:
+        max_secs = max(seconds_map.values())
+        if max_secs > 3600:
+            time_units = figUtil.HOURS_MINS
+        elif max_secs > 60:
+            time_units = figUtil.MINS_SECS
+        else:
+            time_units = figUtil.SECS_MILLIS
+
+    start = 0
+    if show_roi_duration and len(t_indexes) > 0:
+        start = seconds_map.get(t_indexes[0], 0)
+    labels = []
+    for t in t_indexes:
+        if t in seconds_map:
+            labels.append(figUtil.formatTime(seconds_map[t] - start,
+                                             time_units))
+        else:
+            labels.append("%d/%d" % (t + 1, size_t))
+
+    labels.append(time_units)
+    return labels
+
+
 def get_time_indexes(time_points, max_frames):
     """
     If we want to display a number of timepoints (e.g. 11), without exceeding
@@ -89,7 +183,7 @@ def get_time_indexes(time_points, max_frames):
     return indexes
 
 
-def get_roi_movie_view(re, query_service, pixels, time_shape_map,
+def get_roi_movie_view(re, conn, pixels, time_shape_map,
                        merged_indexes, merged_colours, roi_width,
                        roi_height, roi_zoom, spacer=12,
                        algorithm=None, stepping=1, font_size=24,
@@ -158,9 +252,8 @@ def get_roi_movie_view(re, query_service, pixels, time_shape_map,
 
     if show_roi_duration:
         log(" Timepoints shown are ROI duration, not from start of movie")
-    time_labels = figUtil.getTimeLabels(query_service, pixels_id,
-                                        time_indexes, size_t, None,
-                                        show_roi_duration)
+    time_labels = get_time_labels(conn, pixels_id, time_indexes,
+                                  size_t, None, show_roi_duration)
     # The last value of the list will be the Units used to display time
 
     full_first_frame = None
@@ -246,24 +339,24 @@ def draw_rectangle(image, roi_x, roi_y, roi_x2, roi_y2, colour, stroke=1):
         roi_y2 -= 1
 
 
-def get_rectangle(roi_service, image_id, roi_label):
+def get_rectangle(image_rois, roi_label):
     """
     Returns (x, y, width, height, timeShapeMap) of the all rectanges in the
     first ROI of the image where timeShapeMap is a map of tIndex:
     (x,y,zMin,zMax)
     x, y, Width and Height are from the first rectangle (assumed that all are
     same size!)
-    """
 
-    result = roi_service.findByImage(image_id, None)
+    :param image_rois: List of (roi, shapes) of the image, from load_rois()
+    """
 
     roi_text = roi_label.lower()
     roi_count = 0
     rect_count = 0
     found_labelled_roi = False
 
-    for roi in result.rois:
-        rectangles = [shape for shape in roi.copyShapes()
+    for roi, shapes in image_rois:
+        rectangles = [shape for shape in shapes
                       if isinstance(shape, omero.model.RectangleI)]
         if len(rectangles) == 0:
             continue
@@ -315,6 +408,46 @@ def get_rectangle(roi_service, image_id, roi_label):
         return (int(x1), int(y1), int(width), int(height), time_shape_map)
 
 
+def load_rois(conn, image_ids, shape_types=None, page_size=500):
+    """
+    Loads the ROIs of the images, for page_size images per query.
+
+    :param image_ids: IDs of the images
+    :param shape_types: E.g. ["Rectangle"] or ["Line", "Polyline"] to only
+                        keep these shapes. ROIs without any are left out.
+    :return: Dict of {image_id: [(roi, shapes)]} for every image, with the
+             ROIs in order of ID and the shapes as from roi.copyShapes()
+    """
+    shape_classes = None
+    if shape_types is not None:
+        shape_classes = tuple(getattr(omero.model, "%sI" % shape_type)
+                              for shape_type in shape_types)
+    unique_ids = list(dict.fromkeys(image_ids))
+    rois_by_image = dict((image_id, []) for image_id in unique_ids)
+    query_service = conn.getQueryService()
+    for start in range(0, len(unique_ids), page_size):
+        params = omero.sys.ParametersI()
+        params.add("ids", rlist([rlong(i) for i in
+                                 unique_ids[start:start + page_size]]))
+        rois = query_service.findAllByQuery(ROIS_QUERY, params,
+                                            conn.SERVICE_OPTS)
+        for roi in rois:
+            # shapes can be None in some situations
+            shapes = [shape for shape in roi.copyShapes()
+                      if shape is not None]
+            if shape_classes is not None:
+                shapes = [shape for shape in shapes
+                          if isinstance(shape, shape_classes)]
+                if not shapes:
+                    continue
+            rois_by_image[roi.getImage().getId().getValue()].append(
+                (roi, shapes))
+    for rois in rois_by_image.values():
+        # Sort by ROI.id (same as in iviewer)
+        rois.sort(key=lambda r: r[0].getId().getValue())
+    return rois_by_image
+
+
 def get_split_view(conn, image_ids, pixel_ids, merged_indexes, merged_colours,
                    width, height, image_labels, spacer, algorithm, stepping,
                    scalebar, overlay_colour, roi_zoom, max_columns,
@@ -340,14 +473,14 @@ def get_split_view(conn, image_ids, pixel_ids, merged_indexes, merged_colours,
                      Doubled between rows.
     """
 
-    roi_service = conn.getRoiService()
+    rois_by_image = load_rois(conn, image_ids, ["Rectangle"])
     re = conn.createRenderingEngine()
     query_service = conn.getQueryService()    # only needed for movie
 
     # establish dimensions and roiZoom for the primary image
     # getTheseValues from the server
     for iid in image_ids:
-        rect = get_rectangle(roi_service, iid, roi_label)
+        rect = get_rectangle(rois_by_image[iid], roi_label)
         if rect is not None:
             break
 
@@ -397,7 +530,7 @@ def get_split_view(conn, image_ids, pixel_ids, merged_indexes, merged_colours,
 
         # need to get the roi dimensions from the server
         image_id = image_ids[row]
-        roi = get_rectangle(roi_service, image_id, roi_label)
+        roi = get_rectangle(rois_by_image[image_id], roi_label)
         if roi is None:
             log("No Rectangle ROI found for this image")
             del image_labels[row]    # remove the corresponding labels
@@ -420,7 +553,7 @@ def get_split_view(conn, image_ids, pixel_ids, merged_indexes, merged_colours,
             " width: %d  height: %d" % (roi_x, roi_y, roi_width, roi_height))
         # get the split pane and full merged image
         roi_split_pane, full_merged_image, top_spacer = get_roi_movie_view(
-            re, query_service, pixels, time_shape_map, merged_indexes,
+            re, conn, pixels, time_shape_map, merged_indexes,
             merged_colours, roi_width, roi_height, roi_zoom, spacer, algorithm,
             stepping, font_size, max_columns, show_roi_duration)
 
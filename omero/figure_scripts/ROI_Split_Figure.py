@@ -37,7 +37,7 @@ import omero.util.image_utils as image_utils
 import omero.util.figureUtil as figUtil
 import omero.util.script_utils as script_utils
 from omero.gateway import BlitzGateway
-from omero.rtypes import rlong, robject, rstring, wrap, unwrap
+from omero.rtypes import rlong, robject, rstring, wrap, unwrap, rlist
 import os
 from omero.constants.namespaces import NSCREATED
 from omero.constants.projection import ProjectionType
@@ -52,6 +52,11 @@ OVERLAY_COLOURS = dict(COLOURS, **script_utils.EXTRA_COLOURS)
 
 log_strings = []
 
+ROIS_QUERY = ("select distinct roi from Roi roi"
+              " join fetch roi.shapes shape"
+              " left outer join fetch shape.transform"
+              " where roi.image.id in (:ids)")
+
 
 def log(text):
     """
@@ -301,25 +306,24 @@ def draw_rectangle(image, roi_x, roi_y, roi_x2, roi_y2, colour, stroke=1):
         roi_y2 -= 1
 
 
-def get_rectangle(roi_service, image_id, roi_label):
+def get_rectangle(image_rois, roi_label):
     """
     Returns (x, y, width, height, zMin, zMax, tMin, tMax) of the first
     rectange in the image that has roi_label as text.
 
+    :param image_rois: List of (roi, shapes) of the image, from load_rois()
     :return: First rectangle.
     """
 
-    result = roi_service.findByImage(image_id, None)
-
     roi_text = roi_label.lower()
     roi_count = 0
     rect_count = 0
     found_labelled_roi = False
 
-    for roi in result.rois:
+    for roi, shapes in image_rois:
         roi_count += 1
         # go through all the shapes of the ROI
-        for shape in roi.copyShapes():
+        for shape in shapes:
             if isinstance(shape, omero.model.RectangleI):
                 the_t = unwrap(shape.getTheT())
                 the_z = unwrap(shape.getTheZ())
@@ -366,6 +370,46 @@ def get_rectangle(roi_service, image_id, roi_label):
                 int(z_max), int(t_min), int(t_max))
 
 
+def load_rois(conn, image_ids, shape_types=None, page_size=500):
+    """
+    Loads the ROIs of the images, for page_size images per query.
+
+    :param image_ids: IDs of the images
+    :param shape_types: E.g. ["Rectangle"] or ["Line", "Polyline"] to only
+                        keep these shapes. ROIs without any are left out.
+    :return: Dict of {image_id: [(roi, shapes)]} for every image, with the
+             ROIs in order of ID and the shapes as from roi.copyShapes()
+    """
+    shape_classes = None
+    if shape_types is not None:
+        shape_classes = tuple(getattr(omero.model, "%sI" % shape_type)
+                              for shape_type in shape_types)
+    unique_ids = list(dict.fromkeys(image_ids))
+    rois_by_image = dict((image_id, []) for image_id in unique_ids)
+    query_service = conn.getQueryService()
+    for start in range(0, len(unique_ids), page_size):
+        params = omero.sys.ParametersI()
+        params.add("ids", rlist([rlong(i) for i in
+                                 unique_ids[start:start + page_size]]))
+        rois = query_service.findAllByQuery(ROIS_QUERY, params,
+                                            conn.SERVICE_OPTS)
+        for roi in rois:
+            # shapes can be None in some situations
+            shapes = [shape for shape in roi.copyShapes()
+                      if shape is not None]
+            if shape_classes is not None:
+                shapes = [shape for shape in shapes
+                          if isinstance(shape, shape_classes)]
+                if not shapes:
+                    continue
+            rois_by_image[roi.getImage().getId().getValue()].append(
+                (roi, shapes))
+    for rois in rois_by_image.values():
+        # Sort by ROI.id (same as in iviewer)
+        rois.sort(key=lambda r: r[0].getId().getValue())
+    return rois_by_image
+
+
 def get_split_view(conn, image_ids, pixel_ids, split_indexes, channel_names,
                    merged_names, colour_channels, merged_indexes,
                    merged_colours, width, height, image_labels, spacer,
@@ -397,13 +441,13 @@ def get_split_view(conn, image_ids, pixel_ids, split_indexes, channel_names,
                      Doubled between rows.
     """
 
-    roi_service = conn.getRoiService()
+    rois_by_image = load_rois(conn, image_ids, ["Rectangle"])
     re = conn.createRenderingEngine()
     query_service = conn.getQueryService()    # only needed for movie
 
     # establish dimensions and roiZoom for the primary image
     # getTheseValues from the server
-    rect = get_rectangle(roi_service, image_ids[0], roi_label)
+    rect = get_rectangle(rois_by_image[image_ids[0]], roi_label)
     if rect is None:
         raise Exception("No ROI found for the first image.")
     roi_x, roi_y, roi_width, roi_height, y_min, y_max, t_min, t_max = rect
@@ -457,7 +501,7 @@ def get_split_view(conn, image_ids, pixel_ids, split_indexes, channel_names,
 
         # need to get the roi dimensions from the server
         image_id = image_ids[row]
-        roi = get_rectangle(roi_service, image_id, roi_label)
+        roi = get_rectangle(rois_by_image[image_id], roi_label)
         if roi is None:
             log("No Rectangle ROI found for this image")
             invalid_images.append(row)
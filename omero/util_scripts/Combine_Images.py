@@ -30,7 +30,7 @@ additional C, T, Z dimensions.
 # @since 3.0-Beta4.2
 
 import re
-from numpy import zeros
+import numpy
 
 import omero
 import omero.scripts as scripts
@@ -41,6 +41,12 @@ import omero.util.script_utils as script_utils
 
 COLOURS = script_utils.COLOURS
 
+# big-endian numpy types of the raw pixels
+PIXEL_TYPES = {'int8': 'i1', 'uint8': 'u1',
+               'int16': '>i2', 'uint16': '>u2',
+               'int32': '>i4', 'uint32': '>u4',
+               'float': '>f4', 'double': '>f8'}
+
 DEFAULT_T_REGEX = "_T"
 DEFAULT_Z_REGEX = "_Z"
 DEFAULT_C_REGEX = "_C"
@@ -77,11 +83,24 @@ def get_plane(raw_pixel_store, pixels, the_z, the_c, the_t):
                         If no path, saved in the current directory.
     """
 
-    # get the plane
+    # get the plane, as a view of the raw bytes
     pixels_id = pixels.getId().getValue()
     raw_pixel_store.setPixelsId(pixels_id, True)
-    return script_utils.download_plane(
-        raw_pixel_store, pixels, the_z, the_c, the_t)
+    raw_plane = raw_pixel_store.getPlane(the_z, the_c, the_t)
+    pixels_type = pixels.getPixelsType().getValue().getValue()
+    plane = numpy.frombuffer(raw_plane, PIXEL_TYPES[pixels_type])
+    return plane.reshape(pixels.getSizeY().getValue(),
+                         pixels.getSizeX().getValue())
+
+
+def upload_plane(raw_pixel_store, plane, pixels_type, the_z, the_c, the_t):
+    """
+    Uploads the numpy plane as the raw bytes of the pixels type. The plane
+    is only converted if it is not already of that type.
+    """
+    dtype = PIXEL_TYPES[pixels_type.getValue().getValue()]
+    raw_plane = numpy.ascontiguousarray(plane, dtype).tobytes()
+    raw_pixel_store.setPlane(raw_plane, the_z, the_c, the_t)
 
 
 def manually_assign_images(parameter_map, image_ids, source_z):
@@ -362,9 +381,9 @@ def make_single_image(services, parameter_map, image_ids, dataset, colour_map):
                     pixel_sizes['x'].append(pixels.getPhysicalSizeX())
                     pixel_sizes['y'].append(pixels.getPhysicalSizeY())
                 else:
-                    plane_2d = zeros((size_y, size_x))
-                script_utils.upload_plane(raw_pixel_store_upload,
-                                          plane_2d, the_z, the_c, the_t)
+                    plane_2d = numpy.zeros((size_y, size_x))
+                upload_plane(raw_pixel_store_upload, plane_2d, pixels_type,
+                             the_z, the_c, the_t)
                 min_value = min(min_value, plane_2d.min())
                 max_value = max(max_value, plane_2d.max())
         pixels_service.setChannelGlobalMinMax(pixels_id, the_c,
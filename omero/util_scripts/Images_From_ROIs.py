@@ -32,13 +32,18 @@ images with the regions within the ROIs, and saves them back to the server.
 import omero
 import omero.scripts as scripts
 from omero.gateway import BlitzGateway
-from omero.rtypes import rstring, rlong, robject, unwrap
+from omero.rtypes import rstring, rlong, robject, unwrap, rlist
 import omero.util.script_utils as script_utils
 from omero.util.tiles import TileLoopIteration, RPSTileLoop
 from omero.model import PixelsI
 
 import os
 
+ROIS_QUERY = ("select distinct roi from Roi roi"
+              " join fetch roi.shapes shape"
+              " left outer join fetch shape.transform"
+              " where roi.image.id in (:ids)")
+
 
 def create_image_from_tiles(conn, source, image_name, description,
                             box, tile_size):
@@ -121,24 +126,23 @@ def create_image_from_tiles(conn, source, image_name, description,
     return new_image
 
 
-def get_rectangles(conn, image_id):
+def get_rectangles(image_rois):
     """
     Returns a list of (x, y, width, height, zStart, zStop, tStart, tStop)
     of each rectange ROI in the image
+
+    :param image_rois: List of (roi, shapes) of the image, from load_rois()
     """
 
     rois = []
 
-    roi_service = conn.getRoiService()
-    result = roi_service.findByImage(image_id, None)
-
-    for roi in result.rois:
+    for roi, shapes in image_rois:
         width = None
         z_indexes = []
         t_indexes = []
         # note x and y for every T, to track moving object
         xy_by_time = {}
-        for shape in roi.copyShapes():
+        for shape in shapes:
             if isinstance(shape, omero.model.RectangleI):
                 # check t range and z range for every rectangle
                 # t and z (and c) for shape is optional
@@ -169,7 +173,7 @@ def get_rectangles(conn, image_id):
     return rois
 
 
-def process_image(conn, image_id, parameter_map):
+def process_image(conn, image_id, parameter_map, image_rois):
     """
     Process an image.
     If imageStack is True, we make a Z-stack using one tile from each ROI
@@ -177,6 +181,8 @@ def process_image(conn, image_id, parameter_map):
     Otherwise, we create a 5D image representing the ROI "cropping" the
     original image
     Image is put in a dataset if specified.
+
+    :param image_rois: List of (roi, shapes) of the image, from load_rois()
     """
 
     image_stack = parameter_map['Make_Image_Stack']
@@ -197,7 +203,7 @@ def process_image(conn, image_id, parameter_map):
     pixels = image.getPrimaryPixels()
 
     # x, y, w, h, zStart, zEnd, tStart, tEnd
-    rois = get_rectangles(conn, image_id)
+    rois = get_rectangles(image_rois)
 
     img_w = image.getSizeX()
     img_h = image.getSizeY()
@@ -369,6 +375,46 @@ def process_image(conn, image_id, parameter_map):
         return images, dataset, link
 
 
+def load_rois(conn, image_ids, shape_types=None, page_size=500):
+    """
+    Loads the ROIs of the images, for page_size images per query.
+
+    :param image_ids: IDs of the images
+    :param shape_types: E.g. ["Rectangle"] or ["Line", "Polyline"] to only
+                        keep these shapes. ROIs without any are left out.
+    :return: Dict of {image_id: [(roi, shapes)]} for every image, with the
+             ROIs in order of ID and the shapes as from roi.copyShapes()
+    """
+    shape_classes = None
+    if shape_types is not None:
+        shape_classes = tuple(getattr(omero.model, "%sI" % shape_type)
+                              for shape_type in shape_types)
+    unique_ids = list(dict.fromkeys(image_ids))
+    rois_by_image = dict((image_id, []) for image_id in unique_ids)
+    query_service = conn.getQueryService()
+    for start in range(0, len(unique_ids), page_size):
+        params = omero.sys.ParametersI()
+        params.add("ids", rlist([rlong(i) for i in
+                                 unique_ids[start:start + page_size]]))
+        rois = query_service.findAllByQuery(ROIS_QUERY, params,
+                                            conn.SERVICE_OPTS)
+        for roi in rois:
+            # shapes can be None in some situations
+            shapes = [shape for shape in roi.copyShapes()
+                      if shape is not None]
+            if shape_classes is not None:
+                shapes = [shape for shape in shapes
+                          if isinstance(shape, shape_classes)]
+                if not shapes:
+                    continue
+            rois_by_image[roi.getImage().getId().getValue()].append(
+                (roi, shapes))
+    for rois in rois_by_image.values():
+        # Sort by ROI.id (same as in iviewer)
+        rois.sort(key=lambda r: r[0].getId().getValue())
+    return rois_by_image
+
+
 def make_images_from_rois(conn, parameter_map):
     """
     Processes the list of Image_IDs, either making a new image-stack or a new
@@ -395,7 +441,9 @@ def make_images_from_rois(conn, parameter_map):
             images += ds.listChildren()
 
     # Check for rectangular ROIs and filter images list
-    images = [image for image in images if image.getROICount("Rectangle") > 0]
+    rois_by_image = load_rois(conn, [i.getId() for i in images],
+                              ["Rectangle"])
+    images = [image for image in images if rois_by_image[image.getId()]]
     if not images:
         message += "No rectangle ROI found."
         return None, message
@@ -405,7 +453,8 @@ def make_images_from_rois(conn, parameter_map):
     new_datasets = []
     links = []
     for iid in image_ids:
-        new_image, new_dataset, link = process_image(conn, iid, parameter_map)
+        new_image, new_dataset, link = process_image(conn, iid, parameter_map,
+                                                     rois_by_image[iid])
         if new_image is not None:
             if isinstance(new_image, list):
                 new_images.extend(new_image)
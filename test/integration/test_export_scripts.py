@@ -23,14 +23,24 @@
    Integration test for export scripts.
 """
 
+import os
+import shutil
+import subprocess
+import zipfile
+from io import BytesIO
+
+import numpy
 import pytest
 import omero
 import omero.scripts
+import omero.export_scripts.Batch_Image_Export as image_export
+from omero.gateway import BlitzGateway
 from script import ScriptTest
 from script import run_script
 from script import check_file_annotation
 from script import get_file_contents
 from omero.rtypes import rstring, rint, rlong, rlist, rdouble, rbool
+from PIL import Image
 
 
 batch_image_export = "/omero/export_scripts/Batch_Image_Export.py"
@@ -38,6 +48,31 @@ batch_roi_export = "/omero/export_scripts/Batch_ROI_Export.py"
 make_movie = "/omero/export_scripts/Make_Movie.py"
 
 
+def get_file_data(client, file_annotation):
+    """Returns the contents of the file of the File Annotation as bytes."""
+    conn = BlitzGateway(client_obj=client)
+    orig_file = conn.getObject("OriginalFile",
+                               file_annotation.getValue().getFile().id.val)
+    data = b"".join(orig_file.getFileInChunks())
+    conn.close()
+    return data
+
+
+def get_zip_file(client, file_annotation):
+    """Returns the zip file of the File Annotation, read into memory."""
+    return zipfile.ZipFile(BytesIO(get_file_data(client, file_annotation)))
+
+
+def get_tiff_plane(tifffile, data, z, c, t):
+    """Returns the plane of an OME-TIFF, read with tifffile."""
+    with tifffile.TiffFile(BytesIO(data)) as tif:
+        series = tif.series[0]
+        planes = series.asarray()
+    # tifffile drops the dimensions of size 1
+    index = dict(Z=z, C=c, T=t)
+    return planes[tuple(index[axis] for axis in series.axes[:-2])]
+
+
 class TestExportScripts(ScriptTest):
 
     def test_batch_image_export(self):
@@ -57,8 +92,300 @@ class TestExportScripts(ScriptTest):
         c = self.new_client(user=user)
         check_file_annotation(c, ann)
 
+    def test_batch_image_export_max_workers(self):
+        sid = super(TestExportScripts, self).get_script(batch_image_export)
+        assert sid > 0
+
+        client, user = self.new_client_and_user()
+        # x,y,z,c,t
+        image = self.create_test_image(100, 100, 3, 2, 2, client.getSession())
+        image_ids = []
+        image_ids.append(rlong(image.id.val))
+        args = {
+            "Data_Type": rstring("Image"),
+            "IDs": rlist(image_ids),
+            "Choose_Z_Section": rstring("ALL Z planes"),
+            "Choose_T_Section": rstring("ALL T planes")
+        }
+        planes = {}
+        for max_workers in [1, 3]:
+            args["Max_Workers"] = rint(max_workers)
+            ann = run_script(client, sid, args, "File_Annotation")
+            c = self.new_client(user=user)
+            check_file_annotation(c, ann)
+            with get_zip_file(self.new_client(user=user), ann) as zip_file:
+                planes[max_workers] = dict(
+                    (name, zip_file.read(name))
+                    for name in zip_file.namelist() if name.endswith(".jpg"))
+        # merged and 2 channels, for each Z and T
+        assert len(planes[3]) == 3 * 3 * 2
+        # the same files, with the same names, as with a single worker
+        assert planes[3] == planes[1]
+
+    def test_batch_image_export_ome_tiff_workers(self):
+        sid = super(TestExportScripts, self).get_script(batch_image_export)
+        assert sid > 0
+
+        client, user = self.new_client_and_user()
+        image_ids = []
+        for i in range(3):
+            # x,y,z,c,t
+            image = self.create_test_image(100, 100, 2, 2, 1,
+                                           client.getSession())
+            image_ids.append(rlong(image.id.val))
+        args = {
+            "Data_Type": rstring("Image"),
+            "IDs": rlist(image_ids),
+            "Format": rstring("OME-TIFF"),
+            "Max_Workers": rint(2),
+            "Block_Size_KB": rint(64)
+        }
+        ann = run_script(client, sid, args, "File_Annotation")
+        c = self.new_client(user=user)
+        check_file_annotation(c, ann)
+        with get_zip_file(self.new_client(user=user), ann) as zip_file:
+            names = zip_file.namelist()
+            # names are given in the order of the images
+            tiff_names = ["testImage.ome.tif", "testImage_(1).ome.tif",
+                          "testImage_(2).ome.tif"]
+            assert sorted(names) == sorted(tiff_names +
+                                           [image_export.LOG_NAME])
+            tiffs = [zip_file.read(name) for name in tiff_names]
+
+        tifffile = pytest.importorskip("tifffile")
+        conn = BlitzGateway(client_obj=c)
+        for image_id, data in zip(image_ids, tiffs):
+            pixels = conn.getObject("Image", image_id.val).getPrimaryPixels()
+            assert (get_tiff_plane(tifffile, data, 1, 1, 0) ==
+                    pixels.getPlane(1, 1, 0)).all()
+        conn.close()
+
+    def test_batch_image_export_tiled_ome_tiff(self):
+        tifffile = pytest.importorskip("tifffile")
+        sid = super(TestExportScripts, self).get_script(batch_image_export)
+        assert sid > 0
+
+        client, user = self.new_client_and_user()
+        # a 'Big' image, with a pyramid
+        image = self.import_fake_file(name="big", client=client,
+                                      sizeX=4096, sizeY=4096,
+                                      resolutions=3)[0]
+        args = {
+            "Data_Type": rstring("Image"),
+            "IDs": rlist([rlong(image.id.val)]),
+            "Format": rstring("OME-TIFF")
+        }
+        ann = run_script(client, sid, args, "File_Annotation")
+        c = self.new_client(user=user)
+        check_file_annotation(c, ann)
+
+        conn = BlitzGateway(client_obj=c)
+        omero_image = conn.getObject("Image", image.id.val)
+        tiff_name = "%s.ome.tif" % os.path.basename(omero_image.getName())
+        with get_zip_file(self.new_client(user=user), ann) as zip_file:
+            names = zip_file.namelist()
+            assert sorted(names) == sorted([tiff_name,
+                                            image_export.LOG_NAME])
+            data = zip_file.read(tiff_name)
+        with tifffile.TiffFile(BytesIO(data)) as tif:
+            series = tif.series[0]
+            assert series.shape == (4096, 4096)
+            # smaller resolution levels
+            assert len(series.levels) > 1
+            plane = series.asarray()
+        tile = omero_image.getPrimaryPixels().getTile(
+            0, 0, 0, tile=(1000, 2000, 512, 256))
+        assert (plane[2000:2256, 1000:1512] == tile).all()
+        conn.close()
+
+    @pytest.mark.parametrize("zoom", ["25%", "50%", "200%"])
+    def test_batch_image_export_zoom(self, zoom):
+        sid = super(TestExportScripts, self).get_script(batch_image_export)
+        assert sid > 0
+
+        client, user = self.new_client_and_user()
+        # x,y,z,c,t
+        image = self.create_test_image(100, 100, 1, 2, 1, client.getSession())
+        image_ids = []
+        image_ids.append(rlong(image.id.val))
+        args = {
+            "Data_Type": rstring("Image"),
+            "IDs": rlist(image_ids),
+            "Zoom": rstring(zoom)
+        }
+        ann = run_script(client, sid, args, "File_Annotation")
+        c = self.new_client(user=user)
+        check_file_annotation(c, ann)
+        size = 100 * int(zoom[:-1]) // 100
+        with get_zip_file(self.new_client(user=user), ann) as zip_file:
+            names = [name for name in zip_file.namelist()
+                     if name.endswith(".jpg")]
+            # merged and 2 channels
+            assert len(names) == 3
+            for name in names:
+                plane = Image.open(BytesIO(zip_file.read(name)))
+                assert plane.size == (size, size)
+
+    @pytest.mark.parametrize("projection", ["Max projection",
+                                            "Mean projection",
+                                            "Sum projection"])
+    @pytest.mark.parametrize("z_step", [1, 2])
+    def test_batch_image_export_projection(self, projection, z_step):
+        sid = super(TestExportScripts, self).get_script(batch_image_export)
+        assert sid > 0
+
+        client, user = self.new_client_and_user()
+        # x,y,z,c,t
+        image = self.create_test_image(100, 100, 5, 2, 1, client.getSession())
+        image_ids = []
+        image_ids.append(rlong(image.id.val))
+        args = {
+            "Data_Type": rstring("Image"),
+            "IDs": rlist(image_ids),
+            "Individual_Channels_Grey": rbool(True),
+            "Choose_Z_Section": rstring(projection),
+            "OR_specify_Z_start_AND...": rint(2),
+            "...specify_Z_end": rint(5),
+            "Projection_Step": rint(z_step),
+            "Format": rstring("PNG")
+        }
+        ann = run_script(client, sid, args, "File_Annotation")
+        c = self.new_client(user=user)
+        check_file_annotation(c, ann)
+        with get_zip_file(self.new_client(user=user), ann) as zip_file:
+            names = [name for name in zip_file.namelist()
+                     if name.endswith(".png")]
+            # merged and 2 channels, for the projected Z-range
+            assert len(names) == 3
+            assert all("_z02-06_" in name for name in names)
+            name = [name for name in names if "_c00_" in name][0]
+            plane = numpy.asarray(Image.open(BytesIO(zip_file.read(name))))
+
+        # the first channel, in grey, with the channel's window
+        conn = BlitzGateway(client_obj=c)
+        omero_image = conn.getObject("Image", image.id.val)
+        pixels = omero_image.getPrimaryPixels()
+        planes = [pixels.getPlane(z, 0, 0) for z in range(1, 5, z_step)]
+        if projection == "Max projection":
+            expected = numpy.max(planes, axis=0)
+        elif projection == "Mean projection":
+            expected = numpy.mean(planes, axis=0)
+        else:
+            expected = numpy.sum(planes, axis=0)
+        channel = omero_image.getChannels()[0]
+        start = channel.getWindowStart()
+        end = channel.getWindowEnd()
+        if projection == "Sum projection":
+            # the window is scaled by the number of planes
+            start *= len(planes)
+            end *= len(planes)
+        expected = (expected - start) / (end - start) * 255
+        # the projection is within the window, not saturated
+        assert expected.min() >= 0 and expected.max() <= 255
+        assert numpy.abs(plane[:, :, 0] - expected).max() <= 1
+        conn.close()
+
+    def test_batch_image_export_ome_zarr(self, tmp_path):
+        zarr = pytest.importorskip("zarr")
+        sid = super(TestExportScripts, self).get_script(batch_image_export)
+        assert sid > 0
+
+        client, user = self.new_client_and_user()
+        # x,y,z,c,t
+        image = self.create_test_image(100, 100, 2, 2, 1, client.getSession())
+        args = {
+            "Data_Type": rstring("Image"),
+            "IDs": rlist([rlong(image.id.val)]),
+            "Format": rstring("OME-Zarr")
+        }
+        ann = run_script(client, sid, args, "File_Annotation")
+        c = self.new_client(user=user)
+        check_file_annotation(c, ann)
+
+        with get_zip_file(self.new_client(user=user), ann) as zip_file:
+            names = zip_file.namelist()
+            zip_file.extractall(str(tmp_path))
+        zarr_name = [name for name in names if name.endswith(".zarr/.zattrs")]
+        assert len(zarr_name) == 1
+        zarr_name = zarr_name[0].split("/")[0]
+        assert "%s/0/.zarray" % zarr_name in names
+
+        root = zarr.open_group(str(tmp_path / zarr_name), mode="r")
+        multiscales = root.attrs["multiscales"]
+        assert multiscales[0]["datasets"][0]["path"] == "0"
+        assert root.attrs["omero"]["channels"]
+        array = root["0"]
+        # t,c,z,y,x
+        assert array.shape == (1, 2, 2, 100, 100)
+        conn = BlitzGateway(client_obj=c)
+        pixels = conn.getObject("Image", image.id.val).getPrimaryPixels()
+        for the_c in range(2):
+            for the_z in range(2):
+                plane = pixels.getPlane(the_z, the_c, 0)
+                assert (array[0, the_c, the_z] == plane).all()
+        conn.close()
+
+    @pytest.mark.parametrize("change_settings", [False, True])
+    def test_batch_image_export_resume(self, change_settings, tmp_path,
+                                       monkeypatch):
+        client, user = self.new_client_and_user()
+        conn = BlitzGateway(client_obj=client)
+        image_ids = []
+        for i in range(3):
+            # x,y,z,c,t
+            image = self.create_test_image(100, 100, 1, 2, 1,
+                                           client.getSession())
+            image_ids.append(image.id.val)
+        script_params = {
+            "Data_Type": "Image",
+            "IDs": image_ids,
+            "Export_Individual_Channels": True,
+            "Individual_Channels_Grey": False,
+            "Export_Merged_Image": True,
+            "Format": "PNG",
+            "Folder_Name": "Batch_Image_Export"
+        }
+        monkeypatch.chdir(tmp_path)
+        # checkpoint after each image
+        monkeypatch.setattr(image_export, "CHECKPOINT_INTERVAL", 0)
+
+        # 3 files per image: interrupt the export after the first file of
+        # the third image, written after the last checkpoint
+        add_to_zip = image_export.add_to_zip
+        added = []
+
+        def interrupted_add_to_zip(sink, name, *args, **kwargs):
+            add_to_zip(sink, name, *args, **kwargs)
+            added.append(name)
+            if len(added) == 7:
+                raise RuntimeError("Export interrupted")
+        monkeypatch.setattr(image_export, "add_to_zip",
+                            interrupted_add_to_zip)
+        with pytest.raises(RuntimeError):
+            image_export.batch_image_export(conn, script_params)
+
+        if change_settings:
+            image = conn.getObject("Image", image_ids[0])
+            image.setActiveChannels([1, 2], windows=[[0, 10], [0, 10]])
+            image.saveDefaults()
+        del added[:]
+        ann, message = image_export.batch_image_export(conn, script_params)
+        # only the third image, and the first if its settings changed
+        assert len(added) == (6 if change_settings else 3)
+
+        data = b"".join(ann.getFileInChunks())
+        with zipfile.ZipFile(BytesIO(data)) as zip_file:
+            names = zip_file.namelist()
+            assert zip_file.testzip() is None
+        # 9 planes and the log
+        assert len(names) == 10
+        assert len(set(names)) == 10
+        conn.close()
+
+    @pytest.mark.parametrize("stats_engine", ["Server", "Local"])
+    @pytest.mark.parametrize("max_workers", [1, 2])
     @pytest.mark.parametrize("all_planes", [True, False])
-    def test_batch_roi_export(self, all_planes):
+    def test_batch_roi_export(self, all_planes, max_workers, stats_engine):
         sid = super(TestExportScripts, self).get_script(batch_roi_export)
         assert sid > 0
 
@@ -102,7 +429,9 @@ class TestExportScripts(ScriptTest):
             # Should ignore Channels out of range. 1-based index
             "Channels": rlist(channels),
             "Export_All_Planes": rbool(all_planes),
-            "File_Name": rstring(file_name)
+            "File_Name": rstring(file_name),
+            "Max_Workers": rint(max_workers),
+            "Stats_Engine": rstring(stats_engine)
         }
         ann = run_script(client, sid, args, "File_Annotation")
         c = self.new_client(user=user)
@@ -117,7 +446,7 @@ class TestExportScripts(ScriptTest):
             polygon_planes = size_c * size_z * size_t
         # Rows: Header + rect with Z/T set + polygon without Z/T
         row_count = 1 + size_c + polygon_planes
-        assert len(csv_text.split("\n")) == row_count
+        assert len(csv_text.splitlines()) == row_count
 
         # Check first 2 rows of csv (except Std dev)
         zt = ","
@@ -130,16 +459,237 @@ class TestExportScripts(ScriptTest):
                     "z,t,channel,area (pixels),length (pixels),"
                     "points,min,max,sum,mean,std_dev,"
                     "X,Y,Width,Height,RadiusX,RadiusY,X1,Y1,X2,Y2,Points\n"
-                    "%s,\"%s\",%s,%s,polygon,\"%s\",%s,0,%s,,%s,") % (
+                    "%s,%s,%s,%s,polygon,%s,%s,0,%s,,%s,") % (
             image.id.val, image_name, roi.id.val,
             polygon.id.val, label_text, zt, area, points_min_max_sum_mean)
         assert csv_text.startswith(expected)
 
+    def test_batch_roi_export_omero_table(self):
+        sid = super(TestExportScripts, self).get_script(batch_roi_export)
+        assert sid > 0
+
+        client, user = self.new_client_and_user()
+        session = client.getSession()
+        size_c = 2
+        image = self.create_test_image(100, 100, 1, size_c, 1, session,
+                                       name="ROI_image")
+        rect = omero.model.RectangleI()
+        rect.x = rdouble(10)
+        rect.y = rdouble(10)
+        rect.width = rdouble(81)
+        rect.height = rdouble(81)
+        roi = omero.model.RoiI()
+        roi.setImage(image)
+        roi.addShape(rect)
+        session.getUpdateService().saveAndReturnObject(roi)
+
+        file_name = "test_batch_roi_export"
+        args = {
+            "Data_Type": rstring("Image"),
+            "IDs": rlist([rlong(image.id.val)]),
+            "Channels": rlist([rint(c) for c in range(1, size_c + 1)]),
+            "Export_All_Planes": rbool(True),
+            "File_Name": rstring(file_name),
+            "Output_Format": rstring("OMERO.table")
+        }
+        ann = run_script(client, sid, args, "File_Annotation")
+        c = self.new_client(user=user)
+        check_file_annotation(c, ann, file_name="%s.h5" % file_name)
+        assert ann.getValue().getNs().getValue() == \
+            omero.constants.namespaces.NSBULKANNOTATIONS
+
+        orig_file = ann.getValue().getFile()
+        table = c.sf.sharedResources().openTable(orig_file)
+        try:
+            headers = [h.name for h in table.getHeaders()]
+            assert headers[:5] == ["image_id", "image_name", "roi_id",
+                                   "shape_id", "type"]
+            assert "area (pixels)" in headers
+            assert "Points" not in headers
+            # One row for each channel
+            assert table.getNumberOfRows() == size_c
+            data = table.readCoordinates([0])
+            points = data.columns[headers.index("points")].values
+            assert points == [6561]
+        finally:
+            table.close()
+
+    def test_batch_roi_export_parquet(self):
+        pyarrow = pytest.importorskip("pyarrow")
+        parquet = pytest.importorskip("pyarrow.parquet")
+        sid = super(TestExportScripts, self).get_script(batch_roi_export)
+        assert sid > 0
+
+        client, user = self.new_client_and_user()
+        session = client.getSession()
+        size_c = 2
+        size_z = 3
+        image = self.create_test_image(100, 100, size_z, size_c, 1, session,
+                                       name="ROI_image")
+        rect = omero.model.RectangleI()
+        rect.x = rdouble(10)
+        rect.y = rdouble(10)
+        rect.width = rdouble(81)
+        rect.height = rdouble(81)
+        roi = omero.model.RoiI()
+        roi.setImage(image)
+        roi.addShape(rect)
+        session.getUpdateService().saveAndReturnObject(roi)
+
+        file_name = "test_batch_roi_export"
+        args = {
+            "Data_Type": rstring("Image"),
+            "IDs": rlist([rlong(image.id.val)]),
+            "Channels": rlist([rint(c) for c in range(1, size_c + 1)]),
+            "Export_All_Planes": rbool(True),
+            "File_Name": rstring(file_name),
+            "Output_Format": rstring("Parquet")
+        }
+        ann = run_script(client, sid, args, "File_Annotation")
+        c = self.new_client(user=user)
+        check_file_annotation(c, ann, file_name="%s.parquet" % file_name)
+
+        data = get_file_data(self.new_client(user=user), ann)
+        table = parquet.read_table(BytesIO(data))
+        assert table.column_names[:5] == ["image_id", "image_name", "roi_id",
+                                          "shape_id", "type"]
+        assert "area (pixels)" in table.column_names
+        assert "Points" not in table.column_names
+        assert table.schema.field("image_id").type == pyarrow.int64()
+        assert table.schema.field("image_name").type == pyarrow.string()
+        assert table.schema.field("mean").type == pyarrow.float64()
+        # One row for each plane and channel
+        assert table.num_rows == size_z * size_c
+        rows = table.to_pylist()
+        assert set(row["z"] for row in rows) == set(range(1, size_z + 1))
+        assert all(row["image_name"] == "ROI_image" for row in rows)
+        assert all(row["points"] == 6561 for row in rows)
+        # the first channel has the value y at each pixel
+        assert rows[0]["min"] == 10.0
+        assert rows[0]["max"] == 90.0
+        assert rows[0]["mean"] == 50.0
+
+    def test_batch_roi_export_incremental(self):
+        sid = super(TestExportScripts, self).get_script(batch_roi_export)
+        assert sid > 0
+
+        client, user = self.new_client_and_user()
+        session = client.getSession()
+        images = [self.create_test_image(100, 100, 1, 1, 1, session)
+                  for i in range(2)]
+
+        def add_rectangle(image):
+            rect = omero.model.RectangleI()
+            rect.x = rdouble(10)
+            rect.y = rdouble(10)
+            rect.width = rdouble(81)
+            rect.height = rdouble(81)
+            roi = omero.model.RoiI()
+            roi.setImage(image)
+            roi.addShape(rect)
+            session.getUpdateService().saveAndReturnObject(roi)
+
+        for image in images:
+            add_rectangle(image)
+        args = {
+            "Data_Type": rstring("Image"),
+            "IDs": rlist([rlong(image.id.val) for image in images]),
+            "Export_All_Planes": rbool(True),
+            "File_Name": rstring("test_batch_roi_export"),
+            "Incremental": rbool(True)
+        }
+        ann = run_script(client, sid, args, "File_Annotation")
+        file_id = ann.getValue().getFile().id.val
+        first = get_file_contents(self.new_client(user=user), file_id)
+        assert len(first.splitlines()) == 3
+
+        # Unchanged images keep their rows
+        ann = run_script(client, sid, args, "File_Annotation")
+        file_id = ann.getValue().getFile().id.val
+        second = get_file_contents(self.new_client(user=user), file_id)
+        assert second == first
+
+        # The changed image gets a row for the new shape
+        add_rectangle(images[1])
+        ann = run_script(client, sid, args, "File_Annotation")
+        file_id = ann.getValue().getFile().id.val
+        third = get_file_contents(self.new_client(user=user), file_id)
+        lines = third.splitlines()
+        assert len(lines) == 4
+        assert lines[:2] == first.splitlines()[:2]
+        assert all(line.startswith("%s," % images[1].id.val)
+                   for line in lines[2:])
+
+        # The renamed image gets a row with its new name
+        image = session.getQueryService().get("Image", images[0].id.val)
+        image.setName(rstring("renamed"))
+        session.getUpdateService().saveObject(image)
+        ann = run_script(client, sid, args, "File_Annotation")
+        file_id = ann.getValue().getFile().id.val
+        fourth = get_file_contents(self.new_client(user=user), file_id)
+        lines = fourth.splitlines()
+        assert len(lines) == 4
+        renamed = [line for line in lines
+                   if line.startswith("%s," % images[0].id.val)]
+        assert len(renamed) == 1
+        assert renamed[0].startswith('%s,renamed,' % images[0].id.val)
+        assert set(lines) - set(renamed) == \
+            set(third.splitlines()) - set([first.splitlines()[1]])
+
+    @pytest.mark.skipif(shutil.which("ffmpeg") is None or
+                        shutil.which("ffprobe") is None,
+                        reason="ffmpeg is not installed")
+    @pytest.mark.parametrize("format", ["MJPEG", "H.264"])
+    def test_make_movie_ffmpeg(self, format, tmp_path):
+        script_id = super(TestExportScripts, self).get_script(make_movie)
+        assert script_id > 0
+
+        client, user = self.new_client_and_user()
+        image_ids = []
+        for i in range(2):
+            # x,y,z,c,t
+            image = self.create_test_image(10, 10, 1, 1, 3,
+                                           client.getSession())
+            image_ids.append(rlong(image.id.val))
+        # settings of the first image. The second uses its own
+        params = omero.sys.ParametersI()
+        params.addId(image_ids[0].val)
+        rdef = client.sf.getQueryService().findAllByQuery(
+            "select r from RenderingDef r where r.pixels.image.id = :id",
+            params)[0]
+        args = {
+            "Data_Type": rstring("Image"),
+            "IDs": rlist(image_ids),
+            "RenderingDef_ID": rlong(rdef.id.val),
+            "Movie_Name": rstring("test_make_movie_ffmpeg"),
+            "Format": rstring(format),
+            "FPS": rint(4),
+            "Concatenate": rbool(True)
+        }
+        ann = run_script(client, script_id, args, "File_Annotation")
+        c = self.new_client(user=user)
+        check_file_annotation(c, ann)
+
+        movie = tmp_path / "movie"
+        movie.write_bytes(get_file_data(self.new_client(user=user), ann))
+        output = subprocess.run(
+            ["ffprobe", "-v", "error", "-count_frames",
+             "-select_streams", "v:0",
+             "-show_entries", "stream=nb_read_frames,r_frame_rate",
+             "-of", "default=noprint_wrappers=1", str(movie)],
+            stdout=subprocess.PIPE, universal_newlines=True,
+            check=True).stdout.split()
+        # the 3 timepoints of both images
+        assert "nb_read_frames=6" in output
+        assert "r_frame_rate=4/1" in output
+
     @pytest.mark.broken(
         reason=('https://trello.com/c/AlN5hp6g/144-make-movie-tests-failures'))
     @pytest.mark.xfail(
         reason=('https://trello.com/c/AlN5hp6g/144-make-movie-tests-failures'))
-    def test_make_movie(self):
+    @pytest.mark.parametrize("max_workers", [1, 3])
+    @pytest.mark.parametrize("format", ["Quicktime", "H.264"])
+    def test_make_movie(self, format, max_workers):
         script_id = super(TestExportScripts, self).get_script(make_movie)
         assert script_id > 0
 
@@ -151,7 +701,35 @@ class TestExportScripts(ScriptTest):
         args = {
             "Data_Type": rstring("Image"),
             "IDs": rlist(image_ids),
-            "Movie_Name": rstring("test_make_movie")
+            "Movie_Name": rstring("test_make_movie"),
+            "Format": rstring(format),
+            "Max_Workers": rint(max_workers)
+        }
+        ann = run_script(client, script_id, args, "File_Annotation")
+        c = self.new_client(user=user)
+        check_file_annotation(c, ann)
+
+    @pytest.mark.broken(
+        reason=('https://trello.com/c/AlN5hp6g/144-make-movie-tests-failures'))
+    @pytest.mark.xfail(
+        reason=('https://trello.com/c/AlN5hp6g/144-make-movie-tests-failures'))
+    @pytest.mark.parametrize("concatenate", [False, True])
+    def test_make_movie_images(self, concatenate):
+        script_id = super(TestExportScripts, self).get_script(make_movie)
+        assert script_id > 0
+
+        client, user = self.new_client_and_user()
+        image_ids = []
+        for i in range(2):
+            # x,y,z,c,t
+            image = self.create_test_image(10, 10, 1, 1, 2,
+                                           client.getSession())
+            image_ids.append(rlong(image.id.val))
+        args = {
+            "Data_Type": rstring("Image"),
+            "IDs": rlist(image_ids),
+            "Movie_Name": rstring("test_make_movie_images"),
+            "Concatenate": rbool(concatenate)
         }
         ann = run_script(client, script_id, args, "File_Annotation")
         c = self.new_client(user=user)
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+   Test of the conversion of raw planes to and from numpy arrays
+   Copyright 2021 Open Microscopy Environment. All rights reserved.
+   Use is subject to license terms supplied in LICENSE.txt
+"""
+
+import os
+import timeit
+from struct import pack, unpack
+
+import numpy
+import pytest
+
+from omero.export_scripts.Batch_Image_Export import from_raw, \
+    get_dtype, get_raw_plane, get_raw_tile
+from omero.util_scripts.Combine_Images import get_plane, upload_plane
+
+# struct formats of the pixels types
+STRUCT_TYPES = {'int8': 'b', 'uint8': 'B', 'int16': 'h', 'uint16': 'H',
+                'int32': 'i', 'uint32': 'I', 'float': 'f', 'double': 'd'}
+
+
+class Value(object):
+    """An omero.model object or rtype with a value, e.g. a PixelsType."""
+
+    def __init__(self, value):
+        self.value = value
+
+    def getValue(self):
+        return self.value
+
+
+class Pixels(object):
+
+    def __init__(self, pixels_type, size_x, size_y):
+        self.pixels_type = Value(Value(pixels_type))
+        self.size_x = size_x
+        self.size_y = size_y
+
+    def getId(self):
+        return Value(1)
+
+    def getPixelsType(self):
+        return self.pixels_type
+
+    def getSizeX(self):
+        return Value(self.size_x)
+
+    def getSizeY(self):
+        return Value(self.size_y)
+
+
+class RawStore(object):
+    """Raw Pixels Store of one plane, of rows of size_x pixels."""
+
+    def __init__(self, data, size_x, pixel_size):
+        self.data = data
+        self.size_x = size_x
+        self.pixel_size = pixel_size
+
+    def setPixelsId(self, pixels_id, bypass):
+        pass
+
+    def getPlane(self, z, c, t):
+        return self.data
+
+    def setPlane(self, data, z, c, t):
+        self.data = data
+
+    def getTile(self, z, c, t, x, y, w, h):
+        size = self.pixel_size
+        rows = [self.data[(row * self.size_x + x) * size:
+                          (row * self.size_x + x + w) * size]
+                for row in range(y, y + h)]
+        return b"".join(rows)
+
+
+def get_raw_data(pixels_type, values):
+    return pack('>%s%s' % (len(values), STRUCT_TYPES[pixels_type]), *values)
+
+
+def struct_download(raw_plane, pixels_type, size_x, size_y):
+    """As script_utils.download_plane(), with struct"""
+    convert_type = '>' + str(size_x * size_y) + STRUCT_TYPES[pixels_type]
+    converted_plane = unpack(convert_type, raw_plane)
+    remapped_plane = numpy.array(converted_plane,
+                                 dtype=get_dtype(pixels_type))
+    remapped_plane.resize(size_y, size_x)
+    return remapped_plane
+
+
+class TestRawPlanes(object):
+
+    @pytest.mark.parametrize("pixels_type", sorted(STRUCT_TYPES))
+    def test_from_raw(self, pixels_type):
+        size_x, size_y = 7, 5
+        values = list(range(size_x * size_y))
+        data = get_raw_data(pixels_type, values)
+        plane = from_raw(data, pixels_type, size_x, size_y)
+        assert plane.shape == (size_y, size_x)
+        assert plane.tolist() == numpy.reshape(values, (size_y, size_x))\
+            .tolist()
+        # a view of the bytes, not a copy
+        assert not plane.flags.owndata
+        assert not plane.flags.writeable
+        assert numpy.array_equal(
+            plane, struct_download(data, pixels_type, size_x, size_y))
+
+    def test_bit(self):
+        plane = numpy.array([[1, 0, 1], [1, 1, 0], [0, 0, 1]], numpy.uint8)
+        data = bytes([0b10111000, 0b10000000])
+        assert numpy.array_equal(from_raw(data, "bit", 3, 3), plane)
+
+    def test_get_raw_tile(self):
+        size_x, size_y = 6, 4
+        values = list(range(size_x * size_y))
+        plane = numpy.reshape(values, (size_y, size_x))
+        raw_store = RawStore(get_raw_data("uint16", values), size_x, 2)
+        assert numpy.array_equal(
+            get_raw_plane(raw_store, "uint16", size_x, size_y, 0, 0, 0),
+            plane)
+        assert numpy.array_equal(
+            get_raw_tile(raw_store, "uint16", 0, 0, 0, 2, 1, 3, 2),
+            plane[1:3, 2:5])
+
+    @pytest.mark.parametrize("pixels_type", sorted(STRUCT_TYPES))
+    def test_combine_images_planes(self, pixels_type):
+        size_x, size_y = 7, 5
+        values = list(range(size_x * size_y))
+        data = get_raw_data(pixels_type, values)
+        pixels = Pixels(pixels_type, size_x, size_y)
+        raw_store = RawStore(data, size_x, len(data) // len(values))
+        plane = get_plane(raw_store, pixels, 0, 0, 0)
+        assert plane.tolist() == numpy.reshape(values, (size_y, size_x))\
+            .tolist()
+
+        upload_plane(raw_store, plane, pixels.getPixelsType(), 0, 0, 0)
+        assert raw_store.data == data
+        # native and not in C order
+        native = plane.astype(get_dtype(pixels_type).newbyteorder('='))
+        upload_plane(raw_store, native.T.copy().T, pixels.getPixelsType(),
+                     0, 0, 0)
+        assert raw_store.data == data
+        # converted to the pixels type
+        upload_plane(raw_store, numpy.zeros((size_y, size_x)),
+                     pixels.getPixelsType(), 0, 0, 0)
+        assert raw_store.data == get_raw_data(pixels_type, [0] * len(values))
+
+    @pytest.mark.skipif(not os.environ.get("OMERO_SCRIPTS_BENCHMARK"),
+                        reason="Set OMERO_SCRIPTS_BENCHMARK=1 to run")
+    @pytest.mark.parametrize("pixels_type", ["uint8", "uint16", "float"])
+    def test_benchmark_from_raw(self, pixels_type):
+        size_x, size_y = 512, 512
+        data = get_raw_data(pixels_type, [1] * (size_x * size_y))
+        struct_time = min(timeit.repeat(
+            lambda: struct_download(data, pixels_type, size_x, size_y),
+            number=2, repeat=3))
+        numpy_time = min(timeit.repeat(
+            lambda: from_raw(data, pixels_type, size_x, size_y),
+            number=2, repeat=3))
+        assert numpy_time * 10 < struct_time
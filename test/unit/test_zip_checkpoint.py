@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+   Test of the checkpoints of the zip of a batch image export
+   Copyright 2026 Open Microscopy Environment. All rights reserved.
+   Use is subject to license terms supplied in LICENSE.txt
+"""
+
+import os
+import time
+import zipfile
+
+import pytest
+
+from omero.export_scripts.Batch_Image_Export import add_to_zip, \
+    checkpoint_zip_sink, create_zip_sink, remove_old_checkpoint_dirs
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+def add_files(sink, names):
+    for name in names:
+        add_to_zip(sink, name, name.encode() * 100,
+                   key=(1, "", name, "0", 0))
+
+
+@pytest.mark.parametrize("killed", [True, False])
+def test_resume_from_checkpoint(tmp_path, killed):
+    target = str(tmp_path / "export.zip")
+    ledger_path = str(tmp_path / "ledger.sqlite")
+    sink = create_zip_sink(target, ledger_path)
+    add_files(sink, ["a.png", "b.png", "c.png"])
+    checkpoint_zip_sink(sink)
+    add_files(sink, ["d.png", "e.png"])
+    checkpoint_zip_sink(sink)
+    # not in the checkpoint
+    add_files(sink, ["f.png"])
+    end = sink["zip"].start_dir
+    sink["zip"].close()
+    sink["ledger"].close()
+    if killed:
+        # the central directory was never written
+        os.truncate(target, end)
+
+    sink = create_zip_sink(target, ledger_path)
+    assert sorted(sink["done"].values()) == \
+        ["a.png", "b.png", "c.png", "d.png", "e.png"]
+    add_files(sink, ["g.png"])
+    checkpoint_zip_sink(sink)
+    sink["zip"].close()
+    sink["ledger"].close()
+
+    with zipfile.ZipFile(target) as zip_file:
+        assert zip_file.testzip() is None
+        assert zip_file.namelist() == \
+            ["a.png", "b.png", "c.png", "d.png", "e.png", "g.png"]
+        assert zip_file.read("g.png") == b"g.png" * 100
+
+    # the checkpoint after the resume is resumed too
+    sink = create_zip_sink(target, ledger_path)
+    assert len(sink["done"]) == 6
+    sink["zip"].close()
+    sink["ledger"].close()
+
+
+def test_remove_old_checkpoint_dirs(tmp_path):
+    old_time = time.time() - 8 * 24 * 3600
+    for name in ["old", "new", "locked"]:
+        os.makedirs(str(tmp_path / name))
+        with open(str(tmp_path / name / "export.zip"), 'w'):
+            pass
+        if name != "new":
+            for path in [tmp_path / name / "export.zip", tmp_path / name]:
+                os.utime(str(path), (old_time, old_time))
+    lock_file = open(str(tmp_path / "locked" / "lock"), 'w')
+    try:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        for path in [tmp_path / "locked" / "lock", tmp_path / "locked"]:
+            os.utime(str(path), (old_time, old_time))
+        remove_old_checkpoint_dirs(str(tmp_path))
+    finally:
+        lock_file.close()
+    remaining = sorted(os.listdir(str(tmp_path)))
+    assert remaining == (["locked", "new"] if fcntl else ["new"])